@@ -1,56 +1,576 @@
-import os, json, uuid, re, time, io, csv, base64
+import os, json, uuid, re, time, io, csv, base64, logging, threading, contextvars, random
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache, wraps
 
 import azure.functions as func
 
-app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
+# ---------------------------
+# Resilience (Cosmos retry budget + circuit breaker)
+# ---------------------------
+COSMOS_TRANSIENT_STATUS = (408, 429, 449, 503)
+# 429/449 mean the write was not applied; after a 408/503 it may have been, so writes aren't retried on those
+COSMOS_WRITE_RETRY_STATUS = (429, 449)
+COSMOS_WRITE_OPS = {"create_item", "replace_item", "upsert_item", "delete_item", "patch_item", "execute_item_batch"}
+
+class CosmosUnavailable(Exception):
+    """Cosmos is throttling or unavailable and the request's retry budget is spent (or the breaker is open)."""
+    def __init__(self, message: str, retry_after_ms: int):
+        super().__init__(message)
+        self.retry_after_ms = max(int(retry_after_ms or 0), 0)
+
+_RETRY_BUDGET_MS = contextvars.ContextVar("cosmos_retry_budget_ms", default=None)
+# Per-request read consistency ("eventual" on list routes) and Cosmos session tokens keyed by container:
+# _SESSION_IN holds what the client echoed back, _SESSION_OUT what this request's writes produced.
+_READ_CONSISTENCY = contextvars.ContextVar("cosmos_read_consistency", default=None)
+_SESSION_IN = contextvars.ContextVar("cosmos_session_in", default=None)
+_SESSION_OUT = contextvars.ContextVar("cosmos_session_out", default=None)
+SESSION_HEADER = "x-fieldops-session"
+_METRICS_LOCK = threading.Lock()
+_COSMOS_METRICS = {"calls": 0, "retries": 0, "throttled": 0, "transient": 0, "exhausted": 0, "shed": 0, "breakerOpened": 0}
+_BREAKER = {"failures": [], "openUntil": 0.0}
+
+def _metric(name: str, n: int = 1):
+    with _METRICS_LOCK:
+        _COSMOS_METRICS[name] = _COSMOS_METRICS.get(name, 0) + n
+
+def _breaker_failure():
+    # Failures age out of the sliding window on their own; a success in between doesn't reset it, so
+    # an outage where most (not all) calls fail still trips the breaker.
+    window = float(os.environ.get("COSMOS_BREAKER_WINDOW_S", "10"))
+    threshold = int(os.environ.get("COSMOS_BREAKER_THRESHOLD", "20"))
+    now = time.time()
+    with _METRICS_LOCK:
+        f = [t for t in _BREAKER["failures"] if now - t < window]
+        f.append(now)
+        _BREAKER["failures"] = f
+        if len(f) >= threshold and _BREAKER["openUntil"] <= now:
+            _BREAKER["openUntil"] = now + float(os.environ.get("COSMOS_BREAKER_COOLDOWN_S", "5"))
+            _COSMOS_METRICS["breakerOpened"] += 1
+            logging.warning("Cosmos circuit breaker opened after %d transient failures in %ss", len(f), window)
+
+def _retry_after_ms(e, attempt: int) -> int:
+    headers = getattr(e, "headers", None) or {}
+    try:
+        v = headers.get("x-ms-retry-after-ms")
+        if v is not None:
+            return int(float(v))
+    except Exception:
+        pass
+    return min(100 * (2 ** attempt), 2000)
+
+# ---- Profiling (opt-in): per-dependency timings for the current request, shared with worker threads
+_PROFILE = contextvars.ContextVar("request_profile", default=None)
+
+class _dep_timer:
+    """Context manager adding elapsed ms under deps[dependency][op] when the request is being profiled."""
+    __slots__ = ("dep", "op", "t0")
+    def __init__(self, dep: str, op: str):
+        self.dep, self.op = dep, op
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+    def __exit__(self, *exc):
+        prof = _PROFILE.get()
+        if prof is not None:
+            ms = (time.perf_counter() - self.t0) * 1000
+            with prof["lock"]:
+                d = prof["deps"].setdefault(self.dep, {"calls": 0, "ms": 0.0, "ops": {}})
+                d["calls"] += 1; d["ms"] += ms
+                o = d["ops"].setdefault(self.op, {"calls": 0, "ms": 0.0})
+                o["calls"] += 1; o["ms"] += ms
+        return False
+
+class _TimedClient:
+    """Proxy timing every method of an Azure SDK client (and the clients/downloaders it hands out)."""
+    def __init__(self, inner, dep: str):
+        self._inner, self._dep = inner, dep
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if not callable(attr):
+            return attr
+        def call(*a, **kw):
+            if name.startswith("get_") and name.endswith("_client"):
+                return _TimedClient(attr(*a, **kw), self._dep)
+            with _dep_timer(self._dep, name):
+                out = attr(*a, **kw)
+            return _TimedClient(out, self._dep) if name == "download_blob" else out
+        return call
+
+def _cosmos_call(fn, *args, **kwargs):
+    """
+    Run one Cosmos operation, retrying throttles/transient errors after x-ms-retry-after-ms while the
+    per-request budget (COSMOS_RETRY_BUDGET_MS) lasts. Writes are only retried on 429/449; a 408/503
+    leaves their outcome unknown, so it is surfaced instead (clients retry with their Idempotency-Key).
+    Raises CosmosUnavailable when the breaker is open or the budget is exhausted so handlers can shed
+    load with 503 + Retry-After.
+    """
+    now = time.time()
+    if _BREAKER["openUntil"] > now:
+        _metric("shed")
+        raise CosmosUnavailable("Cosmos DB is saturated; retry shortly", (_BREAKER["openUntil"] - now) * 1000)
+    _metric("calls")
+    max_attempts = int(os.environ.get("COSMOS_MAX_RETRIES", "5"))
+    is_write = getattr(fn, "__name__", "") in COSMOS_WRITE_OPS
+    attempt = 0
+    while True:
+        try:
+            with _dep_timer("cosmos", getattr(fn, "__name__", "call")):
+                return fn(*args, **kwargs)
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            if status not in COSMOS_TRANSIENT_STATUS:
+                raise
+            _metric("throttled" if status == 429 else "transient")
+            _breaker_failure()
+            wait = _retry_after_ms(e, attempt)
+            budget = _RETRY_BUDGET_MS.get()
+            if budget is None:
+                budget = int(os.environ.get("COSMOS_RETRY_BUDGET_MS", "2000"))
+            if (is_write and status not in COSMOS_WRITE_RETRY_STATUS) or attempt >= max_attempts or wait > budget \
+                    or _BREAKER["openUntil"] > time.time():
+                _metric("exhausted")
+                raise CosmosUnavailable(f"Cosmos DB request failed with {status}; retry shortly", wait)
+            _RETRY_BUDGET_MS.set(budget - wait)
+            _metric("retries")
+            with _dep_timer("cosmos", "retry_wait"):
+                time.sleep(wait / 1000.0)
+            attempt += 1
+
+def _merge_session_tokens(a: str, b: str) -> str:
+    """Union of two compound session tokens ("<range>:<version>#<lsn>...,..."), keeping the newer LSN per range."""
+    def lsn(part):
+        try: return int(part.split(":", 1)[1].split("#")[1])
+        except (IndexError, ValueError): return -1
+    ranges = {}
+    for part in ",".join(t for t in (a, b) if t).split(","):
+        rid = part.split(":", 1)[0]
+        if part and (rid not in ranges or lsn(part) >= lsn(ranges[rid])):
+            ranges[rid] = part
+    return ",".join(ranges.values())
+
+def _decode_session(value) -> dict:
+    if not value:
+        return {}
+    try:
+        out = json.loads(base64.urlsafe_b64decode(value.encode("ascii")).decode("utf-8"))
+        return {str(k): str(v) for k, v in out.items()} if isinstance(out, dict) else {}
+    except Exception:
+        return {}
+
+def _capture_session(container_id: str, kwargs: dict) -> dict:
+    """Add a response_hook that records the write's session token for the response header."""
+    out = _SESSION_OUT.get()
+    if out is None:
+        return kwargs
+    prior = kwargs.get("response_hook")
+    def hook(headers, result):
+        token = (headers or {}).get("x-ms-session-token")
+        if token:
+            out[container_id] = _merge_session_tokens(out.get(container_id), token)
+        if prior:
+            prior(headers, result)
+    return dict(kwargs, response_hook=hook)
+
+def _with_session_header(resp):
+    out = _SESSION_OUT.get()
+    if out and isinstance(resp, func.HttpResponse):
+        merged = dict(_SESSION_IN.get() or {})
+        for cid, token in out.items():
+            merged[cid] = _merge_session_tokens(merged.get(cid), token)
+        resp.headers[SESSION_HEADER] = base64.urlsafe_b64encode(json.dumps(merged).encode("utf-8")).decode("ascii")
+    return resp
+
+class _ResilientQuery:
+    """Lazy query result: full iteration runs under _cosmos_call; by_page() passes through unretried."""
+    def __init__(self, fn, args, kwargs):
+        self._fn, self._args, self._kwargs = fn, args, kwargs
+    def __iter__(self):
+        def query_items():
+            return list(self._fn(*self._args, **self._kwargs))
+        return iter(_cosmos_call(query_items))
+    def by_page(self, continuation_token=None):
+        return self._fn(*self._args, **self._kwargs).by_page(continuation_token)
+
+class _ResilientContainer:
+    """
+    ContainerProxy wrapper routing data-plane calls through _cosmos_call. Writes record their session
+    token; reads carry the client's echoed token (read-your-writes) or, on list routes, go through the
+    relaxed-consistency client.
+    """
+    _RETRIED = {"read", "read_item", "read_many_items", "create_item", "replace_item", "upsert_item",
+                "delete_item", "patch_item", "execute_item_batch"}
+    _WRITES = COSMOS_WRITE_OPS
+    _READS = {"read_item", "read_many_items", "query_items"}
+    def __init__(self, inner):
+        self._inner = inner
+        self._relaxed = None
+    @property
+    def id(self):
+        return self._inner.id
+    def _read_target(self, kw):
+        token = (_SESSION_IN.get() or {}).get(self.id)
+        if token and "session_token" not in kw:
+            kw["session_token"] = token
+            return self._inner
+        if _READ_CONSISTENCY.get() == "eventual":
+            if self._relaxed is None:
+                db = _cosmos_relaxed_db()
+                self._relaxed = db.get_container_client(self.id) if db is not None else self._inner
+            return self._relaxed
+        return self._inner
+    def __getattr__(self, name):
+        attr = getattr(self._inner, name)
+        if name in self._READS:
+            def read(*a, **kw):
+                fn = getattr(self._read_target(kw), name)
+                if name == "query_items":
+                    return _ResilientQuery(fn, a, kw)
+                return _cosmos_call(fn, *a, **kw)
+            return read
+        if name in self._WRITES:
+            return lambda *a, **kw: _cosmos_call(attr, *a, **_capture_session(self.id, kw))
+        if name in self._RETRIED:
+            return lambda *a, **kw: _cosmos_call(attr, *a, **kw)
+        return attr
+
+class ConcurrentUpdate(Exception):
+    """A conditional (etag) write lost to another writer -- e.g. the doc was soft-deleted or re-evaluated meanwhile."""
+
+def _error_response(e):
+    """Map a handler exception to a response: 503 + Retry-After when Cosmos is saturated, 409 on a lost etag race, else 500."""
+    if isinstance(e, ConcurrentUpdate):
+        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=409)
+    if isinstance(e, CosmosUnavailable):
+        seconds = max(1, -(-e.retry_after_ms // 1000))
+        return func.HttpResponse(json.dumps({"error": str(e), "retryAfterMs": e.retry_after_ms}),
+                                 mimetype="application/json", status_code=503,
+                                 headers={"Retry-After": str(seconds)})
+    return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+
+def _profile_start():
+    """
+    Decide whether to profile this request: PROFILE_SAMPLE_RATE (0..1) of requests get cProfile plus
+    dependency timings; with PROFILE_SLOW_MS set every request collects the (cheap) dependency timings
+    and is written out only if it ran over the threshold. Returns the profile dict or None.
+    The Server-Timing header is added only to sampled requests from admins, or to every profiled
+    response with PROFILE_SERVER_TIMING=true (dependency timings are internal detail).
+    """
+    rate = float(os.environ.get("PROFILE_SAMPLE_RATE", "0") or 0)
+    slow_ms = float(os.environ.get("PROFILE_SLOW_MS", "0") or 0)
+    sampled = rate > 0 and random.random() < rate
+    if not sampled and slow_ms <= 0:
+        return None
+    prof = {"lock": threading.Lock(), "deps": {}, "sampled": sampled, "cprofile": None, "t0": time.perf_counter()}
+    if sampled:
+        import cProfile
+        try:
+            prof["cprofile"] = cProfile.Profile()
+            prof["cprofile"].enable()
+        except ValueError:
+            prof["cprofile"] = None  # another request on this worker is already under cProfile
+    return prof
+
+def _profile_finish(prof, route_name: str, req, resp):
+    total_ms = (time.perf_counter() - prof["t0"]) * 1000
+    cp = prof["cprofile"]
+    if cp is not None:
+        cp.disable()
+    slow_ms = float(os.environ.get("PROFILE_SLOW_MS", "0") or 0)
+    expose = os.environ.get("PROFILE_SERVER_TIMING", "false").lower() == "true" \
+        or (prof["sampled"] and "admin" in _principal(req)["roles"])
+    if expose and isinstance(resp, func.HttpResponse):
+        timing = [f"{dep};dur={d['ms']:.1f}" for dep, d in sorted(prof["deps"].items())] + [f"total;dur={total_ms:.1f}"]
+        resp.headers["Server-Timing"] = ", ".join(timing)
+    if prof["sampled"] or (slow_ms > 0 and total_ms >= slow_ms):
+        _submit_background(_write_profile, {
+            "route": route_name, "method": req.method, "url": req.url,
+            "status": getattr(resp, "status_code", None), "totalMs": round(total_ms, 1),
+            "trigger": "sample" if prof["sampled"] else "slow", "at": _now_iso(),
+            "deps": prof["deps"],
+        }, cp)
+    return resp
+
+def _write_profile(meta: dict, cp):
+    """Write <route>-<time>-<id>.json (+ .prof for snakeviz/pstats) to PROFILE_DIR or the PROFILE_CONTAINER blob container."""
+    try:
+        name = f"{re.sub(r'[^a-zA-Z0-9]+', '-', meta['route']).strip('-') or 'root'}-{meta['at'][:19].replace(':', '')}-{uuid.uuid4().hex[:8]}"
+        raw = None
+        if cp is not None:
+            import pstats, marshal
+            text = io.StringIO()
+            stats = pstats.Stats(cp, stream=text)
+            stats.sort_stats("cumulative").print_stats(int(os.environ.get("PROFILE_TOP", "40")))
+            meta["cprofile"] = text.getvalue()
+            raw = marshal.dumps(stats.stats)
+        body = json.dumps(meta, indent=1, default=str).encode("utf-8")
+        out_dir = os.environ.get("PROFILE_DIR")
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+            with open(os.path.join(out_dir, name + ".json"), "wb") as f:
+                f.write(body)
+            if raw:
+                with open(os.path.join(out_dir, name + ".prof"), "wb") as f:
+                    f.write(raw)
+        else:
+            cont = _blob_service().get_container_client(os.environ.get("PROFILE_CONTAINER", "profiles"))
+            try:
+                cont.create_container()
+            except Exception:
+                pass  # already exists
+            cont.upload_blob(name + ".json", body, overwrite=True, content_settings=ContentSettings(content_type="application/json"))
+            if raw:
+                cont.upload_blob(name + ".prof", raw, overwrite=True)
+    except Exception:
+        logging.exception("writing profile failed")
+
+class _FieldOpsApp(func.FunctionApp):
+    """
+    FunctionApp whose HTTP handlers run in a per-request scope (fresh Cosmos retry budget, session tokens).
+    route(..., idempotent=True) additionally honours the Idempotency-Key request header;
+    route(..., reads="eventual") serves reads from the relaxed-consistency client unless the caller
+    echoed a session token from an earlier write; only for handlers that never write (their
+    read-modify-write would start from a stale doc). Profiling is opt-in via PROFILE_SAMPLE_RATE / PROFILE_SLOW_MS.
+    """
+    def route(self, *args, idempotent=False, reads=None, **kwargs):
+        register = super().route(*args, **kwargs)
+        route_name = kwargs.get("route") or (args[0] if args else "")
+        def deco(fn):
+            @wraps(fn)
+            def handler(req, *a, **kw):
+                token = _RETRY_BUDGET_MS.set(int(os.environ.get("COSMOS_RETRY_BUDGET_MS", "2000")))
+                scope = [(_READ_CONSISTENCY, _READ_CONSISTENCY.set(reads)),
+                         (_SESSION_IN, _SESSION_IN.set(_decode_session(req.headers.get(SESSION_HEADER)))),
+                         (_SESSION_OUT, _SESSION_OUT.set({}))]
+                prof = _profile_start()
+                if prof is not None:
+                    scope.append((_PROFILE, _PROFILE.set(prof)))
+                try:
+                    try:
+                        if idempotent and req.headers.get("Idempotency-Key"):
+                            resp = _with_session_header(_idempotent_call(lambda: fn(req, *a, **kw), req, route_name))
+                        else:
+                            resp = _with_session_header(fn(req, *a, **kw))
+                    except CosmosUnavailable as e:
+                        resp = _error_response(e)
+                    return _profile_finish(prof, route_name, req, resp) if prof is not None else resp
+                finally:
+                    if prof is not None and prof["cprofile"] is not None:
+                        prof["cprofile"].disable()
+                    _RETRY_BUDGET_MS.reset(token)
+                    for var, t in reversed(scope):
+                        var.reset(t)
+            return register(handler)
+        return deco
+
+app = _FieldOpsApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 # ---------------------------
 # Cosmos helpers
 # ---------------------------
-def _get_container_named(container_name: str):
-    from azure.cosmos import CosmosClient, PartitionKey
+# Task.site and TaskEvent.location are GeoJSON points; existing containers need this policy applied once.
+SPATIAL_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "includedPaths": [{"path": "/*"}],
+    "excludedPaths": [{"path": "/\"_etag\"/?"}],
+    "spatialIndexes": [
+        {"path": "/site/?", "types": ["Point"]},
+        {"path": "/location/?", "types": ["Point"]}
+    ]
+}
+
+# Partition layout for per-task documents (events, expenses) in containers created with
+# COSMOS_HIERARCHICAL_PK=true; existing containers keep whatever key they were created with.
+HPK_PATHS = ["/tenantId", "/taskId"]
+
+_CONTAINERS = {}
+_PK_PATHS = {}
+_TTL_ENABLED = {}
+
+def _cosmos_client_opts():
+    # Let _cosmos_call own throttle retries (and their budget) instead of the SDK's 9 x 30s default.
+    return {"retry_total": int(os.environ.get("COSMOS_SDK_THROTTLE_RETRIES", "0")),
+            "retry_backoff_max": int(os.environ.get("COSMOS_SDK_THROTTLE_WAIT_S", "1"))}
+
+@lru_cache(maxsize=1)
+def _cosmos_db():
+    from azure.cosmos import CosmosClient
     endpoint = os.environ.get("COSMOS_ENDPOINT")
     key = os.environ.get("COSMOS_KEY")
     db_name = os.environ.get("COSMOS_DB", "fieldops")
     if not endpoint or not key:
         raise RuntimeError("Missing Cosmos settings (COSMOS_ENDPOINT/COSMOS_KEY).")
-    client = CosmosClient(endpoint, key)
-    db = client.create_database_if_not_exists(db_name)
+    client = CosmosClient(endpoint, key, **_cosmos_client_opts())
+    return client.create_database_if_not_exists(db_name)
+
+@lru_cache(maxsize=1)
+def _cosmos_relaxed_db():
+    """
+    Second client at COSMOS_LIST_CONSISTENCY (default Eventual; ConsistentPrefix also works) for list and
+    dashboard reads. Can only weaken the account default. Empty setting disables it (None).
+    """
+    level = os.environ.get("COSMOS_LIST_CONSISTENCY", "Eventual").strip()
+    if not level:
+        return None
+    from azure.cosmos import CosmosClient
+    _cosmos_db()  # same settings validation and database creation
+    client = CosmosClient(os.environ["COSMOS_ENDPOINT"], os.environ["COSMOS_KEY"],
+                          consistency_level=level, **_cosmos_client_opts())
+    return client.get_database_client(os.environ.get("COSMOS_DB", "fieldops"))
+
+def _get_container_named(container_name: str, default_ttl: int = None, pk_paths=None):
+    c = _CONTAINERS.get(container_name)
+    if c is not None:
+        return c
+    from azure.cosmos import PartitionKey
+    db = _cosmos_db()
     try:
         c = db.get_container_client(container_name)
-        _ = c.read()
+        props = c.read()
     except Exception:
+        paths = pk_paths or ["/tenantId"]
+        pk = PartitionKey(path=paths, kind="MultiHash") if len(paths) > 1 else PartitionKey(path=paths[0])
+        opts = {} if default_ttl is None else {"default_ttl": default_ttl}
         c = db.create_container_if_not_exists(
-            id=container_name, partition_key=PartitionKey(path="/tenantId")
+            id=container_name, partition_key=pk,
+            indexing_policy=SPATIAL_INDEXING_POLICY, **opts
         )
+        props = c.read()
+    # Remember the real key paths so helpers below adapt to /tenantId or /tenantId+/taskId containers.
+    _PK_PATHS[container_name] = (props.get("partitionKey") or {}).get("paths") or ["/tenantId"]
+    _TTL_ENABLED[container_name] = props.get("defaultTtl") is not None
+    c = _ResilientContainer(c)
+    _CONTAINERS[container_name] = c
     return c
 
+def _per_task_pk_paths(container_name: str):
+    """
+    Hierarchical key paths for a per-task container, or None. Only a dedicated container gets them:
+    one shared with Tasks or the catalog (EVENTS_CONTAINER defaults to Tasks) must stay on /tenantId.
+    """
+    if os.environ.get("COSMOS_HIERARCHICAL_PK", "false").lower() != "true":
+        return None
+    shared = {os.environ.get("COSMOS_CONTAINER", "Tasks"), os.environ.get("CATALOG_CONTAINER", "Tasks")}
+    if container_name in shared:
+        logging.warning("COSMOS_HIERARCHICAL_PK ignored for %s: it also holds tasks or products; "
+                        "point EVENTS_CONTAINER/EXPENSES_CONTAINER at a dedicated container", container_name)
+        return None
+    return HPK_PATHS
+
 def _tasks_container():
     return _get_container_named(os.environ.get("COSMOS_CONTAINER", "Tasks"))
 
 def _expenses_container():
-    return _get_container_named(os.environ.get("EXPENSES_CONTAINER", "Expenses"))
+    name = os.environ.get("EXPENSES_CONTAINER", "Expenses")
+    return _get_container_named(name, default_ttl=-1, pk_paths=_per_task_pk_paths(name))
 
 def _events_container():
-    return _get_container_named(os.environ.get("EVENTS_CONTAINER", "Tasks"))
+    name = os.environ.get("EVENTS_CONTAINER", "Tasks")
+    return _get_container_named(name, default_ttl=-1, pk_paths=_per_task_pk_paths(name))
 
 def _catalog_container():
     return _get_container_named(os.environ.get("CATALOG_CONTAINER", "Tasks"))
 
+def _jobs_container():
+    # default_ttl=-1 enables per-document "ttl" without expiring docs that don't set it
+    return _get_container_named(os.environ.get("JOBS_CONTAINER", "Jobs"), default_ttl=-1)
+
+def _pk_paths(container):
+    return _PK_PATHS.get(container.id, ["/tenantId"])
+
+def _pk_value(container, doc):
+    """Full partition key value of a document for this container (scalar or hierarchical list)."""
+    vals = [doc.get(p.strip("/")) for p in _pk_paths(container)]
+    return vals[0] if len(vals) == 1 else vals
+
+def _tenant_pk(container, tenant: str):
+    """Partition key (or hierarchical prefix) that scopes a query to one tenant."""
+    return tenant if len(_pk_paths(container)) == 1 else [tenant]
+
+def _read_doc(container, item_id: str, tenant: str, task_id: str = None, include_deleted: bool = False):
+    """
+    Point read by id; on hierarchical containers without a taskId, a tenant-prefix query by id.
+    Soft-deleted docs read as not found unless include_deleted.
+    """
+    if len(_pk_paths(container)) == 1:
+        doc = container.read_item(item=item_id, partition_key=tenant)
+    elif task_id:
+        doc = container.read_item(item=item_id, partition_key=[tenant, task_id])
+    else:
+        items = list(container.query_items("SELECT * FROM c WHERE c.id=@id",
+                                           parameters=[{"name":"@id","value":item_id}], partition_key=[tenant]))
+        doc = items[0] if items else None
+    if not doc or ("deletedAt" in doc and not include_deleted):
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        raise CosmosResourceNotFoundError(message=f"{item_id} not found")
+    return doc
+
+def _etag_kwargs(doc) -> dict:
+    if not doc.get("_etag"):
+        return {}
+    from azure.core import MatchConditions
+    return {"etag": doc["_etag"], "match_condition": MatchConditions.IfNotModified}
+
+def _delete_doc(container, doc):
+    """Delete by id; docs read with an _etag are only deleted if unchanged since."""
+    container.delete_item(item=doc["id"], partition_key=_pk_value(container, doc), **_etag_kwargs(doc))
+
+def _replace_doc(container, doc):
+    """
+    Replace a doc read earlier, conditional on its _etag so a concurrent soft delete, decision or
+    checkout isn't overwritten by a stale body. Refreshes doc's _etag in place; raises ConcurrentUpdate.
+    """
+    try:
+        saved = container.replace_item(item=doc["id"], body=doc, **_etag_kwargs(doc))
+    except Exception as e:
+        if getattr(e, "status_code", None) == 412:
+            raise ConcurrentUpdate(f"{doc.get('docType', 'document')} {doc['id']} changed meanwhile; reload and retry")
+        raise
+    if isinstance(saved, dict):
+        doc["_etag"] = saved.get("_etag", doc.get("_etag"))
+    return saved
+
+# Soft delete: a deletedAt/purgeAfter marker (one patch) hides a doc from every query
+# ("NOT IS_DEFINED(c.deletedAt)" is served from the index); maintenance/purge removes it for good.
+def _patch_doc(container, doc, ops, predicate: str = None):
+    """
+    Partial update of the given paths only. With a predicate ("FROM c WHERE ...") the patch applies only
+    if it still holds; returns None when it doesn't (Cosmos answers 412).
+    """
+    kwargs = {"filter_predicate": predicate} if predicate else {}
+    try:
+        return container.patch_item(item=doc["id"], partition_key=_pk_value(container, doc), patch_operations=ops, **kwargs)
+    except Exception as e:
+        if predicate and getattr(e, "status_code", None) == 412:
+            return None
+        raise
+
+def _soft_delete(container, doc, deleted_by: str, deleted_at: str = None, **extra):
+    deleted_at = deleted_at or _now_iso()
+    days = float(os.environ.get("SOFT_DELETE_RETENTION_DAYS", "7"))
+    purge_after = (datetime.now(timezone.utc) + timedelta(days=days)).isoformat()
+    fields = {"deletedAt": deleted_at, "purgeAfter": purge_after, "deletedBy": deleted_by, **extra}
+    _patch_doc(container, doc, [{"op": "set", "path": f"/{k}", "value": v} for k, v in fields.items()])
+    return fields
+
+def _undelete(container, doc):
+    keys = [k for k in ("deletedAt", "purgeAfter", "deletedBy", "deleteCascade", "deletedWithTask") if k in doc]
+    if keys:
+        _patch_doc(container, doc, [{"op": "remove", "path": f"/{k}"} for k in keys])
+
 DEFAULT_LIMITS = {"Hotel": 1000, "Food": 1000, "Travel": 1000, "Other": 1000}
 
-def _get_task(tenant_id: str, task_id: str):
+def _get_task(tenant_id: str, task_id: str, include_deleted: bool = False):
     c = _tasks_container()
     try:
-        return c.read_item(item=task_id, partition_key=tenant_id)
+        task = c.read_item(item=task_id, partition_key=tenant_id)
+        return None if "deletedAt" in task and not include_deleted else task
     except Exception:
-        q = "SELECT * FROM c WHERE c.docType='Task' AND c.tenantId=@t AND c.id=@id"
+        q = "SELECT * FROM c WHERE c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND c.id=@id"
         items = list(c.query_items(q, parameters=[{"name":"@t","value":tenant_id},{"name":"@id","value":task_id}], enable_cross_partition_query=True))
         return items[0] if items else None
 
 def _save_task(doc):
-    _tasks_container().replace_item(item=doc, body=doc)
+    _apply_sla_index(doc)
+    _replace_doc(_tasks_container(), doc)
 
 def _now_iso():
     return datetime.now(timezone.utc).isoformat()
@@ -62,6 +582,26 @@ def _parse_iso(s):
     except Exception:
         return None
 
+def _sla_bucket(value):
+    """Hour bucket ("YYYY-MM-DDTHH", UTC) for an ISO timestamp or datetime."""
+    dt = value if isinstance(value, datetime) else _parse_iso(value)
+    if not dt: return None
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H")
+
+def _apply_sla_index(task):
+    # Only open tasks carry slaDueBucket, so the SLA monitor's range query never reads completed work.
+    bucket = _sla_bucket(task.get("slaEnd")) if task.get("status") != "COMPLETED" else None
+    if bucket != task.get("slaDueBucket"):
+        # new deadline or completed: the monitor's last verdict no longer applies
+        task.pop("slaRisk", None)
+        task.pop("slaRiskAt", None)
+    if bucket:
+        task["slaDueBucket"] = bucket
+    else:
+        task.pop("slaDueBucket", None)
+    return task
+
 # ---------------------------
 # Auth helpers (Static Web Apps)
 # ---------------------------
@@ -106,27 +646,172 @@ def _can_access_task(pr, task):
     user = (pr.get("userDetails") or pr.get("userId") or "").strip().lower()
     return bool(assignee and user and assignee == user)
 
+# ---------------------------
+# Idempotency-Key (replay first response for retried mutations)
+# ---------------------------
+def _idempotency_container():
+    return _get_container_named(os.environ.get("IDEMPOTENCY_CONTAINER", "Idempotency"), default_ttl=-1)
+
+def _idempotent_call(run, req: func.HttpRequest, route_name: str):
+    """
+    Execute run() once per (caller, route, Idempotency-Key). The first response (< 500) is stored for
+    IDEMPOTENCY_TTL_SECONDS and replayed to retries with Idempotent-Replayed: true; a retry that arrives
+    while the first attempt is still running gets 409, and reusing a key for a different body gets 422.
+    """
+    import hashlib
+    pr = _principal(req)
+    if not pr["isAuthenticated"]:
+        return run()  # handler answers 401 itself
+    user = (pr.get("userDetails") or pr.get("userId") or "").strip().lower()
+    key = req.headers.get("Idempotency-Key").strip()
+    body = req.get_body() or b""
+    fingerprint = hashlib.sha256(req.method.upper().encode() + b" " + body).hexdigest()
+    doc_id = hashlib.sha256(f"{user}|{route_name}|{key}".encode("utf-8")).hexdigest()
+    pk = f"idem:{user}"
+    c = _idempotency_container()
+
+    def _json(status, payload, **headers):
+        return func.HttpResponse(json.dumps(payload), mimetype="application/json", status_code=status, headers=headers or None)
+
+    try:
+        rec = c.read_item(item=doc_id, partition_key=pk)
+    except CosmosUnavailable:
+        raise
+    except Exception as e:
+        if getattr(e, "status_code", None) != 404:
+            raise
+        rec = None
+
+    lock_s = int(os.environ.get("IDEMPOTENCY_LOCK_SECONDS", "120"))
+    if rec:
+        if rec.get("fingerprint") != fingerprint:
+            return _json(422, {"error": "Idempotency-Key was already used for a different request"})
+        if rec.get("state") == "DONE":
+            headers = dict(rec.get("headers") or {})
+            headers["Idempotent-Replayed"] = "true"
+            return func.HttpResponse(base64.b64decode(rec["body"]), status_code=rec["status"],
+                                     headers=headers, mimetype=rec.get("mimetype"))
+        started = _parse_iso(rec.get("startedAt"))
+        if started and (datetime.now(timezone.utc) - started).total_seconds() < lock_s:
+            return _json(409, {"error": "a request with this Idempotency-Key is still in progress"}, **{"Retry-After": "1"})
+
+    marker = {"id": doc_id, "tenantId": pk, "docType": "IdempotencyRecord", "route": route_name,
+              "fingerprint": fingerprint, "state": "IN_PROGRESS", "startedAt": _now_iso(), "ttl": lock_s * 2}
+    try:
+        if rec:
+            c.replace_item(item=doc_id, body=marker)  # previous attempt died mid-flight
+        else:
+            c.create_item(marker)
+    except CosmosUnavailable:
+        raise
+    except Exception as e:
+        if getattr(e, "status_code", None) == 409:
+            return _json(409, {"error": "a request with this Idempotency-Key is still in progress"}, **{"Retry-After": "1"})
+        raise
+
+    try:
+        resp = run()
+    except Exception:
+        c.delete_item(item=doc_id, partition_key=pk)
+        raise
+    if resp.status_code >= 500:
+        c.delete_item(item=doc_id, partition_key=pk)  # let the client retry for real
+        return resp
+    marker.update({
+        "state": "DONE",
+        "status": resp.status_code,
+        "mimetype": resp.mimetype,
+        "headers": {k: v for k, v in dict(resp.headers).items() if k.lower() not in ("content-length", "content-type")},
+        "body": base64.b64encode(resp.get_body() or b"").decode("ascii"),
+        "finishedAt": _now_iso(),
+        "ttl": int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+    })
+    c.replace_item(item=doc_id, body=marker)
+    return resp
+
+# ---------------------------
+# Geo helpers (GeoJSON points, geofence)
+# ---------------------------
+def _geo_point(lat, lng):
+    """GeoJSON Point ([lng, lat] order) or None if the coordinates are missing/invalid."""
+    try:
+        lat = float(lat); lng = float(lng)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return {"type": "Point", "coordinates": [lng, lat]}
+
+def _site_from(data):
+    """Task site from { site: GeoJSON } or { siteLat, siteLng }."""
+    site = data.get("site")
+    if isinstance(site, dict) and isinstance(site.get("coordinates"), list) and len(site["coordinates"]) == 2:
+        return _geo_point(site["coordinates"][1], site["coordinates"][0])
+    return _geo_point(data.get("siteLat"), data.get("siteLng"))
+
+def _site_radius(value):
+    """siteRadiusM from a payload: None when blank, else a positive float; raises ValueError otherwise."""
+    if value in ("", None):
+        return None
+    try:
+        radius = float(value)
+    except (TypeError, ValueError):
+        radius = None
+    if radius is None or not radius > 0:
+        raise ValueError("siteRadiusM must be a positive number")
+    return radius
+
+def _distance_m(a, b):
+    """Great-circle (haversine) distance in metres between two GeoJSON points."""
+    import math
+    lng1, lat1 = map(math.radians, a["coordinates"])
+    lng2, lat2 = map(math.radians, b["coordinates"])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000.0 * math.asin(math.sqrt(h))
+
+def _geofence(task, point):
+    """(distanceM, within) for a position against the task site; (None, None) when either is unknown."""
+    site = (task or {}).get("site")
+    if not site or not point:
+        return None, None
+    radius = float(task.get("siteRadiusM") or os.environ.get("GEOFENCE_RADIUS_M", "200"))
+    d = _distance_m(site, point)
+    return round(d, 1), d <= radius
+
 # ---------------------------
 # Blob helpers (receipts)
 # ---------------------------
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
+from azure.storage.blob import BlobServiceClient, ContentSettings, generate_blob_sas, BlobSasPermissions
 
 SAFE_NAME = re.compile(r"[^a-zA-Z0-9._/-]+")
 
 def _sanitize_blob_name(name: str) -> str:
     return SAFE_NAME.sub("-", (name or "").strip()).strip("/")
 
-def _blob_service():
+@lru_cache(maxsize=1)
+def _storage_settings():
+    """(account, key, container, account_url) — read once per worker; SAS signing is local HMAC."""
     account = os.environ["STG_ACCOUNT"]
     key = os.environ["STG_KEY"]
-    url = f"https://{account}.blob.core.windows.net"
-    return BlobServiceClient(account_url=url, credential=key)
-
-def _make_blob_urls(task_id: str, filename: str, *, for_read=False, for_write=False, minutes=10):
-    account   = os.environ["STG_ACCOUNT"]
-    key       = os.environ["STG_KEY"]
     container = os.environ.get("STG_CONTAINER", "receipts")
-    blob_name = _sanitize_blob_name(f"{task_id}/{filename}")
+    return account, key, container, f"https://{account}.blob.core.windows.net"
+
+@lru_cache(maxsize=1)
+def _blob_service():
+    account, key, _, url = _storage_settings()
+    return _TimedClient(BlobServiceClient(account_url=url, credential=key), "blob")
+
+RECEIPT_VARIANTS = ("ocr", "thumb")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+
+def _receipt_blob_name(task_id: str, filename: str, variant: str = None) -> str:
+    # Variants live under "_<variant>/" so they never show up in the task's "<taskId>/" listing.
+    if not variant or variant == "original":
+        return _sanitize_blob_name(f"{task_id}/{filename}")
+    return _sanitize_blob_name(f"_{variant}/{task_id}/{filename}.jpg")
+
+def _sign_blob_url(container: str, blob_name: str, *, for_read=False, for_write=False, minutes=10, **sas_kwargs):
+    account, key, _, account_url = _storage_settings()
     perms = BlobSasPermissions(read=for_read, write=for_write, create=for_write)
     sas = generate_blob_sas(
         account_name=account,
@@ -135,10 +820,78 @@ def _make_blob_urls(task_id: str, filename: str, *, for_read=False, for_write=Fa
         account_key=key,
         permission=perms,
         expiry=datetime.utcnow() + timedelta(minutes=minutes),
+        **sas_kwargs
     )
-    blob_url = f"https://{account}.blob.core.windows.net/{container}/{blob_name}"
+    blob_url = f"{account_url}/{container}/{blob_name}"
     return blob_url, f"{blob_url}?{sas}"
 
+def _make_blob_urls(task_id: str, filename: str, *, for_read=False, for_write=False, minutes=10, variant=None):
+    container = _storage_settings()[2]
+    blob_name = _receipt_blob_name(task_id, filename, variant)
+    return _sign_blob_url(container, blob_name, for_read=for_read, for_write=for_write, minutes=minutes)
+
+def _ensure_receipt_variants(task_id: str, filename: str, *, force=False):
+    """
+    Create the OCR-sized and thumbnail JPEG variants of an uploaded receipt image.
+    Returns the variants available; empty for non-images or when Pillow isn't installed.
+    """
+    if not (filename or "").lower().endswith(IMAGE_EXTS):
+        return []
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return []
+    cont = _blob_service().get_container_client(_storage_settings()[2])
+    # thumb is written last, so its presence means both variants exist
+    if not force and cont.get_blob_client(_receipt_blob_name(task_id, filename, "thumb")).exists():
+        return list(RECEIPT_VARIANTS)
+
+    raw = cont.get_blob_client(_receipt_blob_name(task_id, filename)).download_blob().readall()
+    img = Image.open(io.BytesIO(raw))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    sizes = {
+        "ocr":   (int(os.environ.get("RECEIPT_OCR_MAX_PX", "2000")), 85),
+        "thumb": (int(os.environ.get("RECEIPT_THUMB_MAX_PX", "320")), 75),
+    }
+    for variant in RECEIPT_VARIANTS:
+        max_px, quality = sizes[variant]
+        v = img.copy()
+        v.thumbnail((max_px, max_px))
+        buf = io.BytesIO()
+        v.save(buf, "JPEG", quality=quality, optimize=True)
+        cont.upload_blob(_receipt_blob_name(task_id, filename, variant), buf.getvalue(), overwrite=True,
+                         content_settings=ContentSettings(content_type="image/jpeg"))
+    return list(RECEIPT_VARIANTS)
+
+def _archive_container_name():
+    return os.environ.get("STG_ARCHIVE_CONTAINER", "archive")
+
+def _archived_docs(task, kind: str):
+    """Events or expenses ("events" | "expenses") from a compacted task's archive blob."""
+    arch = (task or {}).get("archive")
+    if not arch or not arch.get("blob"):
+        return []
+    raw = _blob_service().get_container_client(_archive_container_name()).download_blob(arch["blob"]).readall()
+    return json.loads(raw).get(kind) or []
+
+def _with_archived(task, kind: str, hot):
+    # Hot copies may still exist until their TTL fires; the hot version wins.
+    cold = _archived_docs(task, kind)
+    if not cold:
+        return hot
+    seen = {d.get("id") for d in hot}
+    return list(hot) + [d for d in cold if d.get("id") not in seen]
+
+def _ocr_read_url(task_id: str, filename: str):
+    """Original blob URL plus the read URL OCR should use (the downscaled variant when available)."""
+    blob_url, read_url = _make_blob_urls(task_id, filename, for_read=True, minutes=10)
+    try:
+        if "ocr" in _ensure_receipt_variants(task_id, filename):
+            _, read_url = _make_blob_urls(task_id, filename, for_read=True, minutes=10, variant="ocr")
+    except Exception:
+        pass  # fall back to the original upload
+    return blob_url, read_url
+
 # ---------------------------
 # Routes
 # ---------------------------
@@ -147,7 +900,7 @@ def hello(req: func.HttpRequest) -> func.HttpResponse:
     return func.HttpResponse("Hello from Python Functions, world!", status_code=200)
 
 # ---- Products (catalog)
-@app.route(route="products", methods=["GET"])
+@app.route(route="products", methods=["GET"], reads="eventual")
 def products_list(req: func.HttpRequest) -> func.HttpResponse:
     # Any authenticated user can read
     pr, err = _ensure_auth(req)
@@ -155,11 +908,11 @@ def products_list(req: func.HttpRequest) -> func.HttpResponse:
     try:
         tenant = req.params.get("tenantId", "default")
         c = _catalog_container()
-        q = "SELECT * FROM c WHERE c.tenantId=@t AND c.docType='Product' ORDER BY c.name"
+        q = "SELECT * FROM c WHERE c.tenantId=@t AND c.docType='Product' AND NOT IS_DEFINED(c.deletedAt) ORDER BY c.name"
         items = list(c.query_items(q, parameters=[{"name":"@t","value": tenant}], enable_cross_partition_query=True))
         return func.HttpResponse(json.dumps(items), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 @app.route(route="products", methods=["POST"])
 def products_create(req: func.HttpRequest) -> func.HttpResponse:
@@ -179,44 +932,261 @@ def products_create(req: func.HttpRequest) -> func.HttpResponse:
             "name": name,
             "sku": (data.get("sku") or "").strip() or None,
             "unitPrice": data.get("unitPrice"),
+            "usageCount": 0,
             "createdAt": _now_iso()
         }
         c.create_item(item)
         return func.HttpResponse(json.dumps(item), mimetype="application/json", status_code=201)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+# ---- Products (usage counter: live tasks referencing each product, kept in step with task writes)
+def _product_ids(items) -> set:
+    return {(it or {}).get("productId") for it in (items or []) if isinstance(it, dict) and it.get("productId")}
+
+def _usage_delta(before=None, after=None, delta=None) -> dict:
+    delta = {} if delta is None else delta
+    for pid in _product_ids(before):
+        delta[pid] = delta.get(pid, 0) - 1
+    for pid in _product_ids(after):
+        delta[pid] = delta.get(pid, 0) + 1
+    return delta
+
+def _apply_product_usage(tenant: str, delta: dict):
+    """
+    Increment usageCount per product. Products created before the counter existed have no usageCount
+    and are skipped (filter predicate); products/delete recounts those once.
+    """
+    cc = _catalog_container()
+    for pid, n in delta.items():
+        if not n:
+            continue
+        try:
+            _patch_doc(cc, {"id": pid, "tenantId": tenant}, [{"op": "incr", "path": "/usageCount", "value": n}],
+                       predicate="FROM c WHERE IS_DEFINED(c.usageCount)")
+        except Exception as e:
+            # unknown product, or a legacy one without a counter yet
+            logging.debug("usageCount not adjusted for %s: %s", pid, e)
 
 # ---- Tasks (create/list + limits)
-@app.route(route="tasks", methods=["POST"])
+def _new_task_doc(data, tenant: str = None):
+    """Task document from a create payload (shared by tasks POST and tasks/import)."""
+    limits = data.get("expenseLimits") or DEFAULT_LIMITS.copy()
+    items  = data.get("items") or []
+    item = {
+        "id": data.get("id") or str(uuid.uuid4()),
+        "tenantId": tenant or data.get("tenantId", "default"),
+        "type": data.get("type", "data_collection"),
+        "title": data.get("title", ""),
+        "assignee": (data.get("assignee") or "").strip(),  # recommend using employee email
+        "slaStart": data.get("slaStart"),
+        "slaEnd": data.get("slaEnd"),
+        "status": data.get("status", "ASSIGNED"),
+        "expenseLimits": limits,
+        "items": items,
+        "createdAt": _now_iso(),
+        "docType": "Task"
+    }
+    site = _site_from(data)
+    if site:
+        item["site"] = site
+        radius = _site_radius(data.get("siteRadiusM"))
+        if radius is not None:
+            item["siteRadiusM"] = radius
+    return _apply_sla_index(item)
+
+@app.route(route="tasks", methods=["POST"], idempotent=True)
 def create_task(req: func.HttpRequest) -> func.HttpResponse:
     # Admin only
     pr, err = _ensure_admin(req)
     if err: return err
     try:
         data = req.get_json()
+        try:
+            _site_radius(data.get("siteRadiusM"))
+        except ValueError as e:
+            return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=400)
         c = _tasks_container()
-        limits = data.get("expenseLimits") or DEFAULT_LIMITS.copy()
-        items  = data.get("items") or []
-        item = {
-            "id": data.get("id") or str(uuid.uuid4()),
-            "tenantId": data.get("tenantId", "default"),
-            "type": data.get("type", "data_collection"),
-            "title": data.get("title", ""),
-            "assignee": (data.get("assignee") or "").strip(),  # recommend using employee email
-            "slaStart": data.get("slaStart"),
-            "slaEnd": data.get("slaEnd"),
-            "status": data.get("status", "ASSIGNED"),
-            "expenseLimits": limits,
-            "items": items,
-            "createdAt": _now_iso(),
-            "docType": "Task"
-        }
+        item = _new_task_doc(data)
         c.create_item(item)
+        _apply_product_usage(item["tenantId"], _usage_delta(after=item["items"]))
         return func.HttpResponse(json.dumps(item), mimetype="application/json", status_code=201)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
-@app.route(route="tasks", methods=["GET"])
+# ---- Tasks (bulk import)
+TASK_IMPORT_CSV_COLUMNS = ("id", "title", "type", "assignee", "slaStart", "slaEnd", "items",
+                           "Hotel", "Food", "Travel", "Other", "siteLat", "siteLng", "siteRadiusM")
+
+def _import_rows_from_csv(text: str):
+    """
+    CSV rows -> task payloads. Columns: TASK_IMPORT_CSV_COLUMNS (title required);
+    items as "productId:qty;productId:qty"; Hotel/Food/Travel/Other are expense limits.
+    """
+    rows = []
+    for r in csv.DictReader(io.StringIO(text)):
+        r = {(k or "").strip(): (v or "").strip() for k, v in r.items() if isinstance(v, str) or v is None}
+        row = {k: r[k] for k in ("id", "title", "type", "assignee", "slaStart", "slaEnd",
+                                 "siteLat", "siteLng", "siteRadiusM") if r.get(k)}
+        items = []
+        for part in (r.get("items") or "").split(";"):
+            if not part.strip():
+                continue
+            pid, _, qty = part.partition(":")
+            items.append({"productId": pid.strip(), "quantity": qty.strip() or 1})
+        row["items"] = items
+        limits = {cat: r[cat] for cat in DEFAULT_LIMITS if r.get(cat)}
+        if limits:
+            row["expenseLimits"] = {**DEFAULT_LIMITS, **limits}
+        rows.append(row)
+    return rows
+
+def _validate_import_row(row, users, products):
+    """Normalized task payload plus a list of validation errors for one import row."""
+    if not isinstance(row, dict):
+        return None, ["row must be an object"]
+    errors = []
+    out = dict(row)
+    out["title"] = (row.get("title") or "").strip()
+    if not out["title"]:
+        errors.append("title is required")
+    assignee = (row.get("assignee") or "").strip().lower()
+    if not assignee:
+        errors.append("assignee is required")
+    elif users is not None and assignee not in users:
+        errors.append(f"assignee {assignee} is not an active user")
+    out["assignee"] = assignee
+
+    start, end = row.get("slaStart"), row.get("slaEnd")
+    start_dt, end_dt = _parse_iso(start), _parse_iso(end)
+    if start and not start_dt: errors.append("slaStart is not an ISO date")
+    if end and not end_dt: errors.append("slaEnd is not an ISO date")
+    if start_dt and end_dt:
+        norm = lambda d: d if d.tzinfo else d.replace(tzinfo=timezone.utc)
+        if norm(end_dt) <= norm(start_dt):
+            errors.append("slaEnd must be after slaStart")
+
+    limits = row.get("expenseLimits")
+    if limits is not None:
+        try:
+            out["expenseLimits"] = {k: float(v) for k, v in dict(limits).items()}
+        except Exception:
+            errors.append("expenseLimits must be numbers")
+
+    items = []
+    for it in (row.get("items") or []):
+        it = it if isinstance(it, dict) else {}
+        pid = str(it.get("productId") or "").strip()
+        try:
+            qty = int(it.get("quantity") or it.get("qty") or 1)
+        except (TypeError, ValueError):
+            qty = 0
+        if not pid or pid not in products:
+            errors.append(f"unknown productId {pid or '(blank)'}")
+        elif qty < 1:
+            errors.append(f"quantity for {pid} must be a positive integer")
+        else:
+            items.append({"productId": pid, "quantity": qty})
+    out["items"] = items
+
+    for k in ("site", "siteLat", "siteLng", "siteRadiusM"):
+        if out.get(k) in ("", None):
+            out.pop(k, None)
+    if any(k in out for k in ("site", "siteLat", "siteLng")) and not _site_from(out):
+        errors.append("site needs a valid siteLat and siteLng (or GeoJSON site)")
+    if "siteRadiusM" in out:
+        try:
+            out["siteRadiusM"] = _site_radius(out["siteRadiusM"])
+        except ValueError as e:
+            errors.append(str(e))
+    return out, errors
+
+@app.route(route="tasks/import", methods=["POST"])
+def tasks_import(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only bulk task creation.
+    Body: JSON array of task payloads (as for POST tasks), { tasks: [...], tenantId, dryRun },
+          or CSV (Content-Type text/csv or ?format=csv; see TASK_IMPORT_CSV_COLUMNS).
+    Every row is validated (assignee in the user directory, SLA dates, items against the catalog);
+    valid rows are written with bounded parallelism unless dryRun=true. Returns per-row results.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        tenant  = req.params.get("tenantId", "default")
+        dry_run = req.params.get("dryRun", "false").lower() == "true"
+        is_csv  = (req.params.get("format") or "").lower() == "csv" or \
+                  "text/csv" in (req.headers.get("Content-Type") or "").lower()
+        if is_csv:
+            rows = _import_rows_from_csv((req.get_body() or b"").decode("utf-8-sig"))
+        else:
+            data = req.get_json()
+            if isinstance(data, dict):
+                tenant  = data.get("tenantId", tenant)
+                dry_run = bool(data.get("dryRun", dry_run))
+                data = data.get("tasks")
+            if not isinstance(data, list):
+                return func.HttpResponse(json.dumps({"error":"expected a JSON array of tasks or { tasks: [...] }"}),
+                                         mimetype="application/json", status_code=400)
+            rows = data
+
+        max_rows = int(os.environ.get("TASK_IMPORT_MAX_ROWS", "5000"))
+        if len(rows) > max_rows:
+            return func.HttpResponse(json.dumps({"error": f"too many rows (max {max_rows})"}),
+                                     mimetype="application/json", status_code=400)
+
+        uq = "SELECT c.email, c.active FROM c WHERE c.tenantId=@t AND c.docType='User'"
+        users = {(u.get("email") or "").lower() for u in _users_container().query_items(
+            uq, parameters=[{"name":"@t","value":"default"}], enable_cross_partition_query=True)
+            if u.get("active", True) is not False}
+        pq = "SELECT c.id FROM c WHERE c.tenantId=@t AND c.docType='Product' AND NOT IS_DEFINED(c.deletedAt)"
+        products = {p["id"] for p in _catalog_container().query_items(
+            pq, parameters=[{"name":"@t","value":tenant}], enable_cross_partition_query=True)}
+
+        results, to_create = [], []
+        for i, row in enumerate(rows):
+            # an empty directory means nobody has signed in yet; don't reject every row for it
+            payload, errors = _validate_import_row(row, users or None, products)
+            if errors:
+                results.append({"row": i, "ok": False, "errors": errors})
+                continue
+            doc = _new_task_doc(payload, tenant)
+            results.append({"row": i, "ok": True, "taskId": doc["id"], "created": False})
+            to_create.append((i, doc))
+
+        if not dry_run and to_create:
+            c = _tasks_container()
+            def _create(pair):
+                i, doc = pair
+                try:
+                    c.create_item(doc)
+                    return i, None
+                except Exception as e:
+                    return i, ("task id already exists" if getattr(e, "status_code", None) == 409 else str(e))
+            usage = {}
+            docs = dict(to_create)
+            for i, failure in _run_bounded(_create, to_create, int(os.environ.get("TASK_IMPORT_CONCURRENCY", "8"))):
+                if failure:
+                    results[i].update({"ok": False, "errors": [failure]})
+                else:
+                    results[i]["created"] = True
+                    _usage_delta(after=docs[i]["items"], delta=usage)
+            _apply_product_usage(tenant, usage)
+
+        out = {
+            "tenantId": tenant,
+            "dryRun": dry_run,
+            "total": len(rows),
+            "valid": len(to_create),
+            "created": sum(1 for r in results if r.get("created")),
+            "failed": sum(1 for r in results if not r["ok"]),
+            "results": results
+        }
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+@app.route(route="tasks", methods=["GET"], reads="eventual")
 def list_tasks(req: func.HttpRequest) -> func.HttpResponse:
     # Any authenticated user can read. (We return all tasks so nothing "disappears" if assignee is not yet the email;
     # actions are still protected per-task below.)
@@ -225,11 +1195,41 @@ def list_tasks(req: func.HttpRequest) -> func.HttpResponse:
     try:
         tenant = req.params.get("tenantId", "default")
         c = _tasks_container()
-        q = "SELECT * FROM c WHERE c.tenantId = @t AND c.docType = 'Task' ORDER BY c.createdAt DESC"
+        q = "SELECT * FROM c WHERE c.tenantId = @t AND c.docType = 'Task' AND NOT IS_DEFINED(c.deletedAt) ORDER BY c.createdAt DESC"
         items = list(c.query_items(q, parameters=[{"name":"@t","value": tenant}], enable_cross_partition_query=True))
         return func.HttpResponse(json.dumps(items), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+@app.route(route="tasks/nearby", methods=["GET"], reads="eventual")
+def tasks_nearby(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Open tasks whose site is within radiusM (default 5000, max 50000) of lat/lng, nearest first.
+    Uses ST_DISTANCE against the spatial index on /site.
+    """
+    pr, err = _ensure_auth(req)
+    if err: return err
+    try:
+        tenant = req.params.get("tenantId", "default")
+        point = _geo_point(req.params.get("lat"), req.params.get("lng"))
+        if not point:
+            return func.HttpResponse(json.dumps({"error":"valid lat and lng required"}), mimetype="application/json", status_code=400)
+        radius = min(max(float(req.params.get("radiusM", "5000")), 1.0), 50000.0)
+        limit = min(max(int(req.params.get("limit", "50")), 1), 200)
+        c = _tasks_container()
+        q = ("SELECT * FROM c WHERE c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND c.status != 'COMPLETED' "
+             "AND IS_DEFINED(c.site) AND ST_DISTANCE(c.site, @pt) <= @r")
+        items = list(c.query_items(q, parameters=[
+            {"name":"@t","value":tenant},
+            {"name":"@pt","value":point},
+            {"name":"@r","value":radius}
+        ], enable_cross_partition_query=True))
+        for t in items:
+            t["distanceM"] = round(_distance_m(t["site"], point), 1)
+        items.sort(key=lambda t: t["distanceM"])
+        return func.HttpResponse(json.dumps(items[:limit]), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
 
 @app.route(route="tasks/limits", methods=["PUT"])
 def update_task_limits(req: func.HttpRequest) -> func.HttpResponse:
@@ -244,100 +1244,169 @@ def update_task_limits(req: func.HttpRequest) -> func.HttpResponse:
         if not task_id or not isinstance(limits, dict):
             return func.HttpResponse(json.dumps({"error":"taskId and expenseLimits required"}),
                                      mimetype="application/json", status_code=400)
-        c = _tasks_container()
-        item = c.read_item(item=task_id, partition_key=tenant)
+        item = _get_task(tenant, task_id)
+        if not item:
+            return func.HttpResponse(json.dumps({"error":"task not found"}), mimetype="application/json", status_code=404)
+        old_limits = item.get("expenseLimits")
         item["expenseLimits"] = limits
         _save_task(item)
-        return func.HttpResponse(json.dumps(item), mimetype="application/json", status_code=200)
+        reevaluating = _queue_limit_reevaluation(item, old_limits)
+        return func.HttpResponse(json.dumps(item), mimetype="application/json", status_code=200,
+                                 headers={"X-Reevaluating": ",".join(reevaluating)} if reevaluating else None)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 # ---- Check-in / Check-out / Timeline
-@app.route(route="tasks/checkin", methods=["POST"])
+def _respond(status: int, payload) -> func.HttpResponse:
+    return func.HttpResponse(json.dumps(payload), mimetype="application/json", status_code=status)
+
+def _event_time(data, replay: bool, *not_before):
+    """
+    (at, error): when the action happened. Only sync/batch replays may supply clientTs; it is clamped to
+    now and must not precede not_before (task createdAt, the CHECK_IN ts). Live calls always use server time.
+    """
+    now = datetime.now(timezone.utc)
+    if not replay or not data.get("clientTs"):
+        return now, None
+    at = _parse_iso(data.get("clientTs"))
+    if not at:
+        return None, "clientTs must be an ISO timestamp"
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    at = min(at.astimezone(timezone.utc), now)
+    for bound in not_before:
+        b = _parse_iso(bound)
+        if b and b.tzinfo is None:
+            b = b.replace(tzinfo=timezone.utc)
+        if b and at < b:
+            return None, f"clientTs is before {bound}"
+    return at, None
+
+def _stamp(ev, at):
+    """Event time is the client's for replays; receivedAt and clientLagS record when it actually reached us."""
+    now = datetime.now(timezone.utc)
+    ev["ts"] = at.isoformat()
+    if (now - at).total_seconds() >= 1:
+        ev["receivedAt"] = now.isoformat()
+        ev["clientLagS"] = int((now - at).total_seconds())
+
+def _checkin(pr, tenant: str, task, data, replay: bool = False):
+    """Core of tasks/checkin; returns (status, payload). Shared with sync/batch (replay=True honours clientTs)."""
+    task_id = data.get("taskId")
+    lat = data.get("lat"); lng = data.get("lng")
+    actor = pr.get("userDetails") or pr.get("userId")
+    if not task:
+        return 404, {"error":"task not found"}
+    if not _can_access_task(pr, task):
+        return 403, {"error":"Forbidden: not assignee"}
+
+    evc = _events_container()
+    q = ("SELECT TOP 1 * FROM c WHERE c.docType='TaskEvent' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
+         "AND c.taskId=@task AND c.eventType='CHECK_IN' ORDER BY c.ts ASC")
+    existing = list(evc.query_items(q, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}], enable_cross_partition_query=True))
+    if existing:
+        return 200, {"event": existing[0], "idempotent": True}
+
+    point = _geo_point(lat, lng)
+    distance, within = _geofence(task, point)
+    if task.get("site") and os.environ.get("GEOFENCE_MODE", "flag").lower() == "enforce":
+        if not point:
+            return 400, {"error":"location required to check in"}
+        if not within:
+            return 400, {"error":"outside task geofence", "distanceM": distance}
+
+    at, bad = _event_time(data, replay, task.get("createdAt"))
+    if bad:
+        return 400, {"error": bad}
+
+    ev = {"id": str(uuid.uuid4()), "docType":"TaskEvent", "tenantId": tenant, "taskId": task_id,
+          "eventType":"CHECK_IN", "lat": lat, "lng": lng, "actor": actor}
+    _stamp(ev, at)
+    if point:
+        ev["location"] = point
+    if distance is not None:
+        ev["distanceM"] = distance; ev["withinGeofence"] = within
+    evc.create_item(ev)
+    task["status"] = "IN_PROGRESS"; task["checkInAt"] = ev["ts"]
+    _save_task(task)
+    return 201, {"event": ev, "idempotent": False}
+
+def _checkout(pr, tenant: str, task, data, replay: bool = False):
+    """
+    Core of tasks/checkout; returns (status, payload). A replayed clientTs only dates the event;
+    lateness is judged when the checkout reaches the server, not by the client's clock.
+    """
+    task_id = data.get("taskId")
+    reason = data.get("reason")
+    lat = data.get("lat"); lng = data.get("lng")
+    actor = pr.get("userDetails") or pr.get("userId")
+    if not task:
+        return 404, {"error":"task not found"}
+    if not _can_access_task(pr, task):
+        return 403, {"error":"Forbidden: not assignee"}
+
+    evc = _events_container()
+    q_out = ("SELECT TOP 1 * FROM c WHERE c.docType='TaskEvent' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
+             "AND c.taskId=@task AND c.eventType='CHECK_OUT' ORDER BY c.ts ASC")
+    existing_out = list(evc.query_items(q_out, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}], enable_cross_partition_query=True))
+    if existing_out:
+        return 200, {"event": existing_out[0], "idempotent": True, "task": task}
+
+    q_in = ("SELECT TOP 1 * FROM c WHERE c.docType='TaskEvent' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
+            "AND c.taskId=@task AND c.eventType='CHECK_IN' ORDER BY c.ts ASC")
+    existing_in = list(evc.query_items(q_in, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}], enable_cross_partition_query=True))
+    if not existing_in:
+        return 400, {"error":"must check in before checking out"}
+
+    at, bad = _event_time(data, replay, task.get("createdAt"), existing_in[0].get("ts"))
+    if bad:
+        return 400, {"error": bad}
+    sla_end = _parse_iso(task.get("slaEnd"))
+    late = bool(sla_end and datetime.now(timezone.utc) > sla_end)
+    if late and not reason:
+        return 400, {"error":"reason required because task is beyond SLA"}
+
+    ev = {"id": str(uuid.uuid4()), "docType":"TaskEvent", "tenantId": tenant, "taskId": task_id,
+          "eventType":"CHECK_OUT", "lat": lat, "lng": lng, "late": late, "reason": reason, "actor": actor}
+    _stamp(ev, at)
+    point = _geo_point(lat, lng)
+    if point:
+        ev["location"] = point
+        distance, within = _geofence(task, point)
+        if distance is not None:
+            ev["distanceM"] = distance; ev["withinGeofence"] = within
+    evc.create_item(ev)
+
+    task["status"] = "COMPLETED"; task["checkOutAt"] = ev["ts"]; task["slaBreached"] = late
+    if reason: task["lateReason"] = reason
+    _save_task(task)
+    return 201, {"event": ev, "idempotent": False, "task": task}
+
+@app.route(route="tasks/checkin", methods=["POST"], idempotent=True)
 def tasks_checkin(req: func.HttpRequest) -> func.HttpResponse:
     pr, err = _ensure_auth(req)
     if err: return err
     try:
         data = req.get_json()
         tenant = data.get("tenantId","default")
-        task_id = data.get("taskId")
-        lat = data.get("lat"); lng = data.get("lng")
-        actor = pr.get("userDetails") or pr.get("userId")
-        if not task_id:
+        if not data.get("taskId"):
             return func.HttpResponse(json.dumps({"error":"taskId required"}), mimetype="application/json", status_code=400)
-        task = _get_task(tenant, task_id)
-        if not task:
-            return func.HttpResponse(json.dumps({"error":"task not found"}), mimetype="application/json", status_code=404)
-        if not _can_access_task(pr, task):
-            return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
-
-        evc = _events_container()
-        q = ("SELECT TOP 1 * FROM c WHERE c.docType='TaskEvent' AND c.tenantId=@t "
-             "AND c.taskId=@task AND c.eventType='CHECK_IN' ORDER BY c.ts ASC")
-        existing = list(evc.query_items(q, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}], enable_cross_partition_query=True))
-        if existing:
-            return func.HttpResponse(json.dumps({"event": existing[0], "idempotent": True}), mimetype="application/json", status_code=200)
-
-        ev = {"id": str(uuid.uuid4()), "docType":"TaskEvent", "tenantId": tenant, "taskId": task_id,
-              "eventType":"CHECK_IN", "ts": _now_iso(), "lat": lat, "lng": lng, "actor": actor}
-        evc.create_item(ev)
-        task["status"] = "IN_PROGRESS"; task["checkInAt"] = ev["ts"]
-        _save_task(task)
-        return func.HttpResponse(json.dumps({"event": ev, "idempotent": False}), mimetype="application/json", status_code=201)
+        return _respond(*_checkin(pr, tenant, _get_task(tenant, data["taskId"]), data))
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
-@app.route(route="tasks/checkout", methods=["POST"])
+@app.route(route="tasks/checkout", methods=["POST"], idempotent=True)
 def tasks_checkout(req: func.HttpRequest) -> func.HttpResponse:
     pr, err = _ensure_auth(req)
     if err: return err
     try:
         data = req.get_json()
         tenant = data.get("tenantId","default")
-        task_id = data.get("taskId")
-        reason = data.get("reason")
-        lat = data.get("lat"); lng = data.get("lng")
-        actor = pr.get("userDetails") or pr.get("userId")
-        if not task_id:
+        if not data.get("taskId"):
             return func.HttpResponse(json.dumps({"error":"taskId required"}), mimetype="application/json", status_code=400)
-        task = _get_task(tenant, task_id)
-        if not task:
-            return func.HttpResponse(json.dumps({"error":"task not found"}), mimetype="application/json", status_code=404)
-        if not _can_access_task(pr, task):
-            return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
-
-        evc = _events_container()
-        q_out = ("SELECT TOP 1 * FROM c WHERE c.docType='TaskEvent' AND c.tenantId=@t "
-                 "AND c.taskId=@task AND c.eventType='CHECK_OUT' ORDER BY c.ts ASC")
-        existing_out = list(evc.query_items(q_out, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}], enable_cross_partition_query=True))
-        if existing_out:
-            return func.HttpResponse(json.dumps({"event": existing_out[0], "idempotent": True, "task": task}),
-                                     mimetype="application/json", status_code=200)
-
-        q_in = ("SELECT TOP 1 * FROM c WHERE c.docType='TaskEvent' AND c.tenantId=@t "
-                "AND c.taskId=@task AND c.eventType='CHECK_IN' ORDER BY c.ts ASC")
-        existing_in = list(evc.query_items(q_in, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}], enable_cross_partition_query=True))
-        if not existing_in:
-            return func.HttpResponse(json.dumps({"error":"must check in before checking out"}), mimetype="application/json", status_code=400)
-
-        now = datetime.now(timezone.utc)
-        sla_end = _parse_iso(task.get("slaEnd"))
-        late = bool(sla_end and now > sla_end)
-        if late and not reason:
-            return func.HttpResponse(json.dumps({"error":"reason required because task is beyond SLA"}), mimetype="application/json", status_code=400)
-
-        ev = {"id": str(uuid.uuid4()), "docType":"TaskEvent", "tenantId": tenant, "taskId": task_id,
-              "eventType":"CHECK_OUT", "ts": _now_iso(), "lat": lat, "lng": lng, "late": late, "reason": reason, "actor": actor}
-        evc.create_item(ev)
-
-        task["status"] = "COMPLETED"; task["checkOutAt"] = ev["ts"]; task["slaBreached"] = late
-        if reason: task["lateReason"] = reason
-        _save_task(task)
-
-        return func.HttpResponse(json.dumps({"event": ev, "idempotent": False, "task": task}),
-                                 mimetype="application/json", status_code=201)
+        return _respond(*_checkout(pr, tenant, _get_task(tenant, data["taskId"]), data))
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 @app.route(route="tasks/events", methods=["GET"])
 def tasks_events(req: func.HttpRequest) -> func.HttpResponse:
@@ -355,12 +1424,14 @@ def tasks_events(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
 
         c = _events_container()
-        q = ("SELECT * FROM c WHERE c.docType='TaskEvent' AND c.tenantId=@t "
+        q = ("SELECT * FROM c WHERE c.docType='TaskEvent' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
              "AND c.taskId=@task ORDER BY c.ts ASC")
         items = list(c.query_items(q, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}], enable_cross_partition_query=True))
+        if task.get("archive"):
+            items = sorted(_with_archived(task, "events", items), key=lambda e: e.get("ts") or "")
         return func.HttpResponse(json.dumps(items), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 # ---- Receipts: SAS + readSas + list
 @app.route(route="receipts/sas", methods=["GET"])
@@ -380,7 +1451,45 @@ def receipts_sas(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(json.dumps({"blobUrl": blob_url, "uploadUrl": upload_url}),
                                  mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+@app.route(route="receipts/sas/batch", methods=["POST"])
+def receipts_sas_batch(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Upload URLs for many receipts of one task with a single authorization.
+    Body: { tenantId, taskId, filenames: [...], minutes?: 10 }
+    Returns { files: [ { filename, blobUrl, uploadUrl } ], expiresAt }.
+    """
+    pr, err = _ensure_auth(req)
+    if err: return err
+    try:
+        data = req.get_json()
+        task_id   = data.get("taskId")
+        tenant    = data.get("tenantId", "default")
+        filenames = data.get("filenames")
+        minutes   = min(max(int(data.get("minutes") or 10), 1), 60)
+        if not task_id or not isinstance(filenames, list) or not filenames:
+            return func.HttpResponse(json.dumps({"error":"taskId and filenames are required"}),
+                                     mimetype="application/json", status_code=400)
+        max_files = int(os.environ.get("SAS_BATCH_MAX_FILES", "100"))
+        if len(filenames) > max_files:
+            return func.HttpResponse(json.dumps({"error": f"too many files (max {max_files})"}),
+                                     mimetype="application/json", status_code=400)
+        task = _get_task(tenant, task_id)
+        if not _can_access_task(pr, task):
+            return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
+
+        files = []
+        for filename in dict.fromkeys(str(x).strip() for x in filenames):
+            if not filename:
+                continue
+            blob_url, upload_url = _make_blob_urls(task_id, filename, for_write=True, minutes=minutes)
+            files.append({"filename": filename, "blobUrl": blob_url, "uploadUrl": upload_url})
+        expires = (datetime.now(timezone.utc) + timedelta(minutes=minutes)).isoformat()
+        return func.HttpResponse(json.dumps({"taskId": task_id, "files": files, "expiresAt": expires}),
+                                 mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
 
 @app.route(route="receipts/readSas", methods=["GET"])
 def receipts_read_sas(req: func.HttpRequest) -> func.HttpResponse:
@@ -390,26 +1499,41 @@ def receipts_read_sas(req: func.HttpRequest) -> func.HttpResponse:
         task_id  = req.params.get("taskId")
         filename = req.params.get("filename")
         minutes  = int(req.params.get("minutes", "5"))
+        variant  = (req.params.get("variant") or "original").lower()
         if not task_id or not filename:
             return func.HttpResponse(json.dumps({"error":"taskId and filename are required"}),
                                      mimetype="application/json", status_code=400)
+        if variant != "original" and variant not in RECEIPT_VARIANTS:
+            return func.HttpResponse(json.dumps({"error":"variant must be original, ocr or thumb"}),
+                                     mimetype="application/json", status_code=400)
         task = _get_task("default", task_id)
         if not _can_access_task(pr, task):
             return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
-        blob_url, read_url = _make_blob_urls(task_id, filename, for_read=True, minutes=minutes)
-        return func.HttpResponse(json.dumps({"blobUrl": blob_url, "readUrl": read_url}),
+        if variant != "original":
+            try:
+                if variant not in _ensure_receipt_variants(task_id, filename):
+                    variant = "original"
+            except Exception:
+                variant = "original"
+        blob_url, read_url = _make_blob_urls(task_id, filename, for_read=True, minutes=minutes, variant=variant)
+        return func.HttpResponse(json.dumps({"blobUrl": blob_url, "readUrl": read_url, "variant": variant}),
                                  mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 @app.route(route="receipts/list", methods=["GET"])
 def receipts_list(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    List a task's receipt blobs.
+    Optional query params:
+      - details=true: also return items[] with size, contentType, lastModified, readUrl and thumbUrl
+      - minutes: lifetime of the read URLs (default 10)
+      - pageSize / continuationToken: page through tasks with many files
+    """
     pr, err = _ensure_auth(req)
     if err: return err
     try:
-        account   = os.environ["STG_ACCOUNT"]
-        key       = os.environ["STG_KEY"]
-        container = os.environ.get("STG_CONTAINER", "receipts")
+        container = _storage_settings()[2]
         task_id   = req.params.get("taskId")
         if not task_id:
             return func.HttpResponse(json.dumps({"error":"taskId required"}),
@@ -417,15 +1541,171 @@ def receipts_list(req: func.HttpRequest) -> func.HttpResponse:
         task = _get_task("default", task_id)
         if not _can_access_task(pr, task):
             return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
+        details   = (req.params.get("details", "false").lower() == "true")
+        minutes   = min(max(int(req.params.get("minutes", "10")), 1), 60)
+        page_size = req.params.get("pageSize")
+        token     = req.params.get("continuationToken") or None
+
         svc = _blob_service()
         cont = svc.get_container_client(container)
-        items = [b.name for b in cont.list_blobs(name_starts_with=f"{task_id}/")]
-        return func.HttpResponse(json.dumps({"files": items}), mimetype="application/json", status_code=200)
+        prefix = f"{task_id}/"
+        out = {}
+        if page_size:
+            pager = cont.list_blobs(name_starts_with=prefix, results_per_page=min(max(int(page_size), 1), 5000)).by_page(continuation_token=token)
+            blobs = list(next(pager, []))
+            out["continuationToken"] = pager.continuation_token
+        else:
+            blobs = list(cont.list_blobs(name_starts_with=prefix))
+        out["files"] = [b.name for b in blobs]
+
+        if details:
+            thumb_prefix = _sanitize_blob_name(f"_thumb/{task_id}") + "/"
+            thumbs = {b.name for b in cont.list_blobs(name_starts_with=thumb_prefix)}
+            items = []
+            for b in blobs:
+                filename = b.name[len(prefix):]
+                blob_url, read_url = _make_blob_urls(task_id, filename, for_read=True, minutes=minutes)
+                thumb_url = None
+                if _receipt_blob_name(task_id, filename, "thumb") in thumbs:
+                    _, thumb_url = _make_blob_urls(task_id, filename, for_read=True, minutes=minutes, variant="thumb")
+                cs = getattr(b, "content_settings", None)
+                items.append({
+                    "name": b.name,
+                    "filename": filename,
+                    "size": b.size,
+                    "contentType": getattr(cs, "content_type", None),
+                    "lastModified": b.last_modified.isoformat() if b.last_modified else None,
+                    "blobUrl": blob_url,
+                    "readUrl": read_url,
+                    "thumbUrl": thumb_url
+                })
+            out["items"] = items
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 # ---- OCR + Expenses (upsert)
-@app.route(route="receipts/ocr", methods=["POST"])
+OCR_MODEL_ID = "prebuilt-receipt"
+
+def _di_api_version():
+    return os.environ.get("DI_API_VERSION", "2023-07-31")
+
+def _analyze_receipt(read_url: str):
+    """
+    Run Document Intelligence prebuilt-receipt against a readable blob URL.
+    Returns (ocr, error): ocr is {merchant,total,date,currency}; error is a dict when the submit fails.
+    """
+    import requests
+    endpoint = os.environ["DI_ENDPOINT"].rstrip("/")
+    key      = os.environ["DI_KEY"]
+    api_ver  = _di_api_version()
+
+    analyze_url = f"{endpoint}/formrecognizer/documentModels/{OCR_MODEL_ID}:analyze?api-version={api_ver}"
+    headers = {"Ocp-Apim-Subscription-Key": key, "Content-Type": "application/json"}
+    payload = {"urlSource": read_url}
+
+    with _dep_timer("ocr", "submit"):
+        r = requests.post(analyze_url, headers=headers, json=payload, timeout=30)
+    if r.status_code not in (200, 202):
+        return None, {"error":"analyze submit failed", "status": r.status_code, "body": r.text}
+
+    op_url = r.headers.get("operation-location") or r.headers.get("Operation-Location")
+    if not op_url:
+        result = r.json()
+    else:
+        for _ in range(20):
+            with _dep_timer("ocr", "wait"):
+                time.sleep(1)
+            with _dep_timer("ocr", "poll"):
+                prq = requests.get(op_url, headers={"Ocp-Apim-Subscription-Key": key}, timeout=20)
+            result = prq.json()
+            if result.get("status") in ("succeeded", "failed", "cancelled"):
+                break
+
+    doc = {}
+    try:
+        docs = result.get("analyzeResult", {}).get("documents", [])
+        f = (docs[0].get("fields", {}) if docs else {})
+        def _val(x):
+            if not isinstance(x, dict): return x
+            for k in ("valueNumber","valueString","valueDate","content"):
+                if k in x: return x[k]
+            vc = x.get("valueCurrency")
+            if isinstance(vc, dict) and "amount" in vc: return vc["amount"]
+            return x.get("content")
+        merchant = _val(f.get("MerchantName", {}))
+        total    = _val(f.get("Total", {}))
+        date     = _val(f.get("TransactionDate", {}))
+        currency = None
+        vc = f.get("Total", {}).get("valueCurrency") if isinstance(f.get("Total", {}), dict) else None
+        if isinstance(vc, dict):
+            currency = vc.get("currencyCode") or vc.get("currencySymbol")
+        doc = {"merchant": merchant, "total": total, "date": date, "currency": currency}
+    except Exception:
+        doc = {}
+    return doc, None
+
+def _expense_fingerprint(merchant, amount, date, currency):
+    """
+    Normalized receipt identity for duplicate detection: merchant (letters/digits only), amount to the
+    cent, calendar date and currency. None when amount or date is missing -- too weak to match on.
+    """
+    import hashlib, unicodedata
+    try:
+        cents = int(round(float(amount) * 100))
+    except (TypeError, ValueError):
+        return None
+    day = _parse_iso(str(date)) if date else None
+    if not day:
+        return None
+    name = unicodedata.normalize("NFKD", merchant or "").encode("ascii", "ignore").decode("ascii")
+    key = "|".join([re.sub(r"[^a-z0-9]+", "", name.lower()), str(cents),
+                    day.strftime("%Y-%m-%d"), (currency or "").strip().upper()])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def _find_duplicates(container, tenant: str, expense: dict):
+    """Other live expenses in the tenant with the same fingerprint (one indexed equality query)."""
+    q = ("SELECT c.id, c.taskId, c.createdAt FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
+         "AND c.fingerprint=@fp AND c.id != @id AND (NOT IS_DEFINED(c.approval.status) OR c.approval.status != 'REJECTED')")
+    return list(container.query_items(q, parameters=[
+        {"name":"@t","value":tenant},
+        {"name":"@fp","value":expense["fingerprint"]},
+        {"name":"@id","value":expense["id"]}
+    ], partition_key=_tenant_pk(container, tenant)))
+
+def _expense_from_ocr(existing, tenant: str, task_id: str, blob_url: str, doc: dict):
+    """Merge OCR fields into an existing Expense or build a new one. Returns (expense, idempotent)."""
+    api_ver = _di_api_version()
+    if existing:
+        exp = existing
+        exp["merchant"] = doc.get("merchant", exp.get("merchant"))
+        exp["total"]    = doc.get("total",    exp.get("total"))
+        exp["currency"] = doc.get("currency", exp.get("currency"))
+        exp["txnDate"]  = doc.get("date",     exp.get("txnDate"))
+        exp["ocrModel"] = OCR_MODEL_ID
+        exp["ocrApiVersion"] = api_ver
+        exp["fingerprint"] = _expense_fingerprint(exp.get("merchant"), exp.get("total"), exp.get("txnDate"), exp.get("currency"))
+        return exp, True
+    return {
+        "id": str(uuid.uuid4()),
+        "docType": "Expense",
+        "tenantId": tenant,
+        "taskId": task_id,
+        "blobPath": blob_url,
+        "merchant": doc.get("merchant"),
+        "total": doc.get("total"),
+        "currency": doc.get("currency"),
+        "txnDate": doc.get("date"),
+        "fingerprint": _expense_fingerprint(doc.get("merchant"), doc.get("total"), doc.get("date"), doc.get("currency")),
+        "category": None,
+        "ocrModel": OCR_MODEL_ID,
+        "ocrApiVersion": api_ver,
+        "createdAt": _now_iso(),
+        "isManualOverride": False,
+        "approval": None
+    }, False
+
+@app.route(route="receipts/ocr", methods=["POST"], idempotent=True)
 def receipts_ocr(req: func.HttpRequest) -> func.HttpResponse:
     pr, err = _ensure_auth(req)
     if err: return err
@@ -442,61 +1722,17 @@ def receipts_ocr(req: func.HttpRequest) -> func.HttpResponse:
         if not _can_access_task(pr, task):
             return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
 
-        blob_url, read_url = _make_blob_urls(task_id, filename, for_read=True, minutes=10)
+        blob_url, read_url = _ocr_read_url(task_id, filename)
 
-        import requests
-        endpoint = os.environ["DI_ENDPOINT"].rstrip("/")
-        key      = os.environ["DI_KEY"]
-        api_ver  = os.environ.get("DI_API_VERSION", "2023-07-31")
-        model_id = "prebuilt-receipt"
-
-        analyze_url = f"{endpoint}/formrecognizer/documentModels/{model_id}:analyze?api-version={api_ver}"
-        headers = {"Ocp-Apim-Subscription-Key": key, "Content-Type": "application/json"}
-        payload = {"urlSource": read_url}
-
-        r = requests.post(analyze_url, headers=headers, json=payload, timeout=30)
-        if r.status_code not in (200, 202):
-            return func.HttpResponse(json.dumps({"error":"analyze submit failed", "status": r.status_code, "body": r.text}),
-                                     mimetype="application/json", status_code=502)
-
-        op_url = r.headers.get("operation-location") or r.headers.get("Operation-Location")
-        if not op_url:
-            result = r.json()
-        else:
-            for _ in range(20):
-                time.sleep(1)
-                prq = requests.get(op_url, headers={"Ocp-Apim-Subscription-Key": key}, timeout=20)
-                result = prq.json()
-                if result.get("status") in ("succeeded", "failed", "cancelled"):
-                    break
-
-        doc = {}
-        try:
-            docs = result.get("analyzeResult", {}).get("documents", [])
-            f = (docs[0].get("fields", {}) if docs else {})
-            def _val(x):
-                if not isinstance(x, dict): return x
-                for k in ("valueNumber","valueString","valueDate","content"):
-                    if k in x: return x[k]
-                vc = x.get("valueCurrency")
-                if isinstance(vc, dict) and "amount" in vc: return vc["amount"]
-                return x.get("content")
-            merchant = _val(f.get("MerchantName", {}))
-            total    = _val(f.get("Total", {}))
-            date     = _val(f.get("TransactionDate", {}))
-            currency = None
-            vc = f.get("Total", {}).get("valueCurrency") if isinstance(f.get("Total", {}), dict) else None
-            if isinstance(vc, dict):
-                currency = vc.get("currencyCode") or vc.get("currencySymbol")
-            doc = {"merchant": merchant, "total": total, "date": date, "currency": currency}
-        except Exception:
-            doc = {}
+        doc, failed = _analyze_receipt(read_url)
+        if failed:
+            return func.HttpResponse(json.dumps(failed), mimetype="application/json", status_code=502)
 
         out = {"taskId": task_id, "tenantId": tenant, "blobPath": blob_url, "ocr": doc}
 
         if save:
             c = _expenses_container()
-            q = ("SELECT TOP 1 * FROM c WHERE c.docType='Expense' AND c.tenantId=@t "
+            q = ("SELECT TOP 1 * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
                  "AND c.taskId=@task AND c.blobPath=@blob")
             items = list(c.query_items(q, parameters=[
                 {"name":"@t","value":tenant},
@@ -504,163 +1740,466 @@ def receipts_ocr(req: func.HttpRequest) -> func.HttpResponse:
                 {"name":"@blob","value":blob_url}
             ], enable_cross_partition_query=True))
 
-            if items:
-                exp = items[0]
-                exp["merchant"] = doc.get("merchant", exp.get("merchant"))
-                exp["total"]    = doc.get("total",    exp.get("total"))
-                exp["currency"] = doc.get("currency", exp.get("currency"))
-                exp["txnDate"]  = doc.get("date",     exp.get("txnDate"))
-                exp["ocrModel"] = "prebuilt-receipt"
-                exp["ocrApiVersion"] = api_ver
-                c.replace_item(item=exp, body=exp)
-                out["saved"] = exp
-                out["idempotent"] = True
+            exp, idempotent = _expense_from_ocr(items[0] if items else None, tenant, task_id, blob_url, doc)
+            if idempotent:
+                _replace_doc(c, exp)
             else:
-                exp = {
-                    "id": str(uuid.uuid4()),
-                    "docType": "Expense",
-                    "tenantId": tenant,
-                    "taskId": task_id,
-                    "blobPath": blob_url,
-                    "merchant": doc.get("merchant"),
-                    "total": doc.get("total"),
-                    "currency": doc.get("currency"),
-                    "txnDate": doc.get("date"),
-                    "category": None,
-                    "ocrModel": "prebuilt-receipt",
-                    "ocrApiVersion": api_ver,
-                    "createdAt": _now_iso(),
-                    "isManualOverride": False,
-                    "approval": None
-                }
                 c.create_item(exp)
-                out["saved"] = exp
-                out["idempotent"] = False
+            out["saved"] = exp
+            out["idempotent"] = idempotent
 
         return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
 
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}),
-                                 mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+def _run_bounded(fn, items, max_workers: int):
+    """Map fn over items with at most max_workers threads; results keep input order."""
+    from concurrent.futures import ThreadPoolExecutor
+    items = list(items)
+    if not items:
+        return []
+    workers = max(1, min(int(max_workers or 1), len(items)))
+    # each item runs in a copy of the caller's context (retry budget and other request-scoped state)
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda pair: pair[0].run(fn, pair[1]), zip(contexts, items)))
+
+def _bulk_upsert(container, docs):
+    """
+    Upsert many docs. Docs sharing a partition key go through transactional batches (max 100 ops)
+    when the SDK supports them; otherwise fall back to one upsert per doc.
+    """
+    if not docs:
+        return
+    if hasattr(container, "execute_item_batch"):
+        by_pk = {}
+        for d in docs:
+            pk = _pk_value(container, d)
+            by_pk.setdefault(json.dumps(pk), (pk, []))[1].append(d)
+        for pk, group in by_pk.values():
+            for i in range(0, len(group), 100):
+                ops = [("upsert", (d,)) for d in group[i:i+100]]
+                container.execute_item_batch(batch_operations=ops, partition_key=pk)
+        return
+    for d in docs:
+        container.upsert_item(d)
+
+_BACKGROUND = None
+_REPORT_POOL = None
+
+def _run_scoped(fn, *args):
+    """
+    Run fn in a fresh context with its own Cosmos retry budget (COSMOS_BACKGROUND_RETRY_BUDGET_MS,
+    default 10000). For work no route scopes -- background jobs and timers -- so retry waits spent by
+    one job never carry over to the next one on the same pool thread.
+    """
+    def scoped():
+        _RETRY_BUDGET_MS.set(int(os.environ.get("COSMOS_BACKGROUND_RETRY_BUDGET_MS", "10000")))
+        return fn(*args)
+    return contextvars.Context().run(scoped)
+
+def _submit_background(fn, *args):
+    """Run fn on a small per-worker pool after the response has been returned."""
+    global _BACKGROUND
+    if _BACKGROUND is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _BACKGROUND = ThreadPoolExecutor(max_workers=int(os.environ.get("BACKGROUND_WORKERS", "2")))
+    return _BACKGROUND.submit(_run_scoped, fn, *args)
+
+def _submit_report_job(job):
+    """Report builds can run for minutes, so they get their own pool (REPORT_WORKERS, default 2) and never
+    hold up cascade deletes, limit re-evaluation or profile writes queued on _submit_background."""
+    global _REPORT_POOL
+    if _REPORT_POOL is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _REPORT_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get("REPORT_WORKERS", "2")))
+    return _REPORT_POOL.submit(_run_scoped, _run_report_job, job)
+
+# ---- Re-evaluation of pending expenses after a limit change
+_REEVAL_LOCK = threading.Lock()
+
+def _limit_for(limits, category) -> float:
+    limits = limits or DEFAULT_LIMITS
+    return float(limits.get(category, limits.get("Other", 1000)) or 0)
+
+def _archived_spend(task, category) -> float:
+    """
+    Approved spend of one category that lives in the task's archive (see _archive_task). Budget checks add
+    it and skip the hot copies still awaiting their ttl, so spend isn't lost (or counted twice) once archived.
+    """
+    rows = ((task or {}).get("archive") or {}).get("totals") or []
+    return sum(_money(r.get("amount")) for r in rows
+               if r.get("category") == category and r.get("status") in ("APPROVED", "AUTO_APPROVED"))
+
+def _expense_amount(e) -> float:
+    try:
+        return float(e.get("editedTotal", e.get("total")) or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _raised_categories(old_limits, new_limits, categories) -> list:
+    """Categories whose effective limit went up (an "Other" change reaches every unlisted category)."""
+    return sorted(cat for cat in categories if _limit_for(new_limits, cat) > _limit_for(old_limits, cat))
+
+def _queue_limit_reevaluation(task, old_limits):
+    """Queue a background re-evaluation when a limit change can unblock anything; returns the categories."""
+    new_limits = task.get("expenseLimits")
+    raised = _raised_categories(old_limits, new_limits,
+                                set((old_limits or DEFAULT_LIMITS).keys()) | set((new_limits or DEFAULT_LIMITS).keys()))
+    if raised:
+        _submit_background(_reevaluate_pending, task["tenantId"], task["id"], old_limits)
+    return raised
+
+def _reevaluate_pending(tenant: str, task_id: str, old_limits):
+    """
+    Promote PENDING_REVIEW expenses a raised limit now covers. Per category, committed spend
+    (APPROVED/AUTO_APPROVED) is summed once, then pending expenses are walked in submission order
+    against the running total. As in _finalize_expense, an earlier expense that stays pending keeps its
+    amount reserved, so only later expenses that fit after it are promoted.
+    Never demotes; admin-decided and possible-duplicate expenses are left alone.
+    Each promotion is a patch of /approval guarded by a filter predicate, so an expense decided or
+    deleted since the query is skipped rather than overwritten.
+    """
+    with _REEVAL_LOCK:  # limit edits for the same task apply one after another, in submission order
+        try:
+            task = _get_task(tenant, task_id)
+            if not task:
+                return
+            c = _expenses_container()
+            q = ("SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND NOT IS_DEFINED(c.ttl) "
+                 "AND c.tenantId=@t AND c.taskId=@task ORDER BY c.createdAt ASC")
+            rows = list(c.query_items(q, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}],
+                                      enable_cross_partition_query=True))
+            by_cat = {}
+            for e in rows:
+                by_cat.setdefault(e.get("category"), []).append(e)
+            new_limits = task.get("expenseLimits")
+            still_pending = ("FROM c WHERE c.approval.status='PENDING_REVIEW' AND NOT IS_DEFINED(c.approval.decidedAt) "
+                             "AND NOT IS_DEFINED(c.deletedAt)")
+            promoted = []
+            for cat in _raised_categories(old_limits, new_limits, [k for k in by_cat if k]):
+                limit = _limit_for(new_limits, cat)
+                spent = _archived_spend(task, cat) + sum(_expense_amount(e) for e in by_cat[cat]
+                            if ((e.get("approval") or {}).get("status")) in ("APPROVED", "AUTO_APPROVED"))
+                for e in by_cat[cat]:
+                    appr = e.get("approval") or {}
+                    if appr.get("status") != "PENDING_REVIEW":
+                        continue
+                    amount = _expense_amount(e)
+                    remaining = limit - spent
+                    if appr.get("decidedAt") or e.get("duplicateOf") or amount > max(0.0, remaining):
+                        spent += amount  # stays pending: reserved, as finalize counts it
+                        continue
+                    approval = {
+                        "status": "AUTO_APPROVED",
+                        "evaluatedAt": _now_iso(),
+                        "limit": limit,
+                        "remainingBefore": remaining,
+                        "reason": f"limit raised: within remaining (amount {amount} ≤ remaining {round(remaining,2)})",
+                        "previous": appr
+                    }
+                    spent += amount  # promoted, or decided meanwhile (counted either way, to stay on the safe side)
+                    if _patch_doc(c, e, [{"op": "set", "path": "/approval", "value": approval}], predicate=still_pending) is None:
+                        continue
+                    promoted.append(e["id"])
+            if promoted:
+                _notify_queue(tenant)
+            logging.info("limit re-evaluation %s/%s: promoted %d expense(s)", tenant, task_id, len(promoted))
+        except Exception:
+            logging.exception("limit re-evaluation failed for %s/%s", tenant, task_id)
+
+@app.route(route="receipts/ocr/batch", methods=["POST"], idempotent=True)
+def receipts_ocr_batch(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Run OCR over many receipts of one task in a single call.
+    Body: { tenantId, taskId, filenames?: [...], save?: true }
+    Without filenames, every blob under the task's "<taskId>/" prefix is analyzed.
+    Analyses run concurrently (OCR_BATCH_CONCURRENCY, default 4); Expense docs are upserted together.
+    """
+    pr, err = _ensure_auth(req)
+    if err: return err
+    try:
+        data = req.get_json()
+        task_id   = data.get("taskId")
+        tenant    = data.get("tenantId", "default")
+        save      = bool(data.get("save", True))
+        filenames = data.get("filenames")
+        if not task_id:
+            return func.HttpResponse(json.dumps({"error":"taskId required"}), mimetype="application/json", status_code=400)
+        if filenames is not None and not isinstance(filenames, list):
+            return func.HttpResponse(json.dumps({"error":"filenames must be a list"}), mimetype="application/json", status_code=400)
+        task = _get_task(tenant, task_id)
+        if not _can_access_task(pr, task):
+            return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
+
+        if filenames is None:
+            container = _storage_settings()[2]
+            prefix = f"{task_id}/"
+            cont = _blob_service().get_container_client(container)
+            filenames = [b.name[len(prefix):] for b in cont.list_blobs(name_starts_with=prefix)]
+        filenames = [f for f in dict.fromkeys(str(x).strip() for x in filenames) if f]
+
+        max_files = int(os.environ.get("OCR_BATCH_MAX_FILES", "50"))
+        if len(filenames) > max_files:
+            return func.HttpResponse(json.dumps({"error": f"too many files (max {max_files})"}),
+                                     mimetype="application/json", status_code=400)
+
+        def _one(filename):
+            try:
+                blob_url, read_url = _ocr_read_url(task_id, filename)
+                doc, failed = _analyze_receipt(read_url)
+                if failed:
+                    return {"filename": filename, "blobPath": blob_url, "ok": False, **failed}
+                return {"filename": filename, "blobPath": blob_url, "ok": True, "ocr": doc}
+            except Exception as e:
+                return {"filename": filename, "ok": False, "error": str(e)}
+
+        results = _run_bounded(_one, filenames, int(os.environ.get("OCR_BATCH_CONCURRENCY", "4")))
+
+        if save:
+            c = _expenses_container()
+            q = "SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND c.taskId=@task"
+            existing = {e.get("blobPath"): e for e in c.query_items(q, parameters=[
+                {"name":"@t","value":tenant},
+                {"name":"@task","value":task_id}
+            ], enable_cross_partition_query=True)}
+            to_create, to_replace = [], []
+            for r in results:
+                if not r.get("ok"):
+                    continue
+                exp, idempotent = _expense_from_ocr(existing.get(r["blobPath"]), tenant, task_id, r["blobPath"], r["ocr"])
+                (to_replace if idempotent else to_create).append((r, exp))
+                r["saved"] = exp
+                r["idempotent"] = idempotent
+            _bulk_upsert(c, [exp for _, exp in to_create])
+            def _resave(pair):
+                r, exp = pair
+                try:
+                    _replace_doc(c, exp)
+                except ConcurrentUpdate as e:
+                    r.update({"ok": False, "error": str(e)}); r.pop("saved", None)
+            _run_bounded(_resave, to_replace, int(os.environ.get("OCR_BATCH_CONCURRENCY", "4")))
+
+        out = {
+            "taskId": task_id, "tenantId": tenant,
+            "count": len(results),
+            "succeeded": sum(1 for r in results if r.get("ok")),
+            "results": results
+        }
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+
+    except Exception as e:
+        return _error_response(e)
 
 # ---- Finalize with REMAINING budget logic
-@app.route(route="expenses/finalize", methods=["POST"])
+def _finalize_expense(pr, data, get_task=None):
+    """Core of expenses/finalize; returns (status, payload). sync/batch passes a cached task lookup."""
+    get_task = get_task or _get_task
+    tenant = data.get("tenantId","default")
+    category = data.get("category")
+    if not category:
+        return 400, {"error":"category is required"}
+
+    c = _expenses_container()
+    expense = None
+    if data.get("expenseId"):
+        expense = _read_doc(c, data["expenseId"], tenant, data.get("taskId"))
+    else:
+        q = "SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND c.taskId=@task AND c.blobPath=@blob"
+        items = list(c.query_items(q, parameters=[
+            {"name":"@t","value":tenant},
+            {"name":"@task","value":data.get("taskId")},
+            {"name":"@blob","value":data.get("blobPath")}
+        ], enable_cross_partition_query=True))
+        if items: expense = items[0]
+    if not expense:
+        return 404, {"error":"expense not found"}
+
+    # Only assignee or admin can finalize this expense (based on its task)
+    task = get_task(expense.get("tenantId","default"), expense.get("taskId"))
+    if not _can_access_task(pr, task):
+        return 403, {"error":"Forbidden: not assignee"}
+
+    original_total = expense.get("total")
+    prev_edited    = expense.get("editedTotal", None)
+
+    submitted_total_present = "total" in data
+    if submitted_total_present:
+        try:
+            edited_total = float(data.get("total") if data.get("total") is not None else 0.0)
+        except Exception:
+            return 400, {"error":"total must be a number"}
+        expense["editedTotal"] = edited_total
+    else:
+        edited_total = float(prev_edited if prev_edited is not None else (original_total or 0))
+
+    current_amount = float(edited_total or 0)
+
+    expense["category"] = category
+    if submitted_total_present and original_total is not None:
+        try:
+            expense["isManualOverride"] = float(edited_total) != float(original_total)
+        except Exception:
+            expense["isManualOverride"] = False
+    if data.get("comment"): expense["comment"] = data["comment"]
+    expense["submittedBy"] = pr.get("userDetails") or pr.get("userId")
+
+    limit_for_cat = _limit_for((task or {}).get("expenseLimits"), category)
+
+    q = ("SELECT c.id, c.editedTotal, c.total, c.approval "
+         "FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND NOT IS_DEFINED(c.ttl) "
+         "AND c.tenantId=@t AND c.taskId=@task AND c.category=@cat")
+    others = list(c.query_items(q, parameters=[
+        {"name":"@t","value":tenant},
+        {"name":"@task","value":expense["taskId"]},
+        {"name":"@cat","value":category}
+    ], enable_cross_partition_query=True))
+
+    def _status(x):
+        a = x.get("approval") or {}
+        return a.get("status")
+
+    spent_so_far = _archived_spend(task, category)
+    for e in others:
+        if e["id"] == expense["id"]:
+            continue
+        st = _status(e)
+        if st in ("APPROVED","AUTO_APPROVED","PENDING_REVIEW"):
+            amt = e.get("editedTotal", e.get("total"))
+            try: amt = float(amt or 0)
+            except: amt = 0.0
+            spent_so_far += amt
+
+    remaining = limit_for_cat - spent_so_far
+    if current_amount <= max(0.0, remaining):
+        status = "AUTO_APPROVED"
+        reason = f"within remaining (amount {current_amount} ≤ remaining {round(remaining,2)})"
+    else:
+        status = "PENDING_REVIEW"
+        reason = f"exceeds remaining (amount {current_amount} > remaining {round(remaining,2)})"
+
+    # Same receipt claimed elsewhere (e.g. re-uploaded under another filename) goes to review regardless of budget.
+    expense["fingerprint"] = _expense_fingerprint(expense.get("merchant"), current_amount,
+                                                  expense.get("txnDate"), expense.get("currency"))
+    dups = _find_duplicates(c, tenant, expense) if expense["fingerprint"] else []
+    if dups:
+        expense["duplicateOf"] = [d["id"] for d in dups[:5]]
+        status = "PENDING_REVIEW"
+        reason = f"possible duplicate of {len(dups)} other expense(s); " + reason
+    else:
+        expense.pop("duplicateOf", None)
+
+    expense["approval"] = {
+        "status": status,
+        "evaluatedAt": _now_iso(),
+        "limit": limit_for_cat,
+        "remainingBefore": remaining,
+        "reason": reason
+    }
+
+    _replace_doc(c, expense)
+    _notify_queue(tenant)
+    return 200, expense
+
+@app.route(route="expenses/finalize", methods=["POST"], idempotent=True)
 def expenses_finalize(req: func.HttpRequest) -> func.HttpResponse:
     pr, err = _ensure_auth(req)
     if err: return err
     try:
-      data = req.get_json()
-      tenant = data.get("tenantId","default")
-      category = data.get("category")
-      if not category:
-          return func.HttpResponse(json.dumps({"error":"category is required"}), mimetype="application/json", status_code=400)
-
-      c = _expenses_container()
-      expense = None
-      if data.get("expenseId"):
-          expense = c.read_item(item=data["expenseId"], partition_key=tenant)
-      else:
-          q = "SELECT * FROM c WHERE c.docType='Expense' AND c.tenantId=@t AND c.taskId=@task AND c.blobPath=@blob"
-          items = list(c.query_items(q, parameters=[
-              {"name":"@t","value":tenant},
-              {"name":"@task","value":data.get("taskId")},
-              {"name":"@blob","value":data.get("blobPath")}
-          ], enable_cross_partition_query=True))
-          if items: expense = items[0]
-      if not expense:
-          return func.HttpResponse(json.dumps({"error":"expense not found"}), mimetype="application/json", status_code=404)
-
-      # Only assignee or admin can finalize this expense (based on its task)
-      task = _get_task(expense.get("tenantId","default"), expense.get("taskId"))
-      if not _can_access_task(pr, task):
-          return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
-
-      original_total = expense.get("total")
-      prev_edited    = expense.get("editedTotal", None)
-
-      submitted_total_present = "total" in data
-      if submitted_total_present:
-          try:
-              edited_total = float(data.get("total") if data.get("total") is not None else 0.0)
-          except Exception:
-              return func.HttpResponse(json.dumps({"error":"total must be a number"}), mimetype="application/json", status_code=400)
-          expense["editedTotal"] = edited_total
-      else:
-          edited_total = float(prev_edited if prev_edited is not None else (original_total or 0))
-
-      current_amount = float(edited_total or 0)
-
-      expense["category"] = category
-      if submitted_total_present and original_total is not None:
-          try:
-              expense["isManualOverride"] = float(edited_total) != float(original_total)
-          except Exception:
-              expense["isManualOverride"] = False
-      if data.get("comment"): expense["comment"] = data["comment"]
-      expense["submittedBy"] = pr.get("userDetails") or pr.get("userId")
-
-      limits = (task or {}).get("expenseLimits") or DEFAULT_LIMITS
-      limit_for_cat = float(limits.get(category, limits.get("Other", 1000)) or 0)
-
-      q = ("SELECT c.id, c.editedTotal, c.total, c.approval "
-           "FROM c WHERE c.docType='Expense' AND c.tenantId=@t AND c.taskId=@task AND c.category=@cat")
-      others = list(c.query_items(q, parameters=[
-          {"name":"@t","value":tenant},
-          {"name":"@task","value":expense["taskId"]},
-          {"name":"@cat","value":category}
-      ], enable_cross_partition_query=True))
-
-      def _status(x):
-          a = x.get("approval") or {}
-          return a.get("status")
-
-      spent_so_far = 0.0
-      for e in others:
-          if e["id"] == expense["id"]:
-              continue
-          st = _status(e)
-          if st in ("APPROVED","AUTO_APPROVED","PENDING_REVIEW"):
-              amt = e.get("editedTotal", e.get("total"))
-              try: amt = float(amt or 0)
-              except: amt = 0.0
-              spent_so_far += amt
-
-      remaining = limit_for_cat - spent_so_far
-      if current_amount <= max(0.0, remaining):
-          status = "AUTO_APPROVED"
-          reason = f"within remaining (amount {current_amount} ≤ remaining {round(remaining,2)})"
-      else:
-          status = "PENDING_REVIEW"
-          reason = f"exceeds remaining (amount {current_amount} > remaining {round(remaining,2)})"
-
-      expense["approval"] = {
-          "status": status,
-          "evaluatedAt": _now_iso(),
-          "limit": limit_for_cat,
-          "remainingBefore": remaining,
-          "reason": reason
-      }
+        return _respond(*_finalize_expense(pr, req.get_json()))
+    except Exception as e:
+        return _error_response(e)
 
-      c.replace_item(item=expense, body=expense)
-      return func.HttpResponse(json.dumps(expense), mimetype="application/json", status_code=200)
+# ---- Offline sync
+SYNC_OPS = ("checkin", "checkout", "finalize")
 
+@app.route(route="sync/batch", methods=["POST"], idempotent=True)
+def sync_batch(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Replay actions queued offline, in order, in one round trip.
+    Body: { tenantId?, ops: [ { opId?, type: "checkin"|"checkout"|"finalize", clientTs?, ...same fields as the single endpoint } ] }
+    Each task is read once and reused across ops; every op gets { opId, type, status, result|error }.
+    clientTs dates checkin/checkout events (never before the task or its check-in); SLA lateness is
+    still judged on arrival. A failing op doesn't stop the rest (a checkout after a failed checkin fails on its own terms),
+    but if Cosmos becomes unavailable the remaining ops are marked skipped and the batch returns 503.
+    """
+    pr, err = _ensure_auth(req)
+    if err: return err
+    try:
+        data = req.get_json()
+        tenant = data.get("tenantId","default")
+        ops = data.get("ops")
+        max_ops = int(os.environ.get("SYNC_BATCH_MAX", "100"))
+        if not isinstance(ops, list) or not ops:
+            return func.HttpResponse(json.dumps({"error":"ops (non-empty list) required"}), mimetype="application/json", status_code=400)
+        if len(ops) > max_ops:
+            return func.HttpResponse(json.dumps({"error":f"at most {max_ops} ops per batch"}), mimetype="application/json", status_code=413)
+
+        tasks = {}
+        def _task(t, task_id):
+            key = (t, task_id)
+            if key not in tasks:
+                tasks[key] = _get_task(t, task_id)
+            return tasks[key]
+
+        results, unavailable = [], None
+        for i, op in enumerate(ops):
+            op = op if isinstance(op, dict) else {}
+            kind = op.get("type")
+            res = {"opId": op.get("opId", i), "type": kind}
+            results.append(res)
+            if unavailable:
+                res.update({"status": 503, "error": "skipped", "skipped": True})
+                continue
+            payload = dict(op, tenantId=op.get("tenantId", tenant))
+            try:
+                if kind not in SYNC_OPS:
+                    status, out = 400, {"error": f"type must be one of {', '.join(SYNC_OPS)}"}
+                elif kind == "finalize":
+                    status, out = _finalize_expense(pr, payload, get_task=_task)
+                elif not payload.get("taskId"):
+                    status, out = 400, {"error":"taskId required"}
+                else:
+                    t = _task(payload["tenantId"], payload["taskId"])
+                    status, out = (_checkin if kind == "checkin" else _checkout)(pr, payload["tenantId"], t, payload, replay=True)
+            except CosmosUnavailable as e:
+                unavailable = e
+                status, out = 503, {"error": str(e)}
+            except ConcurrentUpdate as e:
+                status, out = 409, {"error": str(e)}
+            except Exception as e:
+                status, out = 500, {"error": str(e)}
+            res["status"] = status
+            if status < 400:
+                res["result"] = out
+            else:
+                res["error"] = out.get("error")
+
+        failed = sum(1 for r in results if r["status"] >= 400)
+        body = {"results": results, "applied": len(results) - failed, "failed": failed}
+        if unavailable:
+            # 503 so an Idempotency-Key isn't pinned to a partial result; applied ops are safe to replay.
+            return func.HttpResponse(json.dumps(body), mimetype="application/json", status_code=503,
+                                     headers={"Retry-After": str(max(1, -(-unavailable.retry_after_ms // 1000)))})
+        return func.HttpResponse(json.dumps(body), mimetype="application/json", status_code=200)
     except Exception as e:
-      return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
-@app.route(route="expenses", methods=["GET"])
+@app.route(route="expenses", methods=["GET"], reads="eventual")
 def expenses_list(req: func.HttpRequest) -> func.HttpResponse:
     pr, err = _ensure_auth(req)
     if err: return err
     try:
         tenant = req.params.get("tenantId", "default")
         c = _expenses_container()
-        q = "SELECT * FROM c WHERE c.tenantId = @t AND c.docType = 'Expense' ORDER BY c.createdAt DESC"
+        q = "SELECT * FROM c WHERE c.tenantId = @t AND c.docType = 'Expense' AND NOT IS_DEFINED(c.deletedAt) ORDER BY c.createdAt DESC"
         items = list(c.query_items(q, parameters=[{"name":"@t","value": tenant}], enable_cross_partition_query=True))
         return func.HttpResponse(json.dumps(items), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
-@app.route(route="expenses/byTask", methods=["GET"])
+@app.route(route="expenses/byTask", methods=["GET"], reads="eventual")
 def expenses_by_task(req: func.HttpRequest) -> func.HttpResponse:
     pr, err = _ensure_auth(req)
     if err: return err
@@ -674,30 +2213,128 @@ def expenses_by_task(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(json.dumps({"error":"Forbidden: not assignee"}), mimetype="application/json", status_code=403)
 
         c = _expenses_container()
-        q = "SELECT * FROM c WHERE c.tenantId=@t AND c.docType='Expense' AND c.taskId=@task ORDER BY c.createdAt DESC"
+        q = "SELECT * FROM c WHERE c.tenantId=@t AND c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.taskId=@task ORDER BY c.createdAt DESC"
         items = list(c.query_items(q, parameters=[{"name":"@t","value": tenant},{"name":"@task","value": task_id}], enable_cross_partition_query=True))
+        if (task or {}).get("archive"):
+            items = sorted(_with_archived(task, "expenses", items), key=lambda e: e.get("createdAt") or "", reverse=True)
         return func.HttpResponse(json.dumps(items), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 # ---- Admin approval queue
-@app.route(route="expenses/pending", methods=["GET"])
+TASK_CONTEXT_FIELDS = ("id", "title", "assignee", "status", "slaEnd", "expenseLimits")
+
+def _tasks_by_id(tenant: str, task_ids) -> dict:
+    """
+    Fetch many tasks of one tenant in as few round trips as possible: one read_many_items call where
+    the SDK has it, else ARRAY_CONTAINS queries in chunks of 100. Missing tasks are simply absent.
+    """
+    ids = sorted(set(i for i in task_ids if i))
+    if not ids:
+        return {}
+    c = _tasks_container()
+    if hasattr(c, "read_many_items"):
+        docs = c.read_many_items(items=[(i, tenant) for i in ids])
+    else:
+        q = "SELECT * FROM c WHERE c.tenantId=@t AND c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND ARRAY_CONTAINS(@ids, c.id)"
+        docs = []
+        for i in range(0, len(ids), 100):
+            docs.extend(c.query_items(q, parameters=[{"name":"@t","value":tenant},{"name":"@ids","value":ids[i:i+100]}],
+                                      partition_key=_tenant_pk(c, tenant)))
+    return {d["id"]: d for d in docs if d.get("docType") == "Task" and "deletedAt" not in d}
+
+def _attach_task_context(tenant: str, items):
+    """Set e["task"] to the TASK_CONTEXT_FIELDS of each expense's task (None if it is gone)."""
+    tasks = _tasks_by_id(tenant, (e.get("taskId") for e in items))
+    for e in items:
+        t = tasks.get(e.get("taskId"))
+        e["task"] = {k: t.get(k) for k in TASK_CONTEXT_FIELDS} if t else None
+
+@app.route(route="expenses/pending", methods=["GET"], reads="eventual")
 def expenses_pending(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin approval queue, oldest first.
+    Query: tenantId?, include=task to attach { title, assignee, status, slaEnd, expenseLimits } of each
+    expense's task (fetched once per distinct task), so the approval screen needn't load every task.
+    """
     pr, err = _ensure_admin(req)
     if err: return err
     try:
         tenant = req.params.get("tenantId", "default")
         c = _expenses_container()
-        q = ("SELECT * FROM c WHERE c.docType='Expense' AND c.tenantId=@t "
+        q = ("SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
              "AND c.approval.status='PENDING_REVIEW' ORDER BY c.createdAt ASC")
         items = list(c.query_items(q, parameters=[{"name":"@t","value": tenant}], enable_cross_partition_query=True))
+        if "task" in (req.params.get("include") or "").split(","):
+            _attach_task_context(tenant, items)
         return func.HttpResponse(json.dumps(items), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+# In-process change notifier per tenant: finalize/decide bump the version and wake long-polls on
+# this instance. Other instances still see the change on their next query (at most one poll timeout late).
+_QUEUE_LOCK = threading.Lock()
+_QUEUE_NOTIFY = {}
+# Each waiting long-poll holds a worker thread; past this many per instance, polls return at once.
+_QUEUE_WAITERS = threading.BoundedSemaphore(int(os.environ.get("QUEUE_MAX_WAITERS", "4")))
+
+def _queue_waiter(tenant: str):
+    with _QUEUE_LOCK:
+        w = _QUEUE_NOTIFY.get(tenant)
+        if w is None:
+            w = _QUEUE_NOTIFY[tenant] = {"cond": threading.Condition(), "version": 0}
+        return w
+
+def _notify_queue(tenant: str):
+    w = _queue_waiter(tenant or "default")
+    with w["cond"]:
+        w["version"] += 1
+        w["cond"].notify_all()
+
+def _parse_queue_cursor(cursor: str):
+    """
+    Cursor is "<_ts>:<id>@<_ts>,..." -- the second to query from plus the versions already delivered
+    at or after it (a bare "<id>" means "<id>@<cursor _ts>"). Returns (ts, {id: _ts}).
+    """
+    if not cursor:
+        return None, {}
+    ts, _, ids = cursor.partition(":")
+    try:
+        ts = int(ts)
+        seen = {}
+        for part in (i for i in ids.split(",") if i):
+            doc_id, _, at = part.partition("@")
+            seen[doc_id] = int(at) if at else ts
+        return ts, seen
+    except ValueError:
+        return None, {}
+
+def _queue_changes(tenant: str, ts: int, seen: dict):
+    """Expenses changed since the cursor that are, or were, in the approval queue (pending, decided or promoted)."""
+    c = _expenses_container()
+    q = ("SELECT * FROM c WHERE c.docType='Expense' AND c.tenantId=@t AND c._ts >= @ts "
+         "AND (c.approval.status='PENDING_REVIEW' OR IS_DEFINED(c.approval.decidedAt) "
+         "OR c.approval.previous.status='PENDING_REVIEW')")
+    rows = list(c.query_items(q, parameters=[{"name":"@t","value": tenant},{"name":"@ts","value": ts}],
+                              enable_cross_partition_query=True))
+    return sorted((r for r in rows if seen.get(r["id"]) != r.get("_ts")), key=lambda r: (r.get("_ts") or 0, r["id"]))
+
+def _queue_cursor(rows, ts: int, seen: dict) -> str:
+    """
+    Next cursor after delivering rows. It trails the newest _ts by QUEUE_CURSOR_OVERLAP_S (default 5)
+    so a change committed late in another partition is still found; versions inside that overlap
+    are listed so they aren't delivered twice.
+    """
+    delivered = dict(seen)
+    delivered.update({r["id"]: r.get("_ts") or 0 for r in rows})
+    top = max([ts] + list(delivered.values()))
+    floor = max(ts, top - int(os.environ.get("QUEUE_CURSOR_OVERLAP_S", "5")))
+    keep = sorted((i, t) for i, t in delivered.items() if t >= floor)
+    return f"{floor}:{','.join(i if t == floor else f'{i}@{t}' for i, t in keep)}"
 
 def _decide_expense(expense_id: str, tenant: str, status: str, note: str, decided_by: str):
     c = _expenses_container()
-    exp = c.read_item(item=expense_id, partition_key=tenant)
+    exp = _read_doc(c, expense_id, tenant)
     appr = exp.get("approval") or {}
     appr["status"] = status
     appr["decidedAt"] = _now_iso()
@@ -707,7 +2344,8 @@ def _decide_expense(expense_id: str, tenant: str, status: str, note: str, decide
     elif note:
         appr["note"] = note
     exp["approval"] = appr
-    c.replace_item(item=exp, body=exp)
+    _replace_doc(c, exp)
+    _notify_queue(tenant)
     return exp
 
 @app.route(route="expenses/approve", methods=["POST"])
@@ -725,7 +2363,7 @@ def expenses_approve(req: func.HttpRequest) -> func.HttpResponse:
         exp = _decide_expense(expense_id, tenant, "APPROVED", note, decided_by)
         return func.HttpResponse(json.dumps(exp), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 @app.route(route="expenses/reject", methods=["POST"])
 def expenses_reject(req: func.HttpRequest) -> func.HttpResponse:
@@ -744,130 +2382,1115 @@ def expenses_reject(req: func.HttpRequest) -> func.HttpResponse:
         exp = _decide_expense(expense_id, tenant, "REJECTED", note, decided_by)
         return func.HttpResponse(json.dumps(exp), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+@app.route(route="expenses/pending/changes", methods=["GET"])
+def expenses_pending_changes(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only long-poll for the approval queue.
+    Query: tenantId?, cursor? (or Last-Event-ID header), timeoutSec? (default 10, max 20), include=task
+    (as for expenses/pending, applied to the queued items).
+    Without a cursor: returns the current queue and a cursor. With one: waits until an expense
+    changes (or the timeout) and returns { items: [new/changed pending], removed: [ids no longer pending], cursor }.
+    With Accept: text/event-stream the same payload is sent as one SSE event (id = cursor), so an
+    EventSource reconnects with Last-Event-ID and picks up from there.
+    At most QUEUE_MAX_WAITERS polls per instance wait at a time; the rest answer immediately.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        tenant = req.params.get("tenantId", "default")
+        cursor = req.params.get("cursor") or req.headers.get("Last-Event-ID")
+        try:
+            timeout = min(20.0, max(0.0, float(req.params.get("timeoutSec", "10"))))
+        except ValueError:
+            timeout = 10.0
+        sse = "text/event-stream" in (req.headers.get("Accept") or "")
+
+        ts, seen = _parse_queue_cursor(cursor)
+        if ts is None:
+            # Start from before the query (less the overlap, for host/Cosmos clock skew) rather than from
+            # its end, so an expense changed while the snapshot was read still comes through the feed.
+            start = int(time.time()) - int(os.environ.get("QUEUE_CURSOR_OVERLAP_S", "5"))
+            c = _expenses_container()
+            q = ("SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
+                 "AND c.approval.status='PENDING_REVIEW' ORDER BY c.createdAt ASC")
+            items = list(c.query_items(q, parameters=[{"name":"@t","value": tenant}], enable_cross_partition_query=True))
+            if items:
+                start = min(start, max(i.get("_ts") or 0 for i in items))  # never ahead of Cosmos's own clock
+            seen = {i["id"]: i.get("_ts") or 0 for i in items if (i.get("_ts") or 0) >= start}
+            cursor = f"{start}:{','.join(f'{i}@{t}' for i, t in sorted(seen.items()))}"
+            out = {"items": items, "removed": [], "cursor": cursor, "snapshot": True}
+        else:
+            w = _queue_waiter(tenant)
+            with w["cond"]:
+                version = w["version"]
+            rows = _queue_changes(tenant, ts, seen)
+            if not rows and timeout and _QUEUE_WAITERS.acquire(blocking=False):
+                try:
+                    with w["cond"]:
+                        w["cond"].wait_for(lambda: w["version"] != version, timeout=timeout)
+                finally:
+                    _QUEUE_WAITERS.release()
+                rows = _queue_changes(tenant, ts, seen)
+            queued = lambda r: ((r.get("approval") or {}).get("status")) == "PENDING_REVIEW" and "deletedAt" not in r
+            pending = [r for r in rows if queued(r)]
+            removed = [r["id"] for r in rows if not queued(r)]
+            out = {"items": pending, "removed": removed, "cursor": _queue_cursor(rows, ts, seen), "snapshot": False}
+        if out["items"] and "task" in (req.params.get("include") or "").split(","):
+            _attach_task_context(tenant, out["items"])
+
+        if sse:
+            body = f"retry: 1000\nid: {out['cursor']}\nevent: queue\ndata: {json.dumps(out)}\n\n"
+            return func.HttpResponse(body, mimetype="text/event-stream", status_code=200,
+                                     headers={"Cache-Control": "no-cache"})
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+# ---- Reports
+REPORT_FILTER_KEYS = ("fromDate", "toDate", "assignee", "status", "slaBreached")
+
+def _report_filters(src) -> dict:
+    """Normalize report filters from query params or a JSON body; unknown or empty values are dropped."""
+    f = {}
+    for k in REPORT_FILTER_KEYS:
+        v = src.get(k)
+        if v is None or v == "":
+            continue
+        if k == "status":
+            v = [x.strip().upper() for x in (v if isinstance(v, list) else str(v).split(",")) if x.strip()]
+        elif k == "slaBreached":
+            v = v if isinstance(v, bool) else str(v).lower() == "true"
+        else:
+            v = str(v).strip()
+        f[k] = v
+    return f
 
-# ---- Report CSV
-@app.route(route="report/csv", methods=["GET"])
+def _report_task_query(tenant: str, filters: dict):
+    """
+    Build the task query with every filter pushed into Cosmos. Date bounds are computed once;
+    createdAt is ISO-8601 so string comparison against YYYY-MM-DD bounds is a range-index lookup.
+    Raises ValueError for malformed dates.
+    """
+    where = ["c.docType='Task' AND NOT IS_DEFINED(c.deletedAt)", "c.tenantId=@t"]
+    params = [{"name":"@t","value":tenant}]
+    if filters.get("fromDate"):
+        lo = datetime.strptime(filters["fromDate"], "%Y-%m-%d").date()
+        where.append("c.createdAt >= @from")
+        params.append({"name":"@from","value":lo.isoformat()})
+    if filters.get("toDate"):
+        hi = datetime.strptime(filters["toDate"], "%Y-%m-%d").date() + timedelta(days=1)
+        where.append("c.createdAt < @to")
+        params.append({"name":"@to","value":hi.isoformat()})
+    if filters.get("assignee"):
+        where.append("STRINGEQUALS(c.assignee, @assignee, true)")
+        params.append({"name":"@assignee","value":filters["assignee"]})
+    if filters.get("status"):
+        where.append("ARRAY_CONTAINS(@statuses, c.status)")
+        params.append({"name":"@statuses","value":filters["status"]})
+    if "slaBreached" in filters:
+        where.append("c.slaBreached = true" if filters["slaBreached"]
+                     else "(NOT IS_DEFINED(c.slaBreached) OR c.slaBreached != true)")
+    return "SELECT * FROM c WHERE " + " AND ".join(where), params
+
+def _report_source(tenant: str, filters: dict = None, heartbeat=None):
+    """
+    Tasks matching the report filters and their expenses grouped by task id.
+    heartbeat(), when given, is called as rows stream in so a background job can show it is alive.
+    """
+    filters = filters or {}
+    beat = heartbeat or (lambda: None)
+    def _drain(query):
+        rows = []
+        for r in query:
+            rows.append(r)
+            beat()
+        return rows
+    tq, tparams = _report_task_query(tenant, filters)
+    tasks = _drain(_tasks_container().query_items(tq, parameters=tparams, enable_cross_partition_query=True))
+
+    exp_by_task = {}
+    if not tasks:
+        return tasks, exp_by_task
+    ec = _expenses_container()
+    if not filters:
+        # unfiltered report: one tenant-wide scan beats chunked id lookups
+        eq = "SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t"
+        expenses = _drain(ec.query_items(eq, parameters=[{"name":"@t","value":tenant}], enable_cross_partition_query=True))
+    else:
+        ids = [t.get("id") for t in tasks]
+        eq = "SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND ARRAY_CONTAINS(@ids, c.taskId)"
+        expenses = []
+        for i in range(0, len(ids), 100):
+            expenses.extend(_drain(ec.query_items(eq, parameters=[
+                {"name":"@t","value":tenant},
+                {"name":"@ids","value":ids[i:i+100]}
+            ], enable_cross_partition_query=True)))
+    for e in expenses:
+        exp_by_task.setdefault(e.get("taskId"), []).append(e)
+    for t in tasks:
+        if t.get("archive"):
+            exp_by_task[t["id"]] = _with_archived(t, "expenses", exp_by_task.get(t["id"], []))
+            beat()
+    return tasks, exp_by_task
+
+def _money(x):
+    try: return float(x or 0)
+    except: return 0.0
+
+def _item_quantity(it) -> int:
+    # "qty" first, as report/csv always printed it; tasks/update writes "quantity". Junk counts as 1.
+    for key in ("qty", "quantity"):
+        try:
+            n = int(it.get(key))
+        except (TypeError, ValueError):
+            continue
+        if n > 0:
+            return n
+    return 1
+
+def _task_rollup(t, exps):
+    """One report row per task: numeric category totals and approval counts (REJECTED excluded from totals)."""
+    totals = {"Hotel": 0.0, "Food": 0.0, "Travel": 0.0, "Other": 0.0}
+    pending = approved = rejected = 0
+    for e in exps:
+        st = (e.get("approval") or {}).get("status")
+        amt = _money(e.get("editedTotal", e.get("total")))
+        cat = e.get("category") or "Other"
+        if st == "REJECTED":
+            rejected += 1
+            continue
+        if st in ("PENDING_REVIEW", None, ""):
+            pending += 1
+        elif st in ("APPROVED","AUTO_APPROVED"):
+            approved += 1
+        # Include PENDING & APPROVED in totals, exclude REJECTED
+        totals[cat if cat in totals else "Other"] += amt
+    return {
+        "taskId": t.get("id"),
+        "title": t.get("title") or "",
+        "assignee": t.get("assignee") or "",
+        "status": t.get("status") or "",
+        "createdAt": t.get("createdAt"),
+        "slaStart": t.get("slaStart"),
+        "slaEnd": t.get("slaEnd"),
+        "checkInAt": t.get("checkInAt"),
+        "checkOutAt": t.get("checkOutAt"),
+        "slaBreached": bool(t.get("slaBreached")),
+        "products": [{
+            "productId": it.get("productId"),
+            "name": it.get("name"),
+            "quantity": _item_quantity(it)
+        } for it in (t.get("items") or [])],
+        "hotelTotal": totals["Hotel"],
+        "foodTotal": totals["Food"],
+        "travelTotal": totals["Travel"],
+        "otherTotal": totals["Other"],
+        "grandTotal": sum(totals.values()),
+        "pendingCount": pending,
+        "approvedCount": approved,
+        "rejectedCount": rejected
+    }
+
+def _expense_row(t, e):
+    """One report row per expense, joined with its task's title and assignee."""
+    appr = e.get("approval") or {}
+    total = e.get("total")
+    return {
+        "expenseId": e.get("id"),
+        "taskId": e.get("taskId"),
+        "taskTitle": (t or {}).get("title") or "",
+        "assignee": (t or {}).get("assignee") or "",
+        "category": e.get("category"),
+        "merchant": e.get("merchant"),
+        "currency": e.get("currency"),
+        "txnDate": e.get("txnDate"),
+        "ocrTotal": None if total is None else _money(total),
+        "amount": _money(e.get("editedTotal", total)),
+        "isManualOverride": bool(e.get("isManualOverride")),
+        "status": appr.get("status"),
+        "createdAt": e.get("createdAt"),
+        "evaluatedAt": appr.get("evaluatedAt"),
+        "decidedAt": appr.get("decidedAt"),
+        "decidedBy": appr.get("decidedBy"),
+        "submittedBy": e.get("submittedBy")
+    }
+
+def _report_rows(level: str, tasks, exp_by_task):
+    """Yield report rows lazily so serializers can write them in chunks."""
+    for t in tasks:
+        exps = exp_by_task.get(t.get("id"), [])
+        if level == "expense":
+            for e in exps:
+                yield _expense_row(t, e)
+        else:
+            yield _task_rollup(t, exps)
+
+REPORT_TIMESTAMP_FIELDS = {"createdAt", "slaStart", "slaEnd", "checkInAt", "checkOutAt", "evaluatedAt", "decidedAt"}
+REPORT_FORMATS = {
+    "csv":     ("text/csv; charset=utf-8", "csv"),
+    "ndjson":  ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow":   ("application/vnd.apache.arrow.stream", "arrow"),
+}
+
+def _write_task_csv(rows):
+    buf = io.StringIO()
+    buf.write("\ufeff")
+    writer = csv.writer(buf)
+    writer.writerow([
+        "Task ID","Title","Assignee","Status",
+        "SLA Start","SLA End","Check-in","Check-out","SLA Breached",
+        "Products (name x qty)",
+        "Hotel total","Food total","Travel total","Other total","Grand total",
+        "Pending count","Approved count","Rejected count"
+    ])
+    for r in rows:
+        products_str = ", ".join([f"{(p.get('name') or '').replace(',', ' ')} x{p.get('quantity')}" for p in r["products"]])
+        writer.writerow([
+            r["taskId"], r["title"], r["assignee"], r["status"],
+            r["slaStart"] or "", r["slaEnd"] or "", r["checkInAt"] or "", r["checkOutAt"] or "",
+            "YES" if r["slaBreached"] else "NO",
+            products_str,
+            f"{r['hotelTotal']:.2f}", f"{r['foodTotal']:.2f}", f"{r['travelTotal']:.2f}",
+            f"{r['otherTotal']:.2f}", f"{r['grandTotal']:.2f}",
+            r["pendingCount"], r["approvedCount"], r["rejectedCount"]
+        ])
+    return buf.getvalue().encode("utf-8")
+
+def _write_expense_csv(rows):
+    buf = io.StringIO()
+    buf.write("\ufeff")
+    # header from the row builder itself, so an empty report still has its columns
+    writer = csv.DictWriter(buf, fieldnames=list(_expense_row(None, {}).keys()))
+    writer.writeheader()
+    for r in rows:
+        writer.writerow(r)
+    return buf.getvalue().encode("utf-8")
+
+def _write_ndjson(rows):
+    buf = io.BytesIO()
+    for r in rows:
+        buf.write(json.dumps(r, ensure_ascii=False).encode("utf-8"))
+        buf.write(b"\n")
+    return buf.getvalue()
+
+def _arrow_schema(level: str):
+    import pyarrow as pa
+    ts = pa.timestamp("us", tz="UTC")
+    if level == "expense":
+        return pa.schema([
+            ("expenseId", pa.string()), ("taskId", pa.string()), ("taskTitle", pa.string()),
+            ("assignee", pa.string()), ("category", pa.string()), ("merchant", pa.string()),
+            ("currency", pa.string()), ("txnDate", pa.date32()), ("ocrTotal", pa.float64()),
+            ("amount", pa.float64()), ("isManualOverride", pa.bool_()), ("status", pa.string()),
+            ("createdAt", ts), ("evaluatedAt", ts), ("decidedAt", ts),
+            ("decidedBy", pa.string()), ("submittedBy", pa.string())
+        ])
+    product = pa.struct([("productId", pa.string()), ("name", pa.string()), ("quantity", pa.int64())])
+    return pa.schema([
+        ("taskId", pa.string()), ("title", pa.string()), ("assignee", pa.string()), ("status", pa.string()),
+        ("createdAt", ts), ("slaStart", ts), ("slaEnd", ts), ("checkInAt", ts), ("checkOutAt", ts),
+        ("slaBreached", pa.bool_()), ("products", pa.list_(product)),
+        ("hotelTotal", pa.float64()), ("foodTotal", pa.float64()), ("travelTotal", pa.float64()),
+        ("otherTotal", pa.float64()), ("grandTotal", pa.float64()),
+        ("pendingCount", pa.int32()), ("approvedCount", pa.int32()), ("rejectedCount", pa.int32())
+    ])
+
+def _typed_row(r):
+    """Convert ISO strings to datetimes/dates so Arrow gets real timestamp columns."""
+    out = dict(r)
+    for k in REPORT_TIMESTAMP_FIELDS.intersection(out):
+        dt = _parse_iso(out[k]) if isinstance(out[k], str) else None
+        if dt is not None and dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        out[k] = dt
+    if "txnDate" in out:
+        try:
+            out["txnDate"] = datetime.strptime(str(out["txnDate"])[:10], "%Y-%m-%d").date()
+        except Exception:
+            out["txnDate"] = None
+    return out
+
+def _write_arrow(rows, level: str, fmt: str):
+    """Write rows as Parquet or an Arrow IPC stream, one record batch per REPORT_BATCH_ROWS rows."""
+    import pyarrow as pa
+    schema = _arrow_schema(level)
+    chunk_size = int(os.environ.get("REPORT_BATCH_ROWS", "5000"))
+    sink = io.BytesIO()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema, compression="snappy")
+        write = writer.write_table
+        to_unit = lambda batch: pa.Table.from_pylist(batch, schema=schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+        to_unit = lambda batch: pa.RecordBatch.from_pylist(batch, schema=schema)
+    try:
+        batch = []
+        for r in rows:
+            batch.append(_typed_row(r))
+            if len(batch) >= chunk_size:
+                write(to_unit(batch)); batch = []
+        if batch:
+            write(to_unit(batch))
+    finally:
+        writer.close()
+    return sink.getvalue()
+
+def _render_report(fmt: str, level: str, tasks, exp_by_task):
+    """Serialize a report. Returns (body bytes, content type, file extension)."""
+    content_type, ext = REPORT_FORMATS[fmt]
+    rows = _report_rows(level, tasks, exp_by_task)
+    if fmt == "csv":
+        body = _write_expense_csv(rows) if level == "expense" else _write_task_csv(rows)
+    elif fmt == "ndjson":
+        body = _write_ndjson(rows)
+    else:
+        body = _write_arrow(rows, level, fmt)
+    return body, content_type, ext
+
+def _report_filename(level: str, ext: str):
+    suffix = "_expenses" if level == "expense" else ""
+    return f"fieldops_report{suffix}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{ext}"
+
+@app.route(route="report/csv", methods=["GET"], reads="eventual")
 def report_csv(req: func.HttpRequest) -> func.HttpResponse:
     pr, err = _ensure_admin(req)
     if err: return err
     try:
         tenant = req.params.get("tenantId", "default")
-        from_date = req.params.get("fromDate")
-        to_date   = req.params.get("toDate")
-
-        # tasks
-        tc = _tasks_container()
-        tq = "SELECT * FROM c WHERE c.docType='Task' AND c.tenantId=@t"
-        tasks = list(tc.query_items(tq, parameters=[{"name":"@t","value":tenant}], enable_cross_partition_query=True))
-
-        def _in_range(tdoc):
-            if not from_date and not to_date:
-                return True
-            ca = tdoc.get("createdAt")
+        try:
+            tasks, exp_by_task = _report_source(tenant, _report_filters(req.params))
+        except ValueError:
+            return func.HttpResponse(json.dumps({"error":"fromDate/toDate must be YYYY-MM-DD"}),
+                                     mimetype="application/json", status_code=400)
+        data, content_type, ext = _render_report("csv", "task", tasks, exp_by_task)
+        headers = {
+            "Content-Type": content_type,
+            "Content-Disposition": f'attachment; filename="{_report_filename("task", ext)}"'
+        }
+        return func.HttpResponse(data, headers=headers, status_code=200)
+
+    except Exception as e:
+        return _error_response(e)
+
+@app.route(route="report/export", methods=["GET"], reads="eventual")
+def report_export(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Typed report export for analytics loads.
+    Query params:
+      - format: csv | ndjson | parquet | arrow (default ndjson)
+      - level:  task (per-task rollup, default) | expense (one row per expense)
+      - fromDate / toDate: YYYY-MM-DD on task createdAt
+      - assignee, status (comma-separated), slaBreached=true|false
+    The same filters apply to report/csv and report/jobs.
+    NDJSON/Parquet/Arrow keep numbers and timestamps typed; Parquet/Arrow need pyarrow.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        tenant = req.params.get("tenantId", "default")
+        fmt    = (req.params.get("format") or "ndjson").lower()
+        level  = (req.params.get("level") or "task").lower()
+        if fmt not in REPORT_FORMATS:
+            return func.HttpResponse(json.dumps({"error": f"format must be one of {', '.join(REPORT_FORMATS)}"}),
+                                     mimetype="application/json", status_code=400)
+        if level not in ("task", "expense"):
+            return func.HttpResponse(json.dumps({"error":"level must be task or expense"}),
+                                     mimetype="application/json", status_code=400)
+        if fmt in ("parquet", "arrow"):
             try:
-                dt = _parse_iso(ca) or datetime.min.replace(tzinfo=timezone.utc)
-            except Exception:
-                dt = datetime.min.replace(tzinfo=timezone.utc)
-            if from_date:
-                f = datetime.strptime(from_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                if dt < f: return False
-            if to_date:
-                tt = datetime.strptime(to_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
-                if dt >= tt: return False
-            return True
-
-        tasks = [t for t in tasks if _in_range(t)]
-
-        # expenses grouped
-        ec = _expenses_container()
-        eq = "SELECT * FROM c WHERE c.docType='Expense' AND c.tenantId=@t"
-        expenses = list(ec.query_items(eq, parameters=[{"name":"@t","value":tenant}], enable_cross_partition_query=True))
-        exp_by_task = {}
-        for e in expenses:
-            exp_by_task.setdefault(e.get("taskId"), []).append(e)
-
-        buf = io.StringIO()
-        buf.write("\ufeff")
-        writer = csv.writer(buf)
-        header = [
-            "Task ID","Title","Assignee","Status",
-            "SLA Start","SLA End","Check-in","Check-out","SLA Breached",
-            "Products (name x qty)",
-            "Hotel total","Food total","Travel total","Other total","Grand total",
-            "Pending count","Approved count","Rejected count"
-        ]
-        writer.writerow(header)
-
-        def _money(x):
-            try: return float(x or 0)
-            except: return 0.0
-
-        for t in tasks:
-            t_id = t.get("id"); t_title = t.get("title") or ""
-            t_assignee = t.get("assignee") or ""
-            t_status = t.get("status") or ""
-            sla_start = t.get("slaStart") or ""
-            sla_end   = t.get("slaEnd") or ""
-            cin = t.get("checkInAt") or ""
-            cout= t.get("checkOutAt") or ""
-            breached = bool(t.get("slaBreached"))
-
-            items = t.get("items") or []
-            products_str = ", ".join([f"{(it.get('name') or '').replace(',', ' ')} x{it.get('qty') or 1}" for it in items])
-
-            hotel = food = travel = other = 0.0
-            pending = approved = rejected = 0
-
-            for e in exp_by_task.get(t_id, []):
-                st = (e.get("approval") or {}).get("status")
-                amt = _money(e.get("editedTotal", e.get("total")))
-                cat = e.get("category") or "Other"
-                if st == "REJECTED":
-                    rejected += 1
-                    continue
-                if st in ("PENDING_REVIEW", None, ""):
-                    pending += 1
-                elif st in ("APPROVED","AUTO_APPROVED"):
-                    approved += 1
-                # Include PENDING & APPROVED in totals, exclude REJECTED
-                if cat == "Hotel":
-                    hotel += amt
-                elif cat == "Food":
-                    food += amt
-                elif cat == "Travel":
-                    travel += amt
-                else:
-                    other += amt
-
-            total = hotel+food+travel+other
-            writer.writerow([
-                t_id, t_title, t_assignee, t_status,
-                sla_start, sla_end, cin, cout, "YES" if breached else "NO",
-                products_str,
-                f"{hotel:.2f}", f"{food:.2f}", f"{travel:.2f}", f"{other:.2f}", f"{total:.2f}",
-                pending, approved, rejected
-            ])
-
-        data = buf.getvalue()
-        filename = f"fieldops_report_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv"
+                import pyarrow  # noqa: F401
+            except ImportError:
+                return func.HttpResponse(json.dumps({"error":"pyarrow is not installed on this deployment"}),
+                                         mimetype="application/json", status_code=501)
+
+        try:
+            tasks, exp_by_task = _report_source(tenant, _report_filters(req.params))
+        except ValueError:
+            return func.HttpResponse(json.dumps({"error":"fromDate/toDate must be YYYY-MM-DD"}),
+                                     mimetype="application/json", status_code=400)
+        data, content_type, ext = _render_report(fmt, level, tasks, exp_by_task)
         headers = {
-            "Content-Type": "text/csv; charset=utf-8",
-            "Content-Disposition": f'attachment; filename="{filename}"'
+            "Content-Type": content_type,
+            "Content-Disposition": f'attachment; filename="{_report_filename(level, ext)}"'
         }
         return func.HttpResponse(data, headers=headers, status_code=200)
 
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+# ---- Report jobs (async, blob-hosted results)
+REPORT_JOB_ACTIVE = ("QUEUED", "RUNNING")
+
+def _report_job_id(tenant: str, params: dict) -> str:
+    # Identical (tenant, range, format, level) requests share one job, which is how results are cached.
+    import hashlib
+    raw = json.dumps({"tenantId": tenant, **params}, sort_keys=True)
+    return "report-" + hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+def _report_job_stale(job) -> bool:
+    hb = _parse_iso(job.get("heartbeatAt") or job.get("updatedAt"))
+    limit = int(os.environ.get("REPORT_JOB_STALE_SECONDS", "120"))
+    return not hb or (datetime.now(timezone.utc) - hb).total_seconds() > limit
+
+def _report_job_fresh(job) -> bool:
+    done = _parse_iso(job.get("finishedAt"))
+    minutes = int(os.environ.get("REPORT_CACHE_MINUTES", "15"))
+    return bool(done and datetime.now(timezone.utc) - done < timedelta(minutes=minutes))
+
+def _claim_report_job(jc, job):
+    """
+    Take ownership of a report job for a new run: create it, or replace the copy read earlier only if
+    its _etag is unchanged. Returns the saved doc (with the _etag the runner writes against), or None
+    when another request claimed it first.
+    """
+    job["runId"] = uuid.uuid4().hex
+    try:
+        if job.get("_etag"):
+            _replace_doc(jc, job)
+            return job
+        return jc.create_item(job)
+    except ConcurrentUpdate:
+        return None
+    except Exception as e:
+        if getattr(e, "status_code", None) == 409:
+            return None
+        raise
+
+def _run_report_job(job):
+    """
+    Build a claimed job's report. Every progress write is etag-conditional on the runner's last write, so
+    if the job was judged stale and re-claimed, this run notices on its next heartbeat and stops.
+    """
+    jc = _jobs_container()
+    params = job["params"]
+    beat_every = int(os.environ.get("REPORT_JOB_HEARTBEAT_SECONDS", "20"))
+    def _touch(**fields):
+        job.update(fields)
+        job["updatedAt"] = job["heartbeatAt"] = _now_iso()
+        _replace_doc(jc, job)
+    def _heartbeat():
+        hb = _parse_iso(job.get("heartbeatAt"))
+        if not hb or (datetime.now(timezone.utc) - hb).total_seconds() >= beat_every:
+            _touch()
+    try:
+        _touch(status="RUNNING", progress=0.0, error=None)
+        tasks, exp_by_task = _report_source(job["tenantId"], params.get("filters") or {}, heartbeat=_heartbeat)
+        total = len(tasks)
+        step = max(1, total // 20)
+
+        def _tracked():
+            for i, t in enumerate(tasks, 1):
+                yield t
+                if i % step == 0 and i < total:
+                    _touch(processed=i, total=total, progress=round(i / total, 3))
+                else:
+                    _heartbeat()
+
+        body, content_type, ext = _render_report(params["format"], params["level"], _tracked(), exp_by_task)
+        filename = _report_filename(params["level"], ext)
+        blob_name = f"{job['tenantId']}/{job['id']}/{filename}"
+        cont = _blob_service().get_container_client(os.environ.get("STG_REPORTS_CONTAINER", "reports"))
+        try:
+            cont.create_container()
+        except Exception:
+            pass  # already exists
+        cont.upload_blob(blob_name, body, overwrite=True, content_settings=ContentSettings(content_type=content_type))
+        _touch(status="SUCCEEDED", processed=total, total=total, progress=1.0,
+               blobName=blob_name, filename=filename, size=len(body), finishedAt=_now_iso())
+    except ConcurrentUpdate:
+        logging.info("report job %s was taken over by another run; stopping", job["id"])
+    except Exception as e:
+        try:
+            _touch(status="FAILED", error=str(e), finishedAt=_now_iso())
+        except Exception:
+            pass
+
+def _report_job_view(job):
+    out = {k: v for k, v in job.items() if not k.startswith("_")}
+    if job.get("status") == "SUCCEEDED" and job.get("blobName"):
+        minutes = int(os.environ.get("REPORT_SAS_MINUTES", "15"))
+        _, url = _sign_blob_url(os.environ.get("STG_REPORTS_CONTAINER", "reports"), job["blobName"],
+                                for_read=True, minutes=minutes,
+                                content_disposition=f'attachment; filename="{job.get("filename")}"')
+        out["downloadUrl"] = url
+        out["downloadExpiresAt"] = (datetime.now(timezone.utc) + timedelta(minutes=minutes)).isoformat()
+    return out
+
+@app.route(route="report/jobs", methods=["POST"])
+def report_jobs_create(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Queue a report build in the background (admin only).
+    Body: { tenantId, fromDate?, toDate?, assignee?, status?, slaBreached?,
+            format?: csv|ndjson|parquet|arrow, level?: task|expense, refresh?: false }
+    Returns 202 with the job; a recent identical job is returned as-is (cached: true) unless refresh=true.
+    A job that is still running (heartbeat within REPORT_JOB_STALE_SECONDS) is returned even with refresh.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        data = req.get_json()
+        tenant = data.get("tenantId", "default")
+        params = {
+            "filters": _report_filters(data),
+            "format":  (data.get("format") or "csv").lower(),
+            "level":   (data.get("level") or "task").lower(),
+        }
+        if params["format"] not in REPORT_FORMATS:
+            return func.HttpResponse(json.dumps({"error": f"format must be one of {', '.join(REPORT_FORMATS)}"}),
+                                     mimetype="application/json", status_code=400)
+        if params["level"] not in ("task", "expense"):
+            return func.HttpResponse(json.dumps({"error":"level must be task or expense"}),
+                                     mimetype="application/json", status_code=400)
+        try:
+            _report_task_query(tenant, params["filters"])
+        except ValueError:
+            return func.HttpResponse(json.dumps({"error":"fromDate/toDate must be YYYY-MM-DD"}),
+                                     mimetype="application/json", status_code=400)
+
+        jc = _jobs_container()
+        job_id = _report_job_id(tenant, params)
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        try:
+            job = jc.read_item(item=job_id, partition_key=tenant)
+        except CosmosResourceNotFoundError:
+            job = None
+
+        if job:
+            if not data.get("refresh") and job.get("status") == "SUCCEEDED" and _report_job_fresh(job):
+                return func.HttpResponse(json.dumps({**_report_job_view(job), "cached": True}),
+                                         mimetype="application/json", status_code=200)
+            if job.get("status") in REPORT_JOB_ACTIVE and not _report_job_stale(job):
+                return func.HttpResponse(json.dumps(_report_job_view(job)), mimetype="application/json", status_code=202)
+
+        now = _now_iso()
+        prev_etag = (job or {}).get("_etag")
+        job = {
+            "id": job_id,
+            "tenantId": tenant,
+            "docType": "ReportJob",
+            "params": params,
+            "status": "QUEUED",
+            "progress": 0.0,
+            "requestedBy": pr.get("userDetails") or pr.get("userId"),
+            "createdAt": now,
+            "updatedAt": now,
+            "heartbeatAt": now,
+            "ttl": int(os.environ.get("REPORT_JOB_TTL_SECONDS", str(7 * 24 * 3600)))
+        }
+        if prev_etag:
+            job["_etag"] = prev_etag
+        claimed = _claim_report_job(jc, job)
+        if claimed is None:
+            # another request started this job between our read and write: report that run
+            job = jc.read_item(item=job_id, partition_key=tenant)
+            return func.HttpResponse(json.dumps(_report_job_view(job)), mimetype="application/json", status_code=202)
+        _submit_report_job(dict(claimed))
+        return func.HttpResponse(json.dumps(_report_job_view(claimed)), mimetype="application/json", status_code=202)
+    except Exception as e:
+        return _error_response(e)
+
+@app.route(route="report/jobs", methods=["GET"])
+def report_jobs_get(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Job status (admin only). ?jobId=... returns one job with progress and, once done, a short-lived downloadUrl;
+    without jobId the tenant's recent jobs are listed. A job whose worker went silent is resumed here.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        tenant = req.params.get("tenantId", "default")
+        job_id = req.params.get("jobId")
+        jc = _jobs_container()
+        if not job_id:
+            q = ("SELECT TOP 50 * FROM c WHERE c.docType='ReportJob' AND c.tenantId=@t ORDER BY c.createdAt DESC")
+            items = list(jc.query_items(q, parameters=[{"name":"@t","value":tenant}], enable_cross_partition_query=True))
+            return func.HttpResponse(json.dumps([_report_job_view(j) for j in items]), mimetype="application/json", status_code=200)
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        try:
+            job = jc.read_item(item=job_id, partition_key=tenant)
+        except CosmosResourceNotFoundError:
+            return func.HttpResponse(json.dumps({"error":"job not found"}), mimetype="application/json", status_code=404)
+        if job.get("status") in REPORT_JOB_ACTIVE and _report_job_stale(job):
+            job["status"] = "QUEUED"
+            job["updatedAt"] = job["heartbeatAt"] = _now_iso()
+            claimed = _claim_report_job(jc, job)
+            if claimed is None:
+                job = jc.read_item(item=job_id, partition_key=tenant)  # someone else resumed it
+            else:
+                _submit_report_job(dict(claimed))
+        return func.HttpResponse(json.dumps(_report_job_view(job)), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+# ---- Dashboard stats (server-side aggregates)
+_STATS_CACHE = {}
+EXPENSE_AMOUNT_SQL = "(IS_NUMBER(c.editedTotal) ? c.editedTotal : (IS_NUMBER(c.total) ? c.total : 0))"
+
+def _tenant_aggregate(container, q, tenant, extra_params=None):
+    # Scoped to the tenant partition so GROUP BY/aggregates run server-side in one partition.
+    params = [{"name":"@t","value":tenant}] + (extra_params or [])
+    return list(container.query_items(q, parameters=params, partition_key=_tenant_pk(container, tenant)))
+
+def _stats_range(from_date=None, to_date=None):
+    """createdAt bounds (YYYY-MM-DD, both inclusive) as an extra WHERE clause and its params. Raises ValueError for malformed dates."""
+    where, params = "", []
+    if from_date:
+        where += " AND c.createdAt >= @from"
+        params.append({"name":"@from","value":datetime.strptime(from_date, "%Y-%m-%d").date().isoformat()})
+    if to_date:
+        where += " AND c.createdAt < @to"
+        hi = datetime.strptime(to_date, "%Y-%m-%d").date() + timedelta(days=1)
+        params.append({"name":"@to","value":hi.isoformat()})
+    return where, params
+
+def _compute_stats(tenant: str, days: int, from_date: str = None, to_date: str = None):
+    """
+    Task and expense stats for one tenant. Spend and approval counts cover archived expenses too: hot
+    copies awaiting their ttl are skipped and the totals recorded on each archived task added instead.
+    from_date/to_date keep tasks created in the range and, of their expenses, those created in it
+    (archived totals count with their task). approvalsByDay is built from hot expenses only.
+    """
+    tc = _tasks_container()
+    ec = _expenses_container()
+    rng, rng_params = _stats_range(from_date, to_date)
+    task_where = "c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t" + rng
+
+    by_status = _tenant_aggregate(tc,
+        f"SELECT c.status AS status, COUNT(1) AS n FROM c WHERE {task_where} GROUP BY c.status", tenant, rng_params)
+    sla = _tenant_aggregate(tc,
+        "SELECT COUNT(1) AS completed, SUM(c.slaBreached = true ? 1 : 0) AS breached FROM c "
+        f"WHERE {task_where} AND c.status='COMPLETED'", tenant, rng_params)
+    budget = _tenant_aggregate(tc,
+        "SELECT " + ", ".join(f"SUM(IS_NUMBER(c.expenseLimits.{k}) ? c.expenseLimits.{k} : 0) AS {k}" for k in DEFAULT_LIMITS)
+        + f" FROM c WHERE {task_where}", tenant, rng_params)
+    assignees = {t["id"]: (t.get("assignee") or "").strip().lower() for t in _tenant_aggregate(tc,
+        f"SELECT c.id, c.assignee FROM c WHERE {task_where}", tenant, rng_params)}
+    rows = _tenant_aggregate(ec,
+        f"SELECT c.taskId AS taskId, c.category AS category, c.approval.status AS status, COUNT(1) AS n, "
+        f"SUM({EXPENSE_AMOUNT_SQL}) AS amount FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) "
+        f"AND NOT IS_DEFINED(c.ttl) AND c.tenantId=@t{rng} GROUP BY c.taskId, c.category, c.approval.status",
+        tenant, rng_params)
+    if rng:
+        rows = [r for r in rows if r.get("taskId") in assignees]
+    for t in _tenant_aggregate(tc,
+            f"SELECT c.id, c.archive.totals AS totals FROM c WHERE {task_where} AND IS_DEFINED(c.archive.totals)",
+            tenant, rng_params):
+        rows.extend({**r, "taskId": t["id"]} for r in (t.get("totals") or []))
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).date().isoformat()
+    by_day = _tenant_aggregate(ec,
+        "SELECT LEFT(c.approval.decidedAt ?? c.approval.evaluatedAt, 10) AS day, c.approval.status AS status, COUNT(1) AS n "
+        "FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND IS_DEFINED(c.approval.status) "
+        "AND (c.approval.decidedAt ?? c.approval.evaluatedAt) >= @since "
+        "GROUP BY LEFT(c.approval.decidedAt ?? c.approval.evaluatedAt, 10), c.approval.status",
+        tenant, [{"name":"@since","value":since}])
+
+    tasks_by_status = {(r.get("status") or "UNKNOWN"): r.get("n", 0) for r in by_status}
+    completed = (sla[0].get("completed") if sla else 0) or 0
+    breached  = (sla[0].get("breached") if sla else 0) or 0
+
+    spend_by_category, spend_by_assignee, approvals = {}, {}, {}
+    for r in rows:
+        st = r.get("status") or "UNSUBMITTED"
+        approvals[st] = approvals.get(st, 0) + (r.get("n") or 0)
+        if st != "REJECTED":
+            cat = r.get("category") or "Other"
+            spend_by_category[cat] = round(spend_by_category.get(cat, 0.0) + _money(r.get("amount")), 2)
+            who = assignees.get(r.get("taskId")) or "(unassigned)"
+            spend_by_assignee[who] = round(spend_by_assignee.get(who, 0.0) + _money(r.get("amount")), 2)
+
+    timeline = {}
+    for r in by_day:
+        if not r.get("day"):
+            continue
+        timeline.setdefault(r["day"], {})[r.get("status")] = r.get("n", 0)
+
+    return {
+        "tenantId": tenant,
+        "generatedAt": _now_iso(),
+        "range": {"fromDate": from_date, "toDate": to_date},
+        "tasks": {
+            "total": sum(tasks_by_status.values()),
+            "byStatus": tasks_by_status,
+            "completed": completed,
+            "slaBreached": breached,
+            "slaBreachRate": round(breached / completed, 4) if completed else 0.0
+        },
+        "expenses": {
+            "approvalCounts": approvals,
+            "budgetByCategory": {k: round(_money((budget[0] if budget else {}).get(k)), 2) for k in DEFAULT_LIMITS},
+            "spendByCategory": spend_by_category,
+            "spendByAssignee": dict(sorted(spend_by_assignee.items(), key=lambda kv: -kv[1])),
+            "approvalsByDay": [{"day": d, **timeline[d]} for d in sorted(timeline)]
+        }
+    }
+
+@app.route(route="stats", methods=["GET"], reads="eventual")
+def stats(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only dashboard aggregates computed in Cosmos (GROUP BY/SUM) instead of in the browser.
+    Query params: tenantId, days (approval timeline window, default 30), fromDate/toDate (YYYY-MM-DD,
+    task createdAt range), refresh=true to bypass the cache.
+    Results are cached per worker for STATS_TTL_SECONDS (default 60).
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        tenant = req.params.get("tenantId", "default")
+        days = min(max(int(req.params.get("days", "30")), 1), 366)
+        from_date = req.params.get("fromDate") or None
+        to_date = req.params.get("toDate") or None
+        try:
+            _stats_range(from_date, to_date)
+        except ValueError:
+            return func.HttpResponse(json.dumps({"error":"fromDate/toDate must be YYYY-MM-DD"}), mimetype="application/json", status_code=400)
+        key = (tenant, days, from_date, to_date)
+        now = time.time()
+        hit = _STATS_CACHE.get(key)
+        if hit and hit[0] > now and req.params.get("refresh", "false").lower() != "true":
+            return func.HttpResponse(json.dumps({**hit[1], "cached": True}), mimetype="application/json", status_code=200)
+        out = _compute_stats(tenant, days, from_date, to_date)
+        _STATS_CACHE[key] = (now + int(os.environ.get("STATS_TTL_SECONDS", "60")), out)
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+# ---- SLA monitor (time-bucketed)
+_SLA_LAST_SCAN = {}
+
+def _sla_scan(tenant: str, *, now=None):
+    """
+    Flag open tasks whose slaEnd has passed (BREACHED) or falls within SLA_RISK_MINUTES (AT_RISK).
+    Reads only tasks whose slaDueBucket is at or before the horizon bucket; writes only changed tasks,
+    and only their slaRisk/slaRiskAt, skipping any completed or deleted since the query.
+    """
+    now = now or datetime.now(timezone.utc)
+    window = timedelta(minutes=int(os.environ.get("SLA_RISK_MINUTES", "60")))
+    q = ("SELECT * FROM c WHERE c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
+         "AND IS_DEFINED(c.slaDueBucket) AND c.slaDueBucket <= @hb")
+    items = list(_tasks_container().query_items(q, parameters=[
+        {"name":"@t","value":tenant},
+        {"name":"@hb","value":_sla_bucket(now + window)}
+    ], enable_cross_partition_query=True))
+
+    breached, at_risk, flagged = [], [], 0
+    for t in items:
+        sla_end = _parse_iso(t.get("slaEnd"))
+        if not sla_end or t.get("status") == "COMPLETED":
+            continue
+        if sla_end.tzinfo is None: sla_end = sla_end.replace(tzinfo=timezone.utc)
+        if now > sla_end:
+            risk = "BREACHED"
+        elif sla_end - now <= window:
+            risk = "AT_RISK"
+        else:
+            continue
+        if t.get("slaRisk") != risk:
+            flag = {"slaRisk": risk, "slaRiskAt": _now_iso()}
+            if _patch_doc(_tasks_container(), t, [{"op": "set", "path": f"/{k}", "value": v} for k, v in flag.items()],
+                          predicate="FROM c WHERE c.status != 'COMPLETED' AND NOT IS_DEFINED(c.deletedAt)") is None:
+                continue  # completed or deleted meanwhile
+            t.update(flag)
+            flagged += 1
+        row = {k: t.get(k) for k in ("id", "title", "assignee", "status", "slaStart", "slaEnd", "checkInAt", "slaRisk", "slaRiskAt")}
+        row["minutesLeft"] = round((sla_end - now).total_seconds() / 60, 1)
+        (breached if risk == "BREACHED" else at_risk).append(row)
+
+    breached.sort(key=lambda r: r["minutesLeft"])
+    at_risk.sort(key=lambda r: r["minutesLeft"])
+    result = {
+        "tenantId": tenant,
+        "scannedAt": now.isoformat(),
+        "horizonMinutes": int(window.total_seconds() // 60),
+        "scanned": len(items),
+        "flagged": flagged,
+        "breached": breached,
+        "atRisk": at_risk
+    }
+    _SLA_LAST_SCAN[tenant] = (time.time(), result)
+    return result
+
+def _sla_backfill(tenant: str) -> int:
+    """One-off: add slaDueBucket to open tasks created before the SLA index existed."""
+    q = ("SELECT * FROM c WHERE c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND NOT IS_DEFINED(c.slaDueBucket) "
+         "AND IS_DEFINED(c.slaEnd) AND c.status != 'COMPLETED'")
+    n = 0
+    for t in _tasks_container().query_items(q, parameters=[{"name":"@t","value":tenant}], enable_cross_partition_query=True):
+        if _sla_bucket(t.get("slaEnd")):
+            try:
+                _save_task(t)
+            except ConcurrentUpdate:
+                continue  # changed (or deleted) since the query; its own save sets the bucket
+            n += 1
+    return n
+
+@app.route(route="sla/at-risk", methods=["GET"])
+def sla_at_risk(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only: open tasks past or near slaEnd. Reuses this worker's last scan when it is
+    younger than SLA_SCAN_INTERVAL_SECONDS (default 60); otherwise scans first.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        tenant = req.params.get("tenantId", "default")
+        hit = _SLA_LAST_SCAN.get(tenant)
+        if hit and time.time() - hit[0] < int(os.environ.get("SLA_SCAN_INTERVAL_SECONDS", "60")):
+            return func.HttpResponse(json.dumps({**hit[1], "cached": True}), mimetype="application/json", status_code=200)
+        return func.HttpResponse(json.dumps(_sla_scan(tenant)), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+@app.route(route="sla/scan", methods=["POST"])
+def sla_scan(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only: run the SLA monitor now (for an external scheduler).
+    Body: { tenantId, backfill?: false } — backfill indexes open tasks saved before slaDueBucket existed.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        try:
+            data = req.get_json() or {}
+        except ValueError:
+            data = {}
+        tenant = data.get("tenantId", "default")
+        backfilled = _sla_backfill(tenant) if data.get("backfill") else 0
+        out = _sla_scan(tenant)
+        out["backfilled"] = backfilled
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+# Static Web Apps managed functions only host HTTP triggers; on a standalone Function App,
+# set SLA_MONITOR_SCHEDULE (NCRONTAB, e.g. "0 */1 * * * *") to run the monitor on a timer.
+if os.environ.get("SLA_MONITOR_SCHEDULE"):
+    @app.timer_trigger(schedule="%SLA_MONITOR_SCHEDULE%", arg_name="timer", run_on_startup=False)
+    def sla_monitor(timer: func.TimerRequest) -> None:
+        for tenant in os.environ.get("SLA_MONITOR_TENANTS", "default").split(","):
+            if tenant.strip():
+                _run_scoped(_sla_scan, tenant.strip())
+
+@app.route(route="maintenance/cosmos-metrics", methods=["GET"])
+def maintenance_cosmos_metrics(req: func.HttpRequest) -> func.HttpResponse:
+    """Admin-only: this worker's Cosmos retry/throttle counters and circuit-breaker state."""
+    pr, err = _ensure_admin(req)
+    if err: return err
+    with _METRICS_LOCK:
+        out = dict(_COSMOS_METRICS)
+        open_for = max(0.0, _BREAKER["openUntil"] - time.time())
+        out["breaker"] = {"open": open_for > 0, "openForMs": int(open_for * 1000),
+                          "recentFailures": len(_BREAKER["failures"])}
+    return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+
+# ---- Maintenance: partition migration (copy docs into dedicated / hierarchical containers)
+@app.route(route="maintenance/migrate", methods=["POST"])
+def maintenance_migrate(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only, resumable copy of one docType from a source container to a target container, e.g.
+    TaskEvent docs from the shared "Tasks" container into an "Events" container keyed by /tenantId,/taskId.
+    Body: { source, target, docType, maxItems?: 1000, reset?: false }
+    Each call copies up to maxItems docs in _ts (last-modified) order and checkpoints that position in
+    the Jobs container, so docs created or changed in the source meanwhile are (re)copied by a later call.
+    Call again until "done" is true, point EVENTS_CONTAINER/EXPENSES_CONTAINER/CATALOG_CONTAINER at the
+    target, then call once more to pick up anything written to the source before the switch took effect.
+    Source documents are left in place. The target is created with hierarchical keys when COSMOS_HIERARCHICAL_PK=true.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        data = req.get_json()
+        source   = (data.get("source") or "").strip()
+        target   = (data.get("target") or "").strip()
+        doc_type = (data.get("docType") or "").strip()
+        max_items = min(max(int(data.get("maxItems") or 1000), 1), 10000)
+        if not source or not target or not doc_type or source == target:
+            return func.HttpResponse(json.dumps({"error":"source, target (different) and docType are required"}),
+                                     mimetype="application/json", status_code=400)
+
+        src = _get_container_named(source)
+        dst = _get_container_named(target, pk_paths=_per_task_pk_paths(target) if doc_type in ("TaskEvent", "Expense") else None)
+        jc = _jobs_container()
+        ck_id = f"migrate-{source}-{target}-{doc_type}"
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        try:
+            ck = jc.read_item(item=ck_id, partition_key="_system")
+        except CosmosResourceNotFoundError:
+            ck = None
+        if not ck or data.get("reset"):
+            ck = {"id": ck_id, "tenantId": "_system", "docType": "MigrationCheckpoint",
+                  "source": source, "target": target, "migratedDocType": doc_type,
+                  "lastTs": 0, "idsAtLastTs": [], "copied": 0, "done": False, "startedAt": _now_iso()}
+        # checkpoints written before the _ts cursor (lastId only) restart from 0; upserts make re-copies harmless
+        last_ts, ids_at_last = int(ck.get("lastTs") or 0), ck.get("idsAtLastTs") or []
+
+        q = ("SELECT TOP @n * FROM c WHERE c.docType=@dt "
+             "AND (c._ts > @ts OR (c._ts = @ts AND NOT ARRAY_CONTAINS(@ids, c.id))) ORDER BY c._ts")
+        rows = list(src.query_items(q, parameters=[
+            {"name":"@n","value":max_items},
+            {"name":"@dt","value":doc_type},
+            {"name":"@ts","value":last_ts},
+            {"name":"@ids","value":ids_at_last}
+        ], enable_cross_partition_query=True))
+
+        docs = [{k: v for k, v in r.items() if not k.startswith("_")} for r in rows]
+        _run_bounded(dst.upsert_item, docs, int(os.environ.get("MIGRATE_CONCURRENCY", "8")))
+
+        if rows:
+            top = max(r.get("_ts") or 0 for r in rows)
+            at_top = [r["id"] for r in rows if r.get("_ts") == top]
+            ck["idsAtLastTs"] = sorted(set(at_top) | set(ids_at_last)) if top == last_ts else at_top
+            ck["lastTs"] = top
+            ck["copied"] += len(docs)
+        ck.pop("lastId", None)
+        ck["done"] = len(docs) < max_items
+        ck["updatedAt"] = _now_iso()
+        jc.upsert_item(ck)
+        return func.HttpResponse(json.dumps({k: v for k, v in ck.items() if not k.startswith("_")}),
+                                 mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+# ---- Maintenance: archive events/expenses of old completed tasks
+def _archive_task(task):
+    """
+    Compact a completed task's events and decided expenses into one archive blob, then retire the hot
+    copies: a per-document ttl where the container has TTL enabled, otherwise an immediate delete.
+    Expenses still PENDING_REVIEW stay hot (the approval queue only reads hot docs); the task records
+    how many were left so a later run picks them up once decided. Per category/status totals of what
+    was archived go on the task for /api/stats.
+    """
+    tenant, task_id = task["tenantId"], task["id"]
+    params = [{"name":"@t","value":tenant},{"name":"@task","value":task_id}]
+    evc, exc = _events_container(), _expenses_container()
+    events = list(evc.query_items("SELECT * FROM c WHERE c.docType='TaskEvent' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND c.taskId=@task",
+                                  parameters=params, enable_cross_partition_query=True))
+    expenses = list(exc.query_items("SELECT * FROM c WHERE c.docType='Expense' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND c.taskId=@task",
+                                    parameters=params, enable_cross_partition_query=True))
+    strip = lambda docs: [{k: v for k, v in d.items() if not k.startswith("_")} for d in docs]
+    hot_events = strip(events)
+    hot_expenses = [e for e in strip(expenses) if (e.get("approval") or {}).get("status") != "PENDING_REVIEW"]
+    pending = len(expenses) - len(hot_expenses)
+    # keep anything archived earlier (a re-run after new late expenses)
+    events = _with_archived(task, "events", hot_events)
+    expenses = _with_archived(task, "expenses", hot_expenses)
+
+    blob_name = f"{tenant}/{task_id}.json"
+    cont = _blob_service().get_container_client(_archive_container_name())
+    try:
+        cont.create_container()
+    except Exception:
+        pass  # already exists
+    body = json.dumps({"tenantId": tenant, "taskId": task_id, "archivedAt": _now_iso(),
+                       "events": events, "expenses": expenses})
+    cont.upload_blob(blob_name, body.encode("utf-8"), overwrite=True,
+                     content_settings=ContentSettings(content_type="application/json"))
+
+    ttl = int(os.environ.get("ARCHIVE_HOT_TTL_SECONDS", str(7 * 24 * 3600)))
+    for container, docs in ((evc, hot_events), (exc, hot_expenses)):
+        hot = [d for d in docs if "ttl" not in d]
+        if _TTL_ENABLED.get(container.id):
+            # patch only the ttl, and never onto a doc that was soft-deleted since the query
+            _run_bounded(lambda d: _patch_doc(container, d, [{"op": "set", "path": "/ttl", "value": ttl}],
+                                              predicate="FROM c WHERE NOT IS_DEFINED(c.deletedAt)"),
+                         hot, int(os.environ.get("ARCHIVE_CONCURRENCY", "8")))
+        else:
+            for d in hot:
+                try:
+                    _delete_doc(container, d)
+                except Exception:
+                    pass  # already gone
+    totals = {}
+    for e in expenses:
+        key = (e.get("category"), (e.get("approval") or {}).get("status"))
+        row = totals.setdefault(key, {"category": key[0], "status": key[1], "n": 0, "amount": 0.0})
+        row["n"] += 1
+        row["amount"] = round(row["amount"] + _expense_amount(e), 2)
+    task["archive"] = {"blob": blob_name, "archivedAt": _now_iso(), "events": len(events), "expenses": len(expenses),
+                       "pending": pending, "totals": list(totals.values())}
+    _save_task(task)
+    return task["archive"]
+
+def _archive_due(tenant: str, older_than_days: int, max_tasks: int):
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(days=older_than_days)).isoformat()
+    # tasks archived with expenses still pending are revisited at most daily, so they can't crowd out the rest
+    q = ("SELECT TOP @n * FROM c WHERE c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t AND c.status='COMPLETED' "
+         "AND c.checkOutAt < @cutoff AND (NOT IS_DEFINED(c.archive) OR (c.archive.pending > 0 AND c.archive.archivedAt < @recheck))")
+    tasks = list(_tasks_container().query_items(q, parameters=[
+        {"name":"@n","value":max_tasks},
+        {"name":"@t","value":tenant},
+        {"name":"@cutoff","value":cutoff},
+        {"name":"@recheck","value":(now - timedelta(days=1)).isoformat()}
+    ], enable_cross_partition_query=True))
+    results = []
+    for t in tasks:
+        try:
+            results.append({"taskId": t["id"], "ok": True, **_archive_task(t)})
+        except Exception as e:
+            results.append({"taskId": t["id"], "ok": False, "error": str(e)})
+    return results
+
+@app.route(route="maintenance/archive", methods=["POST"])
+def maintenance_archive(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only: archive events and expenses of tasks completed more than olderThanDays ago
+    (ARCHIVE_AFTER_DAYS, default 90). Body: { tenantId, olderThanDays?, maxTasks?: 50 }.
+    Processes at most maxTasks per call; "more": true means call again.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        try:
+            data = req.get_json() or {}
+        except ValueError:
+            data = {}
+        tenant = data.get("tenantId", "default")
+        days = int(data.get("olderThanDays") or os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+        max_tasks = min(max(int(data.get("maxTasks") or 50), 1), 500)
+        results = _archive_due(tenant, days, max_tasks)
+        out = {"tenantId": tenant, "olderThanDays": days, "archived": sum(1 for r in results if r["ok"]),
+               "more": len(results) == max_tasks, "results": results}
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+# As with the SLA monitor, a timer is only registered outside Static Web Apps managed functions.
+if os.environ.get("ARCHIVE_SCHEDULE"):
+    @app.timer_trigger(schedule="%ARCHIVE_SCHEDULE%", arg_name="timer", run_on_startup=False)
+    def archive_monitor(timer: func.TimerRequest) -> None:
+        days = int(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))
+        for tenant in os.environ.get("ARCHIVE_TENANTS", "default").split(","):
+            if tenant.strip():
+                _run_scoped(_archive_due, tenant.strip(), days, 500)
 
 # ---- Tasks (delete with optional cascade)
+def _cascade_soft_delete(tenant: str, task_id: str, deleted_at: str, deleted_by: str):
+    """Mark a deleted task's events and expenses with the task's deletedAt (so restore can find them)."""
+    params = [{"name":"@t","value":tenant},{"name":"@task","value":task_id}]
+    for container, doc_type in ((_events_container(), "TaskEvent"), (_expenses_container(), "Expense")):
+        q = (f"SELECT c.id, c.tenantId, c.taskId FROM c WHERE c.docType='{doc_type}' AND NOT IS_DEFINED(c.deletedAt) "
+             "AND c.tenantId=@t AND c.taskId=@task")
+        try:
+            docs = list(container.query_items(q, parameters=params, enable_cross_partition_query=True))
+            _run_bounded(lambda d: _soft_delete(container, d, deleted_by, deleted_at, deletedWithTask=True), docs,
+                         int(os.environ.get("PURGE_CONCURRENCY", "8")))
+        except Exception:
+            logging.exception("cascade soft delete failed for %s/%s %s", tenant, task_id, doc_type)
+    _notify_queue(tenant)
+
 @app.route(route="tasks/delete", methods=["POST", "DELETE"])
 def tasks_delete(req: func.HttpRequest) -> func.HttpResponse:
     """
-    Delete a Task (admin only). Supports:
+    Soft-delete a Task (admin only); undo with trash/restore until purgeAfter. Supports:
       - POST body: { tenantId, taskId, cascade: true|false }
       - DELETE query: ?tenantId=..&taskId=..&cascade=true
-    If cascade is true (default), also deletes TaskEvent + Expense docs for the task.
+    If cascade is true (default), the task's TaskEvent + Expense docs are marked in the background
+    and removed with it by maintenance/purge.
     """
     pr, err = _ensure_admin(req)
     if err:
@@ -892,39 +3515,18 @@ def tasks_delete(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(json.dumps({"error": "task not found"}),
                                      mimetype="application/json", status_code=404)
 
-        result = {"ok": True, "tenantId": tenant, "taskId": task_id, "events": 0, "expenses": 0, "cascade": cascade}
-
+        actor = pr.get("userDetails") or pr.get("userId")
+        marker = _soft_delete(_tasks_container(), task, actor, deleteCascade=cascade)
+        _apply_product_usage(tenant, _usage_delta(before=task.get("items")))
         if cascade:
-            # Delete TaskEvent docs
-            try:
-                evc = _events_container()
-                qev = "SELECT c.id FROM c WHERE c.docType='TaskEvent' AND c.tenantId=@t AND c.taskId=@task"
-                for ev in evc.query_items(qev, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}],
-                                          enable_cross_partition_query=True):
-                    evc.delete_item(item=ev["id"], partition_key=tenant)
-                    result["events"] += 1
-            except Exception:
-                pass  # don't fail delete if cleanup has issues
-
-            # Delete Expense docs
-            try:
-                exc = _expenses_container()
-                qex = "SELECT c.id FROM c WHERE c.docType='Expense' AND c.tenantId=@t AND c.taskId=@task"
-                for ex in exc.query_items(qex, parameters=[{"name":"@t","value":tenant},{"name":"@task","value":task_id}],
-                                          enable_cross_partition_query=True):
-                    exc.delete_item(item=ex["id"], partition_key=tenant)
-                    result["expenses"] += 1
-            except Exception:
-                pass
-
-        # Delete the Task itself
-        _tasks_container().delete_item(item=task_id, partition_key=tenant)
+            _submit_background(_cascade_soft_delete, tenant, task_id, marker["deletedAt"], actor)
 
+        result = {"ok": True, "tenantId": tenant, "taskId": task_id, "cascade": cascade,
+                  "deletedAt": marker["deletedAt"], "purgeAfter": marker["purgeAfter"]}
         return func.HttpResponse(json.dumps(result), mimetype="application/json", status_code=200)
 
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}),
-                                 mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 # ---- Tasks (update: title/type/assignee/SLA/budgets/products)
 @app.route(route="tasks/update", methods=["POST","PUT"])
@@ -940,6 +3542,8 @@ def tasks_update(req: func.HttpRequest) -> func.HttpResponse:
         "assignee": "user@example.com",
         "slaStart": "2025-10-11T09:00:00Z",
         "slaEnd":   "2025-10-11T18:00:00Z",
+        "site": { "type": "Point", "coordinates": [77.59, 12.97] },   // or siteLat/siteLng
+        "siteRadiusM": 150,
         "expenseLimits": { "Hotel": 1200, "Food": 900, "Travel": 1500, "Other": 500 },
         "items": [ { "productId": "p1", "quantity": 2 }, ... ]
       }
@@ -972,7 +3576,21 @@ def tasks_update(req: func.HttpRequest) -> func.HttpResponse:
         if "slaEnd" in data:
             task["slaEnd"] = data.get("slaEnd") or None
 
+        # Site location (GeoJSON point); site: null clears it
+        if "site" in data or "siteLat" in data:
+            site = _site_from(data)
+            if site:
+                task["site"] = site
+            else:
+                task.pop("site", None)
+        if "siteRadiusM" in data:
+            try:
+                task["siteRadiusM"] = _site_radius(data["siteRadiusM"])
+            except ValueError as e:
+                return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=400)
+
         # Budgets
+        old_limits = task.get("expenseLimits")
         if isinstance(data.get("expenseLimits"), dict):
             el = data["expenseLimits"]
             def num(x): 
@@ -987,6 +3605,7 @@ def tasks_update(req: func.HttpRequest) -> func.HttpResponse:
             task["expenseLimits"] = limits
 
         # Products
+        old_items = task.get("items")
         if isinstance(data.get("items"), list):
             norm = []
             for it in data["items"]:
@@ -1006,11 +3625,13 @@ def tasks_update(req: func.HttpRequest) -> func.HttpResponse:
         task["updatedAt"] = _now_iso()
 
         _save_task(task)
-        return func.HttpResponse(json.dumps(task), mimetype="application/json", status_code=200)
+        _apply_product_usage(tenant, _usage_delta(before=old_items, after=task.get("items")))
+        reevaluating = _queue_limit_reevaluation(task, old_limits) if "expenseLimits" in data else []
+        return func.HttpResponse(json.dumps(task), mimetype="application/json", status_code=200,
+                                 headers={"X-Reevaluating": ",".join(reevaluating)} if reevaluating else None)
 
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}),
-                                 mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 # ---- Products (delete)
 @app.route(route="products/delete", methods=["POST","DELETE"])
@@ -1033,29 +3654,37 @@ def products_delete(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(json.dumps({"error":"productId required"}),
                                      mimetype="application/json", status_code=400)
 
-        # Block deletion if used in any tasks unless force=true
-        if not force:
-            tc = _tasks_container()
-            q = ("SELECT TOP 1 c.id FROM c WHERE c.docType='Task' AND c.tenantId=@t "
-                 "AND EXISTS(SELECT VALUE x FROM x IN c.items WHERE x.productId=@pid)")
-            ref = list(tc.query_items(q, parameters=[{"name":"@t","value":tenant},{"name":"@pid","value":pid}],
-                                      enable_cross_partition_query=True))
-            if ref:
-                return func.HttpResponse(json.dumps({"error":"Product used in existing tasks. Use force=true to delete anyway."}),
-                                         mimetype="application/json", status_code=409)
-
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
         cc = _catalog_container()
         try:
-            _ = cc.read_item(item=pid, partition_key=tenant)
-        except Exception:
+            product = _read_doc(cc, pid, tenant)
+        except CosmosResourceNotFoundError:
             return func.HttpResponse(json.dumps({"error":"product not found"}), mimetype="application/json", status_code=404)
 
-        cc.delete_item(item=pid, partition_key=tenant)
-        return func.HttpResponse(json.dumps({"ok": True, "productId": pid}),
+        # Block deletion if used in any live tasks unless force=true
+        if not force:
+            used = product.get("usageCount")
+            if used is None or used <= 0:
+                # the counter is only a hint (increments are best-effort): "unused" is confirmed by the
+                # authoritative EXISTS count before deleting, and a drifted or missing counter is reset
+                tc = _tasks_container()
+                q = ("SELECT VALUE COUNT(1) FROM c WHERE c.docType='Task' AND NOT IS_DEFINED(c.deletedAt) AND c.tenantId=@t "
+                     "AND EXISTS(SELECT VALUE x FROM x IN c.items WHERE x.productId=@pid)")
+                used = (list(tc.query_items(q, parameters=[{"name":"@t","value":tenant},{"name":"@pid","value":pid}],
+                                            partition_key=_tenant_pk(tc, tenant))) or [0])[0]
+                if used != product.get("usageCount"):
+                    _patch_doc(cc, product, [{"op": "set", "path": "/usageCount", "value": used}])
+            if used > 0:
+                return func.HttpResponse(json.dumps({"error":"Product used in existing tasks. Use force=true to delete anyway.",
+                                                     "usageCount": used}),
+                                         mimetype="application/json", status_code=409)
+
+        marker = _soft_delete(cc, product, pr.get("userDetails") or pr.get("userId"))
+        return func.HttpResponse(json.dumps({"ok": True, "productId": pid, **marker}),
                                  mimetype="application/json", status_code=200)
 
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 
 # ---- Expenses (delete)
@@ -1077,19 +3706,142 @@ def expenses_delete(req: func.HttpRequest) -> func.HttpResponse:
             return func.HttpResponse(json.dumps({"error":"expenseId required"}),
                                      mimetype="application/json", status_code=400)
 
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
         ec = _expenses_container()
         try:
-            _ = ec.read_item(item=exp_id, partition_key=tenant)
-        except Exception:
+            exp = _read_doc(ec, exp_id, tenant)
+        except CosmosResourceNotFoundError:
             return func.HttpResponse(json.dumps({"error":"expense not found"}), mimetype="application/json", status_code=404)
 
-        ec.delete_item(item=exp_id, partition_key=tenant)
-        return func.HttpResponse(json.dumps({"ok": True, "expenseId": exp_id}),
+        marker = _soft_delete(ec, exp, pr.get("userDetails") or pr.get("userId"))
+        _notify_queue(tenant)
+        return func.HttpResponse(json.dumps({"ok": True, "expenseId": exp_id, **marker}),
                                  mimetype="application/json", status_code=200)
 
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}),
-                                 mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+# ---- Trash (restore within the retention window) and purge
+TRASH_KINDS = {
+    "task":    lambda: _tasks_container(),
+    "product": lambda: _catalog_container(),
+    "expense": lambda: _expenses_container(),
+}
+
+@app.route(route="trash/restore", methods=["POST"])
+def trash_restore(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only undo of a soft delete.
+    Body: { tenantId?, kind: "task"|"product"|"expense", id }
+    Restoring a task also restores the events/expenses its cascade delete marked.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        data = req.get_json()
+        tenant = (data.get("tenantId") or "default").strip()
+        kind = (data.get("kind") or "").strip().lower()
+        doc_id = (data.get("id") or "").strip()
+        if kind not in TRASH_KINDS or not doc_id:
+            return func.HttpResponse(json.dumps({"error":"kind (task|product|expense) and id required"}),
+                                     mimetype="application/json", status_code=400)
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        c = TRASH_KINDS[kind]()
+        try:
+            doc = _read_doc(c, doc_id, tenant, include_deleted=True)
+        except CosmosResourceNotFoundError:
+            doc = None
+        if not doc or "deletedAt" not in doc:
+            return func.HttpResponse(json.dumps({"error":f"no deleted {kind} {doc_id}"}),
+                                     mimetype="application/json", status_code=404)
+        _undelete(c, doc)
+
+        restored = {"events": 0, "expenses": 0}
+        if kind == "task":
+            _apply_product_usage(tenant, _usage_delta(after=doc.get("items")))
+            params = [{"name":"@t","value":tenant},{"name":"@task","value":doc_id},{"name":"@at","value":doc["deletedAt"]}]
+            for key, container, doc_type in (("events", _events_container(), "TaskEvent"), ("expenses", _expenses_container(), "Expense")):
+                q = f"SELECT * FROM c WHERE c.docType='{doc_type}' AND c.tenantId=@t AND c.taskId=@task AND c.deletedAt=@at"
+                children = list(container.query_items(q, parameters=params, enable_cross_partition_query=True))
+                _run_bounded(lambda d: _undelete(container, d), children, int(os.environ.get("PURGE_CONCURRENCY", "8")))
+                restored[key] = len(children)
+        if kind in ("task", "expense"):
+            _notify_queue(tenant)
+        return func.HttpResponse(json.dumps({"ok": True, "kind": kind, "id": doc_id, "restored": restored}),
+                                 mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+def _purge_children(tenant: str, task_id: str):
+    """Remove whatever the cascade left of a purged task (including children the background marking missed)."""
+    params = [{"name":"@t","value":tenant},{"name":"@task","value":task_id}]
+    for container, doc_type in ((_events_container(), "TaskEvent"), (_expenses_container(), "Expense")):
+        q = f"SELECT c.id, c.tenantId, c.taskId FROM c WHERE c.docType='{doc_type}' AND c.tenantId=@t AND c.taskId=@task"
+        for d in list(container.query_items(q, parameters=params, enable_cross_partition_query=True)):
+            try:
+                _delete_doc(container, d)
+            except Exception:
+                pass  # already gone
+
+def _purge_due(max_items: int) -> dict:
+    """Hard-delete soft-deleted docs whose purgeAfter has passed (archive blobs of tasks go too)."""
+    now = _now_iso()
+    out = {"purged": 0, "failed": 0, "kept": 0}
+    containers = {}
+    for get in (_tasks_container, _catalog_container, _events_container, _expenses_container):
+        c = get()
+        containers[c.id] = c  # several kinds may share the Tasks container
+    for c in containers.values():
+        q = "SELECT TOP @n * FROM c WHERE IS_DEFINED(c.deletedAt) AND c.purgeAfter < @now"
+        docs = list(c.query_items(q, parameters=[{"name":"@n","value":max_items},{"name":"@now","value":now}],
+                                  enable_cross_partition_query=True))
+        def _purge(doc):
+            try:
+                if doc.get("deletedWithTask") and _get_task(doc["tenantId"], doc.get("taskId")):
+                    # parent task is live again (restored, or a cascade raced a restore): keep the child
+                    _undelete(c, doc)
+                    return "kept"
+                # etag-conditional: a task restored since the query is left alone (412), children included
+                _delete_doc(c, doc)
+                if doc.get("docType") == "Task":
+                    if doc.get("deleteCascade"):
+                        _purge_children(doc["tenantId"], doc["id"])
+                    if doc.get("archive"):
+                        try:
+                            _blob_service().get_container_client(_archive_container_name()).delete_blob(doc["archive"]["blob"])
+                        except Exception:
+                            pass
+                return "purged"
+            except Exception as e:
+                return "purged" if getattr(e, "status_code", None) == 404 else "failed"
+        done = _run_bounded(_purge, docs, int(os.environ.get("PURGE_CONCURRENCY", "8")))
+        for k in ("purged", "failed", "kept"):
+            out[k] = out.get(k, 0) + done.count(k)
+    return out
+
+@app.route(route="maintenance/purge", methods=["POST"])
+def maintenance_purge(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only: permanently remove soft-deleted tasks, products, events and expenses past purgeAfter.
+    Body (optional): { maxItems?: 500 } per container; call again while anything was purged.
+    Also runs on a timer when PURGE_SCHEDULE is set.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        try:
+            data = req.get_json() or {}
+        except ValueError:
+            data = {}
+        max_items = min(max(int(data.get("maxItems") or 500), 1), 5000)
+        return func.HttpResponse(json.dumps(_purge_due(max_items)), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
+
+if os.environ.get("PURGE_SCHEDULE"):
+    @app.timer_trigger(schedule="%PURGE_SCHEDULE%", arg_name="timer", run_on_startup=False)
+    def purge_monitor(timer: func.TimerRequest) -> None:
+        _run_scoped(_purge_due, 500)
 
 # ---- Users directory (for assignee picker)
 def _users_container():
@@ -1128,11 +3880,12 @@ def users_seen(req: func.HttpRequest) -> func.HttpResponse:
         if not roles:
             roles = ["employee"]
 
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
         c = _users_container()
         user_id = email
         try:
             doc = c.read_item(item=user_id, partition_key="default")
-        except Exception:
+        except CosmosResourceNotFoundError:
             doc = None
 
         if not display:
@@ -1147,6 +3900,10 @@ def users_seen(req: func.HttpRequest) -> func.HttpResponse:
             "roles": roles,
             "updatedAt": _now_iso()
         }
+        if doc and doc.get("active") is False:
+            # signing in doesn't undo a directory deactivation
+            body["active"] = False
+            body["deactivatedAt"] = doc.get("deactivatedAt")
         if doc:
             c.replace_item(item=user_id, body=body)
         else:
@@ -1155,29 +3912,33 @@ def users_seen(req: func.HttpRequest) -> func.HttpResponse:
 
         return func.HttpResponse(json.dumps({"ok": True, "user": body}), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
-@app.route(route="users", methods=["GET"])
+@app.route(route="users", methods=["GET"], reads="eventual")
 def users_list(req: func.HttpRequest) -> func.HttpResponse:
     """
     Admin-only: list users for the assignee picker.
     Optional query params:
       - q: search substring on name/email
       - includeAdmins=true to include admins
+      - includeInactive=true to include users deactivated by users/sync
     """
     pr, err = _ensure_admin(req)
     if err: return err
     try:
         qtxt = (req.params.get("q") or "").strip().lower()
         include_admins = (req.params.get("includeAdmins","false").lower() == "true")
+        include_inactive = (req.params.get("includeInactive","false").lower() == "true")
         c = _users_container()
-        sql = "SELECT c.id, c.email, c.displayName, c.roles FROM c WHERE c.tenantId=@t AND c.docType='User'"
+        sql = "SELECT c.id, c.email, c.displayName, c.roles, c.active FROM c WHERE c.tenantId=@t AND c.docType='User'"
         rows = list(c.query_items(sql, parameters=[{"name":"@t","value":"default"}], enable_cross_partition_query=True))
         out = []
         for r in rows:
             roles = [x for x in (r.get("roles") or [])]
             if not include_admins and "admin" in roles:
                 continue
+            if not include_inactive and r.get("active") is False:
+                continue
             if qtxt:
                 hay = f"{(r.get('displayName') or '').lower()} {(r.get('email') or '').lower()}"
                 if qtxt not in hay:
@@ -1190,7 +3951,7 @@ def users_list(req: func.HttpRequest) -> func.HttpResponse:
         out.sort(key=lambda x: ((x.get("displayName") or "").lower(), x.get("email") or ""))
         return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
 
 @app.route(route="users/upsert", methods=["POST"])
 def users_upsert(req: func.HttpRequest) -> func.HttpResponse:
@@ -1219,12 +3980,110 @@ def users_upsert(req: func.HttpRequest) -> func.HttpResponse:
             "roles": roles,
             "updatedAt": _now_iso()
         }
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
         try:
-            _ = c.read_item(item=email, partition_key="default")
+            c.read_item(item=email, partition_key="default")
+            exists = True
+        except CosmosResourceNotFoundError:
+            exists = False
+        if exists:
             c.replace_item(item=email, body=body)
-        except Exception:
+        else:
             body["createdAt"] = _now_iso()
             c.create_item(body)
         return func.HttpResponse(json.dumps(body), mimetype="application/json", status_code=200)
     except Exception as e:
-        return func.HttpResponse(json.dumps({"error": str(e)}), mimetype="application/json", status_code=500)
+        return _error_response(e)
+
+@app.route(route="users/sync", methods=["POST"])
+def users_sync(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Admin-only: apply a directory export (e.g. from HR) in one call.
+    Body: { users: [ { email, displayName?, roles?: ["employee"], active?: true } ],
+            mode?: "incremental" | "full", dryRun?: false, protectAdmins?: true }
+    Existing User docs are read once and diffed; only creates/changes are written, with bounded
+    concurrency. In "full" mode users missing from the export are deactivated (active=false);
+    admins are left alone unless protectAdmins=false.
+    """
+    pr, err = _ensure_admin(req)
+    if err: return err
+    try:
+        data = req.get_json()
+        incoming = data.get("users")
+        mode = (data.get("mode") or "incremental").lower()
+        dry_run = bool(data.get("dryRun", False))
+        protect_admins = bool(data.get("protectAdmins", True))
+        if not isinstance(incoming, list) or mode not in ("incremental", "full"):
+            return func.HttpResponse(json.dumps({"error":"users (list) required; mode is incremental or full"}),
+                                     mimetype="application/json", status_code=400)
+
+        c = _users_container()
+        sql = "SELECT * FROM c WHERE c.tenantId=@t AND c.docType='User'"
+        existing = {d["id"]: d for d in c.query_items(sql, parameters=[{"name":"@t","value":"default"}], enable_cross_partition_query=True)}
+
+        now = _now_iso()
+        writes, seen, invalid = [], set(), []
+        created = updated = unchanged = deactivated = 0
+        for i, u in enumerate(incoming):
+            email = ((u or {}).get("email") or "").strip().lower() if isinstance(u, dict) else ""
+            if not email or "@" not in email:
+                invalid.append({"row": i, "error": "valid email required"})
+                continue
+            if email in seen:
+                invalid.append({"row": i, "error": f"duplicate email {email}"})
+                continue
+            seen.add(email)
+            cur = existing.get(email)
+            roles = u.get("roles") or (cur or {}).get("roles") or ["employee"]
+            body = {
+                "id": email,
+                "tenantId": "default",
+                "docType": "User",
+                "email": email,
+                "displayName": (u.get("displayName") or "").strip() or (cur or {}).get("displayName") or _derive_display_name(email),
+                "roles": roles,
+                "active": u.get("active", True) is not False,
+                "updatedAt": now,
+                "createdAt": (cur or {}).get("createdAt") or now
+            }
+            if not body["active"]:
+                body["deactivatedAt"] = (cur or {}).get("deactivatedAt") or now
+            if cur is None:
+                created += 1
+            elif (cur.get("displayName"), cur.get("roles"), cur.get("active", True) is not False) == \
+                 (body["displayName"], body["roles"], body["active"]):
+                unchanged += 1
+                continue
+            else:
+                updated += 1
+            writes.append(body)
+
+        if mode == "full":
+            for email, cur in existing.items():
+                if email in seen or cur.get("active") is False:
+                    continue
+                if protect_admins and "admin" in (cur.get("roles") or []):
+                    continue
+                body = {k: v for k, v in cur.items() if not k.startswith("_")}
+                body.update({"active": False, "deactivatedAt": now, "updatedAt": now})
+                writes.append(body)
+                deactivated += 1
+
+        failed = []
+        if not dry_run and writes:
+            def _write(body):
+                try:
+                    c.upsert_item(body)
+                    return None
+                except Exception as e:
+                    return {"email": body["email"], "error": str(e)}
+            failed = [r for r in _run_bounded(_write, writes, int(os.environ.get("USER_SYNC_CONCURRENCY", "8"))) if r]
+
+        out = {
+            "mode": mode, "dryRun": dry_run,
+            "created": created, "updated": updated, "unchanged": unchanged, "deactivated": deactivated,
+            "invalid": invalid, "failed": failed
+        }
+        return func.HttpResponse(json.dumps(out), mimetype="application/json", status_code=200)
+    except Exception as e:
+        return _error_response(e)
@@ -0,0 +1,34 @@
+// Echo the API's Cosmos session token back on /api calls so list views (served at eventual
+// consistency) still show this browser's own writes. The token is only needed until replication
+// catches up, so it is dropped after MAX_AGE_MS instead of pinning the tab to one region forever.
+const HEADER = "x-fieldops-session";
+const KEY = "fieldops.session";
+const MAX_AGE_MS = 60 * 1000;
+
+function storedToken() {
+  try {
+    const saved = JSON.parse(sessionStorage.getItem(KEY) || "null");
+    if (saved && saved.token && Date.now() - saved.at < MAX_AGE_MS) return saved.token;
+  } catch {
+    // older plain-string value or unreadable storage: start over
+  }
+  sessionStorage.removeItem(KEY);
+  return null;
+}
+
+export default function installApiSession() {
+  if (typeof window === "undefined" || window.__fieldopsSession) return;
+  window.__fieldopsSession = true;
+  const original = window.fetch.bind(window);
+  window.fetch = async (input, init = {}) => {
+    const url = typeof input === "string" ? input : input?.url || "";
+    if (!url.startsWith("/api/")) return original(input, init);
+    const token = storedToken();
+    const headers = new Headers(init.headers || (typeof input === "string" ? undefined : input.headers));
+    if (token && !headers.has(HEADER)) headers.set(HEADER, token);
+    const res = await original(input, { ...init, headers });
+    const next = res.headers.get(HEADER);
+    if (next) sessionStorage.setItem(KEY, JSON.stringify({ token: next, at: Date.now() }));
+    return res;
+  };
+}
@@ -1,8 +1,11 @@
 import useSeenUser from "../lib/useSeenUser";
+import installApiSession from "../lib/apiSession";
 import "../styles/ui.css";      // you already added this
 import "../styles/shell.css";   // new shell styles
 import AppShell from "../components/AppShell";
 
+installApiSession();
+
 export default function MyApp({ Component, pageProps }) {
   return (
     <AppShell>
@@ -45,6 +45,15 @@ function fmtYMDUTC(d) {
   const day = String(d.getUTCDate()).padStart(2, "0");
   return `${y}-${m}-${day}`;
 }
+// Apply an approval-queue feed delta: drop removed ids, upsert changed items (keeping task context
+// attached by expenses/pending?include=task), oldest first like the server's queue.
+function mergeQueue(prev, items, removed, replace = false) {
+  const before = new Map((prev || []).map((e) => [e.id, e]));
+  const gone = new Set(removed || []);
+  const next = new Map(replace ? [] : (prev || []).filter((e) => !gone.has(e.id)).map((e) => [e.id, e]));
+  (items || []).forEach((e) => next.set(e.id, { ...e, task: e.task || before.get(e.id)?.task }));
+  return [...next.values()].sort((a, b) => new Date(a.createdAt || 0) - new Date(b.createdAt || 0));
+}
 function formatINR(n) {
   const v = Number(n || 0);
   if (v >= 1e7) return "₹" + (v / 1e7).toFixed(1) + "cr";
@@ -91,6 +100,7 @@ export default function Admin() {
   const [loadingPending, setLoadingPending] = useState(true);
   const [expenses, setExpenses] = useState([]);
   const [loadingAll, setLoadingAll] = useState(true);
+  const [listsLoaded, setListsLoaded] = useState(false);
 
   const tasksById = useMemo(() => {
     const m = {};
@@ -101,9 +111,12 @@ export default function Admin() {
   async function loadTasks() {
     try {
       const t = await fetch(`/api/tasks?tenantId=${tenantId}`).then((r) => r.json());
-      setTasks(Array.isArray(t) ? t : []);
+      const arr = Array.isArray(t) ? t : [];
+      setTasks(arr);
+      return arr;
     } catch (e) {
       console.error(e);
+      return [];
     }
   }
   async function loadProducts() {
@@ -115,8 +128,8 @@ export default function Admin() {
   async function loadPending() {
     setLoadingPending(true);
     try {
-      const p = await fetch(`/api/expenses/pending?tenantId=${tenantId}`).then((r) => r.json());
-      setPending(Array.isArray(p) ? p : []);
+      const p = await fetch(`/api/expenses/pending?tenantId=${tenantId}&include=task`).then((r) => r.json());
+      if (Array.isArray(p)) setPending((prev) => mergeQueue(prev, p, [], true));
     } catch (e) {
       console.error(e);
     } finally {
@@ -138,10 +151,37 @@ export default function Admin() {
     }
   }
   useEffect(() => {
-    loadTasks();
+    setListsLoaded(false);
     loadProducts();
     loadPending();
-    loadAllExpenses();
+  }, [tenantId]);
+
+  // Keep the approval queue live: long-poll expenses/pending/changes and merge each delta.
+  useEffect(() => {
+    let stopped = false;
+    let cursor = null;
+    (async () => {
+      while (!stopped) {
+        try {
+          const qs = `tenantId=${tenantId}&include=task&timeoutSec=15${cursor ? `&cursor=${encodeURIComponent(cursor)}` : ""}`;
+          const r = await fetch(`/api/expenses/pending/changes?${qs}`);
+          if (!r.ok) throw new Error(`queue feed: ${r.status}`);
+          const j = await r.json();
+          if (stopped) break;
+          cursor = j.cursor;
+          if (j.snapshot || j.items.length || j.removed.length) {
+            setPending((prev) => mergeQueue(prev, j.items, j.removed, j.snapshot));
+            if (j.snapshot) setLoadingPending(false);
+          }
+        } catch (e) {
+          console.error(e);
+          await new Promise((res) => setTimeout(res, 5000));
+        }
+      }
+    })();
+    return () => {
+      stopped = true;
+    };
   }, [tenantId]);
 
   async function openReceipt(exp) {
@@ -168,46 +208,33 @@ export default function Admin() {
     return (expenses || []).filter((e) => allowed.has(e.taskId) && inRange(e.createdAt));
   }, [expenses, tasksInRange, dFrom, dTo]);
 
-  /* ---------- KPIs ---------- */
-  const kpis = useMemo(() => {
-    const open = tasksInRange.filter((t) => (t.status || "ASSIGNED") !== "COMPLETED").length;
-    const completedList = tasksInRange.filter((t) => (t.status || "") === "COMPLETED");
-    const completed = completedList.length;
-    const breached = completedList.filter((t) => !!t.slaBreached).length;
-    const breachRate = completed ? (breached / completed) * 100 : 0;
-
-    const catKeys = ["Hotel", "Food", "Travel", "Other"];
-    const budget = { Hotel: 0, Food: 0, Travel: 0, Other: 0 };
-    for (const t of tasksInRange) {
-      const el = t.expenseLimits || {};
-      for (const k of catKeys) budget[k] += Number(el[k] || 0);
-    }
-
-    const spend = { Hotel: 0, Food: 0, Travel: 0, Other: 0 };
-    for (const e of expensesInRange) {
-      const st = e.approval?.status || "";
-      if (st === "REJECTED") continue;
-      const amt = Number(e.editedTotal ?? e.total ?? 0) || 0;
-      const cat = e.category || "Other";
-      if (spend[cat] == null) spend[cat] = 0;
-      spend[cat] += amt;
-    }
-
-    const perUser = {};
-    for (const e of expensesInRange) {
-      const st = e.approval?.status || "";
-      if (st === "REJECTED") continue;
-      const t = tasksById[e.taskId] || {};
-      const user = (t.assignee || "—").toLowerCase();
-      const amt = Number(e.editedTotal ?? e.total ?? 0) || 0;
-      perUser[user] = (perUser[user] || 0) + amt;
+  /* ---------- KPIs (aggregated server-side by /api/stats) ---------- */
+  const [stats, setStats] = useState(null);
+  async function loadStats() {
+    try {
+      let url = `/api/stats?tenantId=${tenantId}`;
+      if (reportFrom) url += `&fromDate=${reportFrom}`;
+      if (reportTo) url += `&toDate=${reportTo}`;
+      const r = await fetch(url);
+      if (r.ok) setStats(await r.json());
+    } catch (e) {
+      console.error(e);
     }
-    const ranked = Object.entries(perUser)
-      .map(([assignee, total]) => ({ assignee, total }))
-      .sort((a, b) => b.total - a.total);
-
-    return { open, completed, breachRate, budget, spend, rankedSpenders: ranked };
-  }, [tasksInRange, expensesInRange, tasksById]);
+  }
+  const kpis = useMemo(() => {
+    const t = stats?.tasks || {};
+    const x = stats?.expenses || {};
+    const open = (t.total || 0) - (t.byStatus?.COMPLETED || 0);
+    const ranked = Object.entries(x.spendByAssignee || {}).map(([assignee, total]) => ({ assignee, total }));
+    return {
+      open,
+      completed: t.completed || 0,
+      breachRate: (t.slaBreachRate || 0) * 100,
+      budget: x.budgetByCategory || {},
+      spend: x.spendByCategory || {},
+      rankedSpenders: ranked
+    };
+  }, [stats]);
 
   /* ---------- EOM (with adjustable N, NO caps on products) ---------- */
   const [eomN, setEomN] = useState(3);
@@ -405,6 +432,18 @@ export default function Admin() {
   const [tab, setTab] = useState("overview");
   const [topSpendN, setTopSpendN] = useState(5);
 
+  // The overview reads only /api/stats; the full task and expense lists load when a tab needs them.
+  useEffect(() => {
+    if (tab === "overview") loadStats();
+  }, [tab, tenantId, reportFrom, reportTo]);
+  useEffect(() => {
+    if (!listsLoaded && ["performance", "eom", "tasks", "expenses"].includes(tab)) {
+      setListsLoaded(true);
+      loadTasks();
+      loadAllExpenses();
+    }
+  }, [tab, listsLoaded]);
+
   // Auto-set current month when switching to EoM
   useEffect(() => {
     if (tab === "eom") {
@@ -421,14 +460,15 @@ export default function Admin() {
   const [quickTitle, setQuickTitle] = useState("");
   const [quickRows, setQuickRows] = useState([]); // array of tasks
 
-  function openQuickList(kind) {
+  async function openQuickList(kind) {
+    const inRangeTasks = listsLoaded ? tasksInRange : (await loadTasks()).filter((t) => inRange(t.createdAt));
     if (kind === "open") {
-      const rows = tasksInRange.filter((t) => (t.status || "ASSIGNED") !== "COMPLETED");
+      const rows = inRangeTasks.filter((t) => (t.status || "ASSIGNED") !== "COMPLETED");
       setQuickTitle("Open tasks");
       setQuickRows(rows);
       setQuickOpen(true);
     } else if (kind === "completed") {
-      const rows = tasksInRange.filter((t) => (t.status || "") === "COMPLETED");
+      const rows = inRangeTasks.filter((t) => (t.status || "") === "COMPLETED");
       setQuickTitle("Completed tasks");
       setQuickRows(rows);
       setQuickOpen(true);
@@ -628,9 +668,8 @@ export default function Admin() {
       await loadTasks();
       closeDelete();
       alert(
-        `Deleted task ${deleteTarget.title || deleteTarget.id}\nRemoved events: ${
-          j.events || 0
-        }, expenses: ${j.expenses || 0}`
+        `Deleted task ${deleteTarget.title || deleteTarget.id}` +
+          (j.purgeAfter ? `\nIt can be restored until ${new Date(j.purgeAfter).toLocaleString()}.` : "")
       );
     } catch (e) {
       alert(e.message || "Delete failed");
@@ -655,7 +694,7 @@ export default function Admin() {
       const j = await r.json();
       if (!r.ok) return alert(j.error || `Could not ${action}`);
       setNotes((prev) => ({ ...prev, [expenseId]: "" }));
-      await loadPending();
+      setPending((prev) => prev.filter((e) => e.id !== expenseId)); // the queue feed confirms it
       await loadAllExpenses();
     } catch (e) {
       alert(e.message || `Could not ${action}`);
@@ -1383,7 +1422,7 @@ function ExpensesTab(props) {
         ) : (
           <ul style={{ listStyle: "none", padding: 0, margin: 0 }}>
             {pending.map((e) => {
-              const t = tasksById[e.taskId] || {};
+              const t = e.task || tasksById[e.taskId] || {};
               const amount = Number(e.editedTotal ?? e.total ?? 0) || 0;
               const cat = e.category || "Other";
               const remBefore = e.approval?.remainingBefore;